@@ -0,0 +1,472 @@
+"""
+backups
+
+Online backups of the database. Each backup is a directory in settings.BACKUPS_DIR, with a manifest and compressed
+data files. Data is streamed from the database through the compressor to disk (and back, when restoring), so no table
+is ever held in memory.
+
+- SQLite: the online backup API copies the database a few pages at a time, so writers are only blocked briefly.
+- PostgreSQL: tables are dumped with COPY in parallel, biggest first, all reading the same exported snapshot so the
+  backup is consistent. COPY only takes the lock a SELECT would. Restoring drops the secondary indexes and foreign
+  keys, and empties and loads the tables, all in one transaction, so if that fails the database is left as it was.
+  Once that has committed, the indexes and constraints are rebuilt in parallel.
+
+Restoring needs the database schema to be at the same migration as the backup.
+"""
+import logging
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+SUFFIXES = {"gzip": ".gz", "zstd": ".zst", "none": ""}
+CHUNK_SIZE = 1024 * 1024
+
+
+class BackupFile(BaseModel):
+    name: str
+    file: str
+    bytes: int
+    rows: Optional[int] = None
+
+
+class Manifest(BaseModel):
+    name: str
+    created: datetime
+    dialect: str
+    compression: str
+    alembic_revision: Optional[str] = None
+    files: List[BackupFile] = []
+    sequences: Dict[str, int] = {}
+    seconds: float = 0
+
+    @property
+    def bytes(self) -> int:
+        return sum(file.bytes for file in self.files)
+
+
+def open_writer(path: Path, compression: str, level: int) -> BinaryIO:
+    """Open a file for writing, compressing on the fly"""
+    if compression == "gzip":
+        import gzip
+
+        return gzip.open(path, "wb", compresslevel=level)  # type: ignore
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("BACKUPS_COMPRESSION zstd requires zstandard")
+        return zstandard.ZstdCompressor(level=level).stream_writer(open(path, "wb"))
+    return open(path, "wb")
+
+
+def open_reader(path: Path, compression: str) -> BinaryIO:
+    """Open a file for reading, decompressing on the fly"""
+    if compression == "gzip":
+        import gzip
+
+        return gzip.open(path, "rb")  # type: ignore
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError(
+                "This backup is compressed with zstd, which requires zstandard"
+            )
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, "rb")
+
+
+def backups_dir() -> Path:
+    from .config import settings
+
+    return Path(settings.BACKUPS_DIR)
+
+
+def backup_path(name: str) -> Path:
+    if not re.fullmatch(r"[\w.-]+", name) or name.startswith("."):
+        raise ValueError(f"Invalid backup name {name!r}")
+    return backups_dir() / name
+
+
+def read_manifest(name: str) -> Manifest:
+    path = backup_path(name) / "manifest.json"
+    if not path.exists():
+        raise FileNotFoundError(f"No such backup {name!r}")
+    return Manifest.parse_file(path)
+
+
+def list_backups() -> List[Manifest]:
+    """All complete backups, most recent first"""
+    directory = backups_dir()
+    if not directory.is_dir():
+        return []
+    # The manifest is written last, so incomplete backups don't have one
+    found = [Manifest.parse_file(path) for path in directory.glob("*/manifest.json")]
+    return sorted(found, key=lambda manifest: manifest.created, reverse=True)
+
+
+def run_parallel(
+    func: Callable[[Any], Any], items: Iterable[Any], parallel: int
+) -> List[Any]:
+    """Run func on each item in a thread pool, raising the first error"""
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [executor.submit(func, item) for item in items]
+        try:
+            return [future.result() for future in as_completed(futures)]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def alembic_revision(cursor: Any) -> Optional[str]:
+    try:
+        cursor.execute("SELECT version_num FROM alembic_version")
+        row = cursor.fetchone()
+        return row[0] if row else None
+    except Exception:
+        # No migrations have been run
+        return None
+
+
+def sqlite_database() -> str:
+    from .db import engine
+
+    database = engine.url.database
+    if not database or database == ":memory:":
+        raise RuntimeError("Can't back up an in-memory SQLite database")
+    return database
+
+
+def sqlite_create(manifest: Manifest, directory: Path) -> None:
+    import sqlite3
+
+    from .config import settings
+
+    temp = directory / "main.sqlite.tmp"
+    source = sqlite3.connect(sqlite_database())
+    target = sqlite3.connect(temp)
+    try:
+        # Copies a batch of pages at a time, letting other connections in between batches
+        source.backup(target, pages=settings.BACKUPS_SQLITE_PAGES)
+        manifest.alembic_revision = alembic_revision(target.cursor())
+    finally:
+        target.close()
+        source.close()
+
+    file = f"main.sqlite{SUFFIXES[manifest.compression]}"
+    with open(temp, "rb") as src, open_writer(
+        directory / file, manifest.compression, settings.BACKUPS_COMPRESSION_LEVEL
+    ) as out:
+        shutil.copyfileobj(src, out, CHUNK_SIZE)
+    temp.unlink()
+    manifest.files = [
+        BackupFile(name="main", file=file, bytes=(directory / file).stat().st_size)
+    ]
+
+
+def sqlite_restore(manifest: Manifest, directory: Path) -> None:
+    import sqlite3
+
+    from .config import settings
+    from .db import engine
+
+    temp = directory / "main.sqlite.tmp"
+    with open_reader(
+        directory / manifest.files[0].file, manifest.compression
+    ) as src, open(temp, "wb") as out:
+        shutil.copyfileobj(src, out, CHUNK_SIZE)
+
+    # Don't keep using pooled connections to the database we're replacing
+    engine.dispose()
+    source = sqlite3.connect(temp)
+    target = sqlite3.connect(sqlite_database())
+    try:
+        source.backup(target, pages=settings.BACKUPS_SQLITE_PAGES)
+    finally:
+        target.close()
+        source.close()
+        temp.unlink()
+
+
+def pg_connection() -> Any:
+    """A raw psycopg2 connection from the pool, which has the COPY support we need"""
+    from .db import engine
+
+    if engine.dialect.driver != "psycopg2":
+        raise RuntimeError(
+            f"PostgreSQL backups require the psycopg2 driver, not {engine.dialect.driver}"
+        )
+    return engine.raw_connection()
+
+
+def quote(name: str) -> str:
+    from .db import engine
+
+    return engine.dialect.identifier_preparer.quote(name)
+
+
+def pg_alembic_revision(cursor: Any) -> Optional[str]:
+    # Check first, as a failed query would abort the transaction
+    cursor.execute("SELECT to_regclass('alembic_version') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return None
+    return alembic_revision(cursor)
+
+
+def pg_create(manifest: Manifest, directory: Path) -> None:
+    from .config import settings
+
+    suffix = SUFFIXES[manifest.compression]
+    main = pg_connection()
+    try:
+        cursor = main.cursor()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        # Every table is dumped from this snapshot, as if in a single transaction
+        cursor.execute("SELECT pg_export_snapshot()")
+        snapshot = cursor.fetchone()[0]
+        cursor.execute(
+            "SELECT tablename FROM pg_tables WHERE schemaname = current_schema() "
+            "ORDER BY pg_total_relation_size(quote_ident(tablename)::regclass) DESC"
+        )
+        tables = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            "SELECT sequencename, last_value FROM pg_sequences "
+            "WHERE schemaname = current_schema() AND last_value IS NOT NULL"
+        )
+        manifest.sequences = dict(cursor.fetchall())
+        manifest.alembic_revision = pg_alembic_revision(cursor)
+
+        def dump(table: str) -> BackupFile:
+            start = time.monotonic()
+            path = directory / f"{table}.copy{suffix}"
+            conn = pg_connection()
+            try:
+                cur = conn.cursor()
+                cur.execute(
+                    "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY"
+                )
+                cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+                with open_writer(
+                    path, manifest.compression, settings.BACKUPS_COMPRESSION_LEVEL
+                ) as out:
+                    cur.copy_expert(f"COPY {quote(table)} TO STDOUT", out)
+                rows = cur.rowcount
+                conn.rollback()
+            finally:
+                conn.close()
+            logger.info(
+                "Dumped %s: %d rows in %.1fs", table, rows, time.monotonic() - start
+            )
+            return BackupFile(
+                name=table, file=path.name, bytes=path.stat().st_size, rows=rows
+            )
+
+        files = run_parallel(dump, tables, settings.BACKUPS_PARALLEL)
+        order = {table: i for i, table in enumerate(tables)}
+        manifest.files = sorted(files, key=lambda file: order[file.name])
+        main.rollback()
+    finally:
+        main.close()
+
+
+def pg_deferred_ddl(
+    cursor: Any, tables: List[str]
+) -> Tuple[List[Tuple[str, str, str]], List[Tuple[str, str, str]]]:
+    """The secondary indexes and foreign keys on the tables, as (table, name, definition)"""
+    # Indexes that back a primary key, unique or exclusion constraint stay, so the data is still checked as it loads
+    cursor.execute(
+        """
+        SELECT t.relname, i.relname, pg_get_indexdef(x.indexrelid)
+        FROM pg_index x
+        JOIN pg_class t ON t.oid = x.indrelid
+        JOIN pg_class i ON i.oid = x.indexrelid
+        JOIN pg_namespace n ON n.oid = t.relnamespace
+        WHERE n.nspname = current_schema() AND t.relname = ANY(%s)
+          AND NOT EXISTS (
+            SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid AND c.contype IN ('p', 'u', 'x')
+          )
+        """,
+        (tables,),
+    )
+    indexes = cursor.fetchall()
+    cursor.execute(
+        """
+        SELECT t.relname, c.conname, pg_get_constraintdef(c.oid)
+        FROM pg_constraint c
+        JOIN pg_class t ON t.oid = c.conrelid
+        JOIN pg_namespace n ON n.oid = t.relnamespace
+        WHERE n.nspname = current_schema() AND t.relname = ANY(%s) AND c.contype = 'f'
+        """,
+        (tables,),
+    )
+    foreign_keys = cursor.fetchall()
+    return indexes, foreign_keys
+
+
+def pg_execute(sql: str) -> None:
+    conn = pg_connection()
+    try:
+        conn.cursor().execute(sql)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def pg_restore(manifest: Manifest, directory: Path) -> None:
+    from .config import settings
+
+    ddl_path = directory / "restore-ddl.sql"
+    if ddl_path.exists():
+        # Starting again would overwrite it with the definitions of whatever is left
+        raise RuntimeError(
+            f"A previous restore of this backup didn't finish rebuilding the indexes and foreign keys. Run the "
+            f"statements in {ddl_path} that haven't been run yet, then delete it."
+        )
+
+    tables = [file.name for file in manifest.files]
+    main = pg_connection()
+    try:
+        cursor = main.cursor()
+        revision = pg_alembic_revision(cursor)
+        if revision != manifest.alembic_revision:
+            raise RuntimeError(
+                f"The backup is at migration {manifest.alembic_revision}, but the database is at {revision}; "
+                "migrate the database first"
+            )
+        indexes, foreign_keys = pg_deferred_ddl(cursor, tables)
+
+        # Keep the definitions somewhere safe, in case rebuilding them fails once the data has been committed
+        with open(ddl_path, "w") as ddl:
+            for _, _, definition in indexes:
+                ddl.write(f"{definition};\n")
+            for table, name, definition in foreign_keys:
+                ddl.write(
+                    f"ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(name)} {definition};\n"
+                )
+
+        # Everything up to the commit is one transaction (DDL included), so a failure leaves the database untouched.
+        #  It also lets PostgreSQL skip the WAL for tables truncated in the same transaction, with wal_level=minimal.
+        for table, name, _ in foreign_keys:
+            cursor.execute(f"ALTER TABLE {quote(table)} DROP CONSTRAINT {quote(name)}")
+        for _, name, _ in indexes:
+            cursor.execute(f"DROP INDEX {quote(name)}")
+        cursor.execute(f"TRUNCATE {', '.join(quote(table) for table in tables)}")
+        for file in manifest.files:
+            start = time.monotonic()
+            with open_reader(directory / file.file, manifest.compression) as src:
+                cursor.copy_expert(f"COPY {quote(file.name)} FROM STDIN", src)
+            logger.info("Restored %s in %.1fs", file.name, time.monotonic() - start)
+        for sequence, value in manifest.sequences.items():
+            cursor.execute("SELECT setval(%s, %s)", (quote(sequence), value))
+        main.commit()
+    except BaseException:
+        main.rollback()
+        ddl_path.unlink(missing_ok=True)
+        raise
+    finally:
+        main.close()
+
+    try:
+        run_parallel(
+            pg_execute,
+            [f"ANALYZE {quote(table)}" for table in tables],
+            settings.BACKUPS_PARALLEL,
+        )
+        logger.info("Rebuilding %d indexes", len(indexes))
+        run_parallel(
+            pg_execute,
+            [definition for _, _, definition in indexes],
+            settings.BACKUPS_PARALLEL,
+        )
+        # Adding the foreign keys as NOT VALID is instant; validating them is the slow part, and can run in parallel
+        for table, name, definition in foreign_keys:
+            pg_execute(
+                f"ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(name)} {definition} NOT VALID"
+            )
+        run_parallel(
+            pg_execute,
+            [
+                f"ALTER TABLE {quote(table)} VALIDATE CONSTRAINT {quote(name)}"
+                for table, name, _ in foreign_keys
+            ],
+            settings.BACKUPS_PARALLEL,
+        )
+    except BaseException:
+        logger.critical(
+            "The data has been restored, but rebuilding the indexes and foreign keys failed. They are defined in %s; "
+            "run the statements that haven't been run yet, then delete it.",
+            ddl_path,
+        )
+        raise
+    ddl_path.unlink()
+
+
+def check_dialect(dialect: str) -> None:
+    if dialect not in {"sqlite", "postgresql"}:
+        raise RuntimeError(
+            f"Backups are only supported for SQLite and PostgreSQL, not {dialect}"
+        )
+
+
+def create_backup(name: Optional[str] = None) -> Manifest:
+    """Back up the database"""
+    from .config import settings
+    from .db import engine
+
+    dialect = engine.dialect.name
+    check_dialect(dialect)
+    if name is None:
+        name = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    directory = backup_path(name)
+    directory.mkdir(parents=True, exist_ok=False)
+
+    start = time.monotonic()
+    manifest = Manifest(
+        name=name,
+        created=datetime.utcnow(),
+        dialect=dialect,
+        compression=settings.BACKUPS_COMPRESSION,
+    )
+    try:
+        if dialect == "sqlite":
+            sqlite_create(manifest, directory)
+        else:
+            pg_create(manifest, directory)
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    manifest.seconds = round(time.monotonic() - start, 1)
+    (directory / "manifest.json").write_text(manifest.json(indent=2))
+    return manifest
+
+
+def restore_backup(name: str) -> Manifest:
+    """Replace the contents of the database with a backup"""
+    from .db import engine
+
+    manifest = read_manifest(name)
+    if manifest.dialect != engine.dialect.name:
+        raise RuntimeError(
+            f"Backup {name} is of a {manifest.dialect} database, not {engine.dialect.name}"
+        )
+    check_dialect(manifest.dialect)
+    directory = backup_path(name)
+    if manifest.dialect == "sqlite":
+        sqlite_restore(manifest, directory)
+    else:
+        pg_restore(manifest, directory)
+    return manifest
+
+
+def remove_backup(name: str) -> None:
+    read_manifest(name)
+    shutil.rmtree(backup_path(name))
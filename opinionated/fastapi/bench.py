@@ -0,0 +1,324 @@
+"""
+bench
+
+Benchmarks for the framework's hot paths (fastapi-admin bench), run in-process against the configured APP_MODULE:
+requests through the app's ASGI stack, route dispatch, the Sentry middleware, settings access, Session checkout and
+task enqueueing. Each scenario runs a fixed number of operations after a warmup, timed in batches, and the results
+(throughput and latency percentiles, with the versions of everything involved) can be saved as JSON and compared with
+an earlier run, so regressions show up before they reach production.
+"""
+import asyncio
+import gc
+import importlib
+import logging
+import platform
+import subprocess
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, cast
+
+import dramatiq
+from fastapi import APIRouter, FastAPI
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# The packages whose versions affect the results
+PACKAGES = [
+    "opinionated-fastapi",
+    "fastapi",
+    "starlette",
+    "pydantic",
+    "SQLAlchemy",
+    "dramatiq",
+    "sentry-sdk",
+]
+
+BENCH_QUEUE = "opinionated_bench"
+
+
+class Result(BaseModel):
+    name: str
+    operations: int
+    seconds: float
+    ops_per_second: float
+    mean_us: float
+    p50_us: float
+    p90_us: float
+    p99_us: float
+    max_us: float
+
+
+class Report(BaseModel):
+    created: datetime
+    environment: Dict[str, Optional[str]]
+    results: List[Result]
+
+
+def summarize(name: str, timings: List[float], batch: int) -> Result:
+    """Turn the timings of each batch into a result; percentiles are of the mean time per operation in each batch"""
+    per_op = sorted(timing / batch for timing in timings)
+    total = sum(timings)
+    operations = len(timings) * batch
+
+    def percentile(p: float) -> float:
+        return round(per_op[min(len(per_op) - 1, int(p * len(per_op)))] * 1e6, 3)
+
+    return Result(
+        name=name,
+        operations=operations,
+        seconds=round(total, 4),
+        ops_per_second=round(operations / total, 1),
+        mean_us=round(total / operations * 1e6, 3),
+        p50_us=percentile(0.5),
+        p90_us=percentile(0.9),
+        p99_us=percentile(0.99),
+        max_us=percentile(1.0),
+    )
+
+
+def run_sync(
+    name: str, func: Callable[[], Any], operations: int, batch: int = 1
+) -> Result:
+    rounds = max(1, operations // batch)
+    for _ in range(max(1, rounds // 10) * batch):
+        func()
+    gc.collect()
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(batch):
+            func()
+        timings.append(time.perf_counter() - start)
+    return summarize(name, timings, batch)
+
+
+async def run_async(
+    name: str, func: Callable[[], Awaitable[Any]], operations: int
+) -> Result:
+    for _ in range(max(1, operations // 10)):
+        await func()
+    gc.collect()
+    timings = []
+    for _ in range(operations):
+        start = time.perf_counter()
+        await func()
+        timings.append(time.perf_counter() - start)
+    return summarize(name, timings, 1)
+
+
+async def bench_endpoint(item_id: int) -> Dict[str, int]:
+    return {"id": item_id}
+
+
+def bench_task() -> None:
+    pass
+
+
+def add_bench_routes(app: FastAPI, routers: int, routes: int) -> Tuple[str, str]:
+    """
+    Add routers to the app the way load_controllers() does, after all of its own routes. Returns the paths of the
+    first and the very last of them, which has to be matched against every other route first.
+    """
+    from .config import settings
+
+    prefix = f"{settings.BASE_URL_PREFIX}/__bench"
+    for r in range(routers):
+        router = APIRouter()
+        for i in range(routes):
+            router.add_api_route(f"/{r}/{i}/{{item_id}}", bench_endpoint)
+        app.include_router(router, prefix=prefix)
+    return f"{prefix}/0/0/1", f"{prefix}/{routers - 1}/{routes - 1}/1"
+
+
+def sentry_app(app: FastAPI) -> Any:
+    """
+    The app wrapped in the Sentry middleware, tracing every request, with a client that sends nothing. The client is
+    bound to the current hub, replacing any configured one; run_http_scenarios() puts that back afterwards.
+    """
+    import sentry_sdk
+    from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
+    from sentry_sdk.transport import Transport
+
+    from .sentry import SentryTracingMiddleware
+
+    class NullTransport(Transport):
+        def capture_event(self, event: Any) -> None:
+            pass
+
+        def capture_envelope(self, envelope: Any) -> None:
+            pass
+
+    sentry_sdk.Hub.current.bind_client(
+        sentry_sdk.Client(
+            dsn="http://bench@127.0.0.1:9/1",
+            transport=NullTransport,
+            traces_sample_rate=1.0,
+        )
+    )
+    return SentryAsgiMiddleware(SentryTracingMiddleware(app, router=app.router))
+
+
+def environment(real_broker: bool) -> Dict[str, Optional[str]]:
+    from importlib.metadata import PackageNotFoundError, version
+
+    from .config import settings
+    from .db import engine
+
+    env: Dict[str, Optional[str]] = {
+        "python": f"{platform.python_implementation()} {platform.python_version()}",
+        "platform": platform.platform(),
+        "app_module": settings.APP_MODULE,
+        "database": engine.dialect.name,
+        # The broker the tasks were sent to
+        "broker": type(dramatiq.get_broker()).__name__ if real_broker else "StubBroker",
+        "sentry_configured": str(bool(settings.SENTRY_DSN)),
+    }
+    for package in PACKAGES:
+        try:
+            env[package] = version(package)
+        except PackageNotFoundError:
+            env[package] = None
+    try:
+        env["commit"] = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        env["commit"] = None
+    return env
+
+
+async def run_http_scenarios(
+    app: FastAPI,
+    requests: int,
+    routers: int,
+    routes: int,
+    wanted: Callable[[str], bool],
+) -> List[Result]:
+    import sentry_sdk
+
+    from .utils import asgi_request, http_scope
+
+    first, last = add_bench_routes(app, routers, routes)
+    results = []
+    # The other scenarios are the baseline for http.sentry, so they run with Sentry off, even if it's configured
+    hub = sentry_sdk.Hub.current
+    client = hub.client
+    hub.bind_client(None)
+    await app.router.startup()
+    try:
+        for name, with_sentry, path in [
+            ("http.request", False, first),
+            ("http.dispatch", False, last),
+            ("http.sentry", True, first),
+        ]:
+            if not wanted(name):
+                continue
+            asgi_app = sentry_app(app) if with_sentry else app
+            scope = http_scope(path)
+
+            async def request() -> None:
+                # Each request gets its own copy of the scope, as it would from a server
+                await asgi_request(asgi_app, dict(scope))
+
+            results.append(await run_async(name, request, requests))
+    finally:
+        await app.router.shutdown()
+        hub.bind_client(client)
+    return results
+
+
+def run_benchmarks(
+    requests: int = 2000,
+    routers: int = 50,
+    routes: int = 10,
+    scenarios: Optional[List[str]] = None,
+    real_broker: bool = False,
+) -> Report:
+    """
+    Run the benchmark scenarios (all of them, or those whose names start with any of scenarios). Tasks are sent to a
+    stub broker with the configured broker's middleware, unless real_broker is set: that measures the round trip to
+    the broker as well, and needs one that can take (and then lose) a few thousand messages.
+    """
+    from .config import current_snapshot, settings, settings_proxy
+    from .db import Session
+    from .server import FastApiAppProtocol
+
+    def wanted(name: str) -> bool:
+        return not scenarios or any(name.startswith(s) for s in scenarios)
+
+    app = cast(FastApiAppProtocol, importlib.import_module(settings.APP_MODULE)).app
+    results: List[Result] = []
+
+    # The cheap scenarios run many more operations, in batches so the timer doesn't dominate
+    # Reading a setting from the snapshot, as the registered modules do, and through the proxy, as everything else does
+    readers: List[Tuple[str, Any]] = [
+        ("settings.snapshot", current_snapshot()),
+        ("settings.proxy", settings_proxy),
+    ]
+    for name, obj in readers:
+        if wanted(name):
+            results.append(
+                run_sync(
+                    name,
+                    lambda: obj.DATABASE_URL,
+                    requests * 100,
+                    batch=100,
+                )
+            )
+
+    if wanted("db.session"):
+
+        def checkout() -> None:
+            with Session() as session:
+                session.connection()
+
+        results.append(run_sync("db.session", checkout, requests * 5, batch=10))
+
+    if wanted("tasks.enqueue"):
+        from dramatiq.brokers.stub import StubBroker
+
+        broker = dramatiq.get_broker()
+        if not real_broker:
+            broker = StubBroker(middleware=broker.middleware)
+        actor = dramatiq.actor(
+            bench_task,
+            actor_name="opinionated_bench_task",
+            queue_name=BENCH_QUEUE,
+            broker=broker,
+        )
+        try:
+            results.append(
+                run_sync("tasks.enqueue", actor.send, requests * 5, batch=10)
+            )
+        finally:
+            broker.flush(BENCH_QUEUE)
+
+    if any(wanted(name) for name in ["http.request", "http.dispatch", "http.sentry"]):
+        # Starting the app up opens its pools, connections and so on, so only do it if it's going to be used
+        results += asyncio.run(
+            run_http_scenarios(app, requests, routers, routes, wanted)
+        )
+    return Report(
+        created=datetime.utcnow(),
+        environment=environment(real_broker),
+        results=results,
+    )
+
+
+def compare(report: Report, baseline: Report) -> List[Tuple[str, float, float, float]]:
+    """(name, baseline ops/s, ops/s, change in percent) for each scenario in both reports"""
+    before = {result.name: result for result in baseline.results}
+    rows = []
+    for result in report.results:
+        if result.name in before:
+            old = before[result.name].ops_per_second
+            rows.append(
+                (
+                    result.name,
+                    old,
+                    result.ops_per_second,
+                    round((result.ops_per_second - old) / old * 100, 1),
+                )
+            )
+    return rows
@@ -14,14 +14,31 @@ import logging.config
 import os
 import sys
 from types import ModuleType
-from typing import List, Optional, Protocol, cast
+from typing import Any, Dict, List, Optional, Protocol, cast
 
 from fastapi import APIRouter, FastAPI
-
-from .config import init_config, settings
+from starlette.requests import Request
+from starlette.responses import Response
+
+from .compression import setup_compression_middleware
+from .config import (
+    bind_settings,
+    init_config,
+    register_settings_module,
+    settings,
+)
 from .default_settings import DEFAULT_LOGGING
+from .executors import setup_executors
+from .health import setup_health_checks
+from .log import RequestIDMiddleware, init_logging
+from .metrics import setup_metrics
+from .openapi import OpenAPIDocument, load_openapi_document
+from .profiling import setup_profiling_middleware
+from .responses import default_response_class
 from .sentry import init_sentry, setup_sentry_middleware
+from .shutdown import close_connections
 from .tasks import init_broker
+from .warmup import warmup
 
 logger = logging.getLogger(__name__)
 
@@ -32,7 +49,10 @@ initialized = False
 def load_modules(
     apps: List[str], mod_name: Optional[str] = None, mods: Optional[List[str]] = None
 ) -> List[ModuleType]:
-    """Generic function to load modules from apps and dedicated config paths"""
+    """
+    Generic function to load modules from apps and dedicated config paths. Their 'settings' is bound to the settings
+    snapshot at the end of setup(), as is that of the modules in them, for the apps' packages.
+    """
     res: List[ModuleType] = []
     for app in apps:
         full_path = f"{app}.{mod_name}" if mod_name is not None else app
@@ -49,6 +69,8 @@ def load_modules(
             # No protection; if there's an error, crash and burn and let the user know
             res.append(importlib.import_module(mod))
 
+    for module in res:
+        register_settings_module(module.__name__)
     return res
 
 
@@ -131,7 +153,7 @@ def setup():
     # - find the right Settings object using environment variables and import and instantiate it
     init_config()
 
-    logging.config.dictConfig({**DEFAULT_LOGGING, **settings.LOGGING})
+    init_logging()
 
     # Ordering is significant; sentry must initialize *before* db and dramatiq but *after* config
     # initialize sentry
@@ -144,6 +166,11 @@ def setup():
     if Engine is None:
         raise RuntimeError("Failed to initialize database engine.")
 
+    from .cache import init_query_cache
+    from .db import Session
+
+    init_query_cache(Session)
+
     # - find and import all model modules to ensure models are loaded into the sqlalchemy and alembic lists
     load_models()
 
@@ -159,6 +186,9 @@ def setup():
     # We don't use them here, but load the controllers, which makes sure they're ready and without obvious errors
     load_controllers()
 
+    # Everything that's going to import the settings has done so by now; give them the settings themselves
+    bind_settings()
+
 
 class OpinionatedFastAPI(FastAPI):
     def __init__(self, *args, **kwargs):
@@ -167,13 +197,70 @@ class OpinionatedFastAPI(FastAPI):
         kwargs.setdefault("openapi_url", f"{settings.BASE_URL_PREFIX}/openapi.json")
         kwargs.setdefault("title", settings.SERVER_TITLE)
         kwargs.setdefault("debug", settings.DEBUG)
+        kwargs.setdefault("default_response_class", default_response_class())
+
+        self.openapi_document: Optional[OpenAPIDocument] = None
 
         super().__init__(*args, **kwargs)
 
+        # Replace the openapi.json route with one that serves pre-serialized bytes (the docs routes still use it)
+        if self.openapi_url is not None:
+            self.router.routes = [
+                route
+                for route in self.router.routes
+                if getattr(route, "path", None) != self.openapi_url
+            ]
+            self.add_route(
+                self.openapi_url, self.openapi_endpoint, include_in_schema=False
+            )
+
+        # Add the compression middleware (and static files, which are served precompressed)
+        setup_compression_middleware(self)
+
+        # Add the profiler, inside sentry so it doesn't count sentry's overhead
+        setup_profiling_middleware(self)
+
         # Add the sentry ASGI middleware
         setup_sentry_middleware(self)
 
+        # Measure everything but the request ID
+        setup_metrics(self)
+
+        # Outermost, so everything else has the request ID available when logging
+        self.add_middleware(RequestIDMiddleware, header=settings.LOG_REQUEST_ID_HEADER)
+
         api_router = APIRouter()
         for router in load_controllers():
             api_router.include_router(router)
         self.include_router(api_router, prefix=settings.BASE_URL_PREFIX)
+
+        setup_health_checks(self)
+
+        # Before the handlers below: the pools are running by the time warmup starts, and stopped before the connections
+        #  they might be using are closed
+        setup_executors(self)
+
+        # Runs in each worker before it starts accepting requests
+        self.add_event_handler("startup", self.warmup)
+        # Runs once the server has stopped accepting connections and the in-flight requests have finished
+        self.add_event_handler("shutdown", close_connections)
+
+    def openapi(self) -> Dict[str, Any]:
+        """Return the OpenAPI schema, loading it from OPENAPI_SCHEMA_FILE if we can"""
+        if self.openapi_document is None:
+            document = None
+            if settings.OPENAPI_SCHEMA_FILE:
+                document = load_openapi_document(settings.OPENAPI_SCHEMA_FILE)
+            if document is None:
+                document = OpenAPIDocument.from_schema(super().openapi())
+            self.openapi_document = document
+            self.openapi_schema = document.schema
+        return cast(Dict[str, Any], self.openapi_schema)
+
+    async def openapi_endpoint(self, request: Request) -> Response:
+        self.openapi()
+        return cast(OpenAPIDocument, self.openapi_document).response(request)
+
+    async def warmup(self) -> None:
+        """Open connections and build caches ahead of the first requests. Override to add your own steps."""
+        await warmup(self)
@@ -0,0 +1,422 @@
+"""
+cache
+
+A query result cache for db.Session. Only statements that ask for it are cached, which is meant for reference data
+that is read far more often than it changes (settings tables, permissions, feature flags):
+
+    session.execute(select(FeatureFlag).execution_options(query_cache=True))
+    session.execute(select(Permission).where(...).execution_options(query_cache=60))  # ttl in seconds
+
+Results are keyed by the compiled SQL and its parameters. Each table has a version number; a cached result remembers
+the versions of the tables it read, and is stale once any of them changes. Committing a session bumps the versions of
+every table it wrote to (via the ORM, or ORM-enabled insert/update/delete statements). With the redis backend, the
+versions live in redis and are shared by all processes, and the results are signed with QUERY_CACHE_SECRET_KEY so that
+only ones we stored are ever unpickled. With the memory backend, each process has its own LRU cache, and invalidations
+are broadcast to the others over redis pub/sub, if QUERY_CACHE_REDIS_URL is set; the cache isn't used until the
+process has subscribed to them.
+
+Writes that bypass the Session (e.g. Core statements on a Connection, or another application) aren't seen; call
+invalidate() for those, and rely on the ttl otherwise.
+"""
+import hashlib
+import hmac
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Iterable, Optional, Set, Tuple
+
+from sqlalchemy import Table, event
+from sqlalchemy.engine import FrozenResult
+from sqlalchemy.orm import ORMExecuteState
+from sqlalchemy.orm import Session as OrmSession
+from sqlalchemy.orm import object_mapper, sessionmaker
+from sqlalchemy.orm.loading import merge_frozen_result
+from sqlalchemy.sql.expression import Alias
+from sqlalchemy.sql.util import find_tables
+
+logger = logging.getLogger(__name__)
+
+# Session.info key for the tables a session has written to in its current transaction
+WRITTEN_TABLES = "query_cache_tables"
+
+Versions = Tuple[int, ...]
+
+SIGNATURE_SIZE = hashlib.sha256().digest_size
+
+
+def statement_tables(statement: Any) -> FrozenSet[str]:
+    """The names of the tables a statement reads from, including subqueries and eagerly joined relationships"""
+    compile_state = getattr(statement, "compile_state", None)
+    if compile_state is not None:
+        # A compiled ORM statement; its compile state includes the joins added by loader options
+        statement = compile_state.statement
+    names = set()
+    for table in find_tables(statement, include_aliases=True):
+        if isinstance(table, Alias):
+            table = table.element
+        if isinstance(table, Table):
+            names.add(table.fullname)
+    return frozenset(names)
+
+
+class MemoryBackend:
+    """A per-process LRU cache. Versions are kept locally, and can be bumped by broadcasts from other processes."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, Tuple[FrozenResult, Versions, float]]" = (
+            OrderedDict()
+        )
+        self.table_versions: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def versions(self, tables: Tuple[str, ...]) -> Versions:
+        return tuple(self.table_versions.get(table, 0) for table in tables)
+
+    def get(
+        self, key: str, tables: Tuple[str, ...]
+    ) -> Tuple[Optional[FrozenResult], Versions]:
+        with self.lock:
+            versions = self.versions(tables)
+            entry = self.entries.get(key)
+            if entry is None:
+                return None, versions
+            value, entry_versions, expires = entry
+            if entry_versions != versions or expires < time.monotonic():
+                del self.entries[key]
+                return None, versions
+            self.entries.move_to_end(key)
+            return value, versions
+
+    def set(
+        self, key: str, value: FrozenResult, versions: Versions, ttl: float
+    ) -> None:
+        # Keep a copy that doesn't belong to any session, so the session that loaded the objects can't change them.
+        #  They're copied again into each session that reads them, which leaves this copy alone.
+        value = pickle.loads(pickle.dumps(value))
+        with self.lock:
+            self.entries[key] = (value, versions, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, tables: Iterable[str]) -> None:
+        with self.lock:
+            for table in tables:
+                self.table_versions[table] = self.table_versions.get(table, 0) + 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+class RedisBackend:
+    """A cache shared by all processes. The versions are redis counters, so invalidation needs no broadcast."""
+
+    def __init__(self, url: str, prefix: str, secret_key: bytes):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.secret_key = secret_key
+
+    def signature(self, data: bytes) -> bytes:
+        return hmac.new(self.secret_key, data, hashlib.sha256).digest()
+
+    def sign(self, data: bytes) -> bytes:
+        return self.signature(data) + data
+
+    def verify(self, signed: bytes) -> Optional[bytes]:
+        """The data, if we signed it, otherwise None"""
+        signature, data = signed[:SIGNATURE_SIZE], signed[SIGNATURE_SIZE:]
+        if not hmac.compare_digest(signature, self.signature(data)):
+            return None
+        return data
+
+    def get(
+        self, key: str, tables: Tuple[str, ...]
+    ) -> Tuple[Optional[FrozenResult], Versions]:
+        # One round trip for the entry and the current versions of its tables
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(f"{self.prefix}q:{key}")
+        pipe.mget([f"{self.prefix}v:{table}" for table in tables])
+        signed, raw_versions = pipe.execute()
+        versions = tuple(int(v or 0) for v in raw_versions)
+        if signed is None:
+            return None, versions
+        data = self.verify(signed)
+        if data is None:
+            logger.warning("Ignoring query cache entry %s with a bad signature", key)
+            return None, versions
+        entry_versions, value = pickle.loads(data)
+        if entry_versions != versions:
+            return None, versions
+        return value, versions
+
+    def set(
+        self, key: str, value: FrozenResult, versions: Versions, ttl: float
+    ) -> None:
+        self.client.set(
+            f"{self.prefix}q:{key}",
+            self.sign(pickle.dumps((versions, value))),
+            px=int(ttl * 1000),
+        )
+
+    def invalidate(self, tables: Iterable[str]) -> None:
+        pipe = self.client.pipeline(transaction=False)
+        for table in tables:
+            pipe.incr(f"{self.prefix}v:{table}")
+        pipe.execute()
+
+    def clear(self) -> None:
+        for key in self.client.scan_iter(f"{self.prefix}q:*"):
+            self.client.delete(key)
+
+
+class InvalidationBroadcast:
+    """
+    Tell the other processes' memory caches which tables changed, using redis pub/sub. Invalidations sent while a
+    process isn't subscribed are lost, so its cache is only used while it is.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        channel: str,
+        backend: MemoryBackend,
+        subscribe_timeout: float = 1.0,
+    ):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.channel = channel
+        self.backend = backend
+        self.subscribe_timeout = subscribe_timeout
+        self.pid: Optional[int] = None
+        self.subscribed = threading.Event()
+        self.lock = threading.Lock()
+
+    def ready(self) -> bool:
+        """
+        Whether we're subscribed, so the cache can be used. The listener thread is started lazily, so each forked
+        process gets its own, and the first query in a process waits (briefly) for it to subscribe.
+        """
+        if self.pid != os.getpid():
+            with self.lock:
+                started = self.pid != os.getpid()
+                if started:
+                    self.pid = os.getpid()
+                    self.subscribed = threading.Event()
+                    thread = threading.Thread(
+                        target=self.listen, name="QueryCacheInvalidation", daemon=True
+                    )
+                    thread.start()
+            if started:
+                return self.subscribed.wait(self.subscribe_timeout)
+        return self.subscribed.is_set()
+
+    def listen(self) -> None:
+        while True:
+            try:
+                pubsub = self.client.pubsub()
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message["type"] == "subscribe":
+                        # Anything cached before now (e.g. while we were reconnecting) may have missed an
+                        #  invalidation; from now on we'll see them all
+                        self.backend.clear()
+                        self.subscribed.set()
+                    elif message["type"] == "message":
+                        self.backend.invalidate(message["data"].decode().split(","))
+            except Exception:
+                self.subscribed.clear()
+                logger.exception("Lost query cache invalidation subscription")
+                time.sleep(1)
+
+    def publish(self, tables: Iterable[str]) -> None:
+        try:
+            self.client.publish(self.channel, ",".join(tables))
+        except Exception:
+            logger.exception("Failed to broadcast query cache invalidation")
+
+
+class QueryCache:
+    def __init__(
+        self,
+        backend: Any,
+        ttl: float,
+        broadcast: Optional[InvalidationBroadcast] = None,
+        max_statements: int = 1000,
+    ):
+        self.backend = backend
+        self.ttl = ttl
+        self.broadcast = broadcast
+        self.max_statements = max_statements
+        # Compiled SQL and tables for each statement shape, so we don't compile the same statement every time
+        self.statements: Dict[Any, Tuple[str, Tuple[str, ...]]] = {}
+
+    def key_and_tables(
+        self, orm_context: ORMExecuteState
+    ) -> Optional[Tuple[str, Tuple[str, ...]]]:
+        # A Select (or other statement with a cache key), which the type stubs only know as an Executable
+        statement: Any = orm_context.statement
+        cache_key = statement._generate_cache_key()
+        if cache_key is None:
+            # The statement contains something SQLAlchemy itself won't cache
+            return None
+        compiled = self.statements.get(cache_key.key)
+        if compiled is None:
+            bind = orm_context.session.get_bind(**orm_context.bind_arguments)
+            sql = statement.compile(dialect=bind.dialect)
+            compiled = (str(sql), tuple(sorted(statement_tables(sql))))
+            if len(self.statements) >= self.max_statements:
+                self.statements.clear()
+            self.statements[cache_key.key] = compiled
+        sql_str, tables = compiled
+
+        parameters = orm_context.parameters or {}
+        if cache_key.bindparams:
+            params = tuple(
+                parameters.get(bp.key, bp.effective_value)
+                for bp in cache_key.bindparams
+            )
+        else:
+            params = tuple(parameters[key] for key in sorted(parameters))
+        key = hashlib.sha1(repr((sql_str, params)).encode()).hexdigest()
+        return key, tables
+
+    def execute(self, orm_context: ORMExecuteState) -> Any:
+        option = orm_context.execution_options.get("query_cache")
+        if not option or not orm_context.is_select:
+            return None
+        key_and_tables = self.key_and_tables(orm_context)
+        if key_and_tables is None:
+            return None
+        key, tables = key_and_tables
+        written = orm_context.session.info.get(WRITTEN_TABLES)
+        if written and written.intersection(tables):
+            # The session has uncommitted changes to these tables, which it must see (and nobody else must)
+            return None
+
+        if self.broadcast is not None and not self.broadcast.ready():
+            return None
+        try:
+            value, versions = self.backend.get(key, tables)
+        except Exception:
+            logger.exception("Query cache lookup failed")
+            return None
+        if value is not None:
+            frozen = value
+        else:
+            frozen = orm_context.invoke_statement().freeze()
+            ttl = self.ttl if option is True else float(option)
+            try:
+                # Stored with the versions from before we ran the query, so it's stale if anything committed since
+                self.backend.set(key, frozen, versions, ttl)
+            except Exception:
+                logger.exception("Query cache store failed")
+        # Copy any objects into this session, rather than sharing them between sessions
+        return merge_frozen_result(
+            orm_context.session, orm_context.statement, frozen, load=False
+        )()
+
+    def invalidate(self, tables: Iterable[str]) -> None:
+        tables = sorted(tables)
+        if not tables:
+            return
+        try:
+            self.backend.invalidate(tables)
+        except Exception:
+            logger.exception("Query cache invalidation failed")
+        if self.broadcast is not None:
+            self.broadcast.publish(tables)
+
+
+# The cache in use, if it's enabled
+query_cache: Optional[QueryCache] = None
+
+
+def written_tables(session: OrmSession) -> Set[str]:
+    return session.info.setdefault(WRITTEN_TABLES, set())
+
+
+def _do_orm_execute(orm_context: ORMExecuteState) -> Any:
+    if orm_context.is_insert or orm_context.is_update or orm_context.is_delete:
+        table = getattr(orm_context.statement, "table", None)
+        if table is not None:
+            written_tables(orm_context.session).update(statement_tables(table))
+        return None
+    if query_cache is None:
+        return None
+    return query_cache.execute(orm_context)
+
+
+def _after_flush(session: OrmSession, flush_context: Any) -> None:
+    tables = written_tables(session)
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        tables.update(table.fullname for table in object_mapper(obj).tables)
+
+
+def _after_commit(session: OrmSession) -> None:
+    tables = session.info.pop(WRITTEN_TABLES, None)
+    if tables and query_cache is not None:
+        query_cache.invalidate(tables)
+
+
+def _after_rollback(session: OrmSession) -> None:
+    session.info.pop(WRITTEN_TABLES, None)
+
+
+def invalidate(*tables: str) -> None:
+    """Invalidate cached results that read any of these tables, for writes the Session didn't make"""
+    if query_cache is not None:
+        query_cache.invalidate(tables)
+
+
+def init_query_cache(session_factory: sessionmaker) -> None:
+    """Set up the query cache from the settings, and attach it to the session factory"""
+    global query_cache
+
+    from .config import settings
+
+    if not settings.QUERY_CACHE_ENABLED:
+        return
+
+    broadcast = None
+    if settings.QUERY_CACHE_BACKEND == "redis":
+        if settings.QUERY_CACHE_REDIS_URL is None:
+            raise RuntimeError(
+                "Must set QUERY_CACHE_REDIS_URL to use the redis query cache"
+            )
+        if settings.QUERY_CACHE_SECRET_KEY is None:
+            raise RuntimeError(
+                "Must set QUERY_CACHE_SECRET_KEY to use the redis query cache"
+            )
+        backend: Any = RedisBackend(
+            settings.QUERY_CACHE_REDIS_URL,
+            settings.QUERY_CACHE_PREFIX,
+            settings.QUERY_CACHE_SECRET_KEY.get_secret_value().encode(),
+        )
+    else:
+        backend = MemoryBackend(settings.QUERY_CACHE_MAX_ENTRIES)
+        if settings.QUERY_CACHE_REDIS_URL is not None:
+            broadcast = InvalidationBroadcast(
+                settings.QUERY_CACHE_REDIS_URL,
+                f"{settings.QUERY_CACHE_PREFIX}invalidate",
+                backend,
+            )
+        else:
+            logger.info(
+                "No QUERY_CACHE_REDIS_URL, so other processes won't see query cache invalidations until the ttl expires"
+            )
+
+    logger.info("Initializing %s query cache", settings.QUERY_CACHE_BACKEND)
+    query_cache = QueryCache(backend, settings.QUERY_CACHE_TTL, broadcast)
+
+    event.listen(session_factory, "do_orm_execute", _do_orm_execute)
+    event.listen(session_factory, "after_flush", _after_flush)
+    event.listen(session_factory, "after_commit", _after_commit)
+    event.listen(session_factory, "after_rollback", _after_rollback)
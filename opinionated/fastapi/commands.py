@@ -4,14 +4,16 @@ commands
 Library functions to handle the "manage.py" fastapi commands.
 """
 import importlib
+import importlib.util
 import logging
+import os
 import subprocess
 import sys
+import time
 from functools import partial
-from typing import List, Protocol, cast
+from typing import List, Optional, cast
 
 import typer
-from fastapi import FastAPI
 
 from .config import settings
 
@@ -57,53 +59,127 @@ def develop(
         raise typer.Exit(1)
 
 
-class FastApiAppProtocol(Protocol):
-    app: FastAPI
-
-
 @cli.command()
-def runserver():
+def runserver(
+    bind: List[str] = typer.Option(
+        settings.SERVER_BIND,
+        help="Address to bind to, as HOST:PORT or unix:PATH. Can be given more than once.",
+    ),
+    workers: Optional[int] = typer.Option(
+        settings.SERVER_WORKERS,
+        help="Number of worker processes. Defaults to the number of CPUs.",
+    ),
+    preload: bool = typer.Option(settings.SERVER_PRELOAD_APP),
+    max_requests: int = typer.Option(settings.SERVER_MAX_REQUESTS),
+    max_requests_jitter: int = typer.Option(settings.SERVER_MAX_REQUESTS_JITTER),
+    keepalive: int = typer.Option(settings.SERVER_KEEPALIVE),
+    backlog: int = typer.Option(settings.SERVER_BACKLOG),
+    timeout: int = typer.Option(settings.SERVER_TIMEOUT),
+    graceful_timeout: int = typer.Option(settings.SHUTDOWN_TIMEOUT),
+    limit_concurrency: Optional[int] = typer.Option(
+        settings.SERVER_LIMIT_CONCURRENCY,
+        help="Connections and tasks per worker beyond which requests get a 503. No limit by default.",
+    ),
+    loop: str = typer.Option(settings.SERVER_LOOP, help="auto, asyncio or uvloop"),
+    http: str = typer.Option(settings.SERVER_HTTP, help="auto, h11 or httptools"),
+):
     try:
-        from gunicorn.app.base import BaseApplication
+        import gunicorn  # noqa
     except ImportError:
         typer.echo("Failed to run server - gunicorn is not installed.", err=True)
         raise typer.Exit(1)
 
     try:
-        from uvicorn.workers import UvicornWorker
+        import uvicorn  # noqa
     except ImportError:
         typer.echo("Failed to run server - uvicorn is not installed.", err=True)
         raise typer.Exit(1)
 
+    # Check the optional speedups are available here, rather than having every worker fail to boot
+    for option, value, choices in (
+        ("loop", loop, {"auto", "asyncio", "uvloop"}),
+        ("http", http, {"auto", "h11", "httptools"}),
+    ):
+        if value not in choices:
+            typer.echo(f"Invalid --{option} '{value}'.", err=True)
+            raise typer.Exit(1)
+        if value in {"uvloop", "httptools"} and importlib.util.find_spec(value) is None:
+            typer.echo(f"Failed to run server - {value} is not installed.", err=True)
+            raise typer.Exit(1)
+
+    from .metrics import clear_metrics_dir
+    from .server import GunicornApplication, UvicornWorker, default_worker_count
+
     try:
         # If no app module set, use the default one
-        app = cast(FastApiAppProtocol, importlib.import_module(settings.APP_MODULE)).app
-
-        class FastApiApp(BaseApplication):
-            def init(self, parser, opts, args):
-                pass
-
-            def load_config(self):
-                # fixme: set some sane defaults and provide some command line arguments here
-                self.cfg.set("worker_class", "uvicorn.workers.UvicornWorker")
-
-            def load(self):
-                return app
-
-        FastApiApp().run()
+        app_found = importlib.util.find_spec(settings.APP_MODULE) is not None
     except ImportError:
+        app_found = False
+    if not app_found:
         typer.echo(
             f"Failed to run server - could not find app '{settings.APP_MODULE}'",
             err=True,
         )
         raise typer.Exit(1)
 
+    clear_metrics_dir("web")
+
+    # The workers are forked from this process, so they pick this up
+    UvicornWorker.CONFIG_KWARGS = {
+        "loop": loop,
+        "http": http,
+        "limit_concurrency": limit_concurrency,
+    }
+
+    GunicornApplication(
+        settings.APP_MODULE,
+        {
+            "bind": bind or [f"{settings.SERVER_HOST}:{settings.SERVER_PORT}"],
+            "workers": workers or default_worker_count(),
+            "preload_app": preload,
+            "max_requests": max_requests,
+            "max_requests_jitter": max_requests_jitter,
+            "keepalive": keepalive,
+            "backlog": backlog,
+            "timeout": timeout,
+            "graceful_timeout": graceful_timeout,
+        },
+    ).run()
+
+
+@cli.command()
+def buildopenapi(
+    output: Optional[str] = typer.Option(
+        settings.OPENAPI_SCHEMA_FILE,
+        help="File to write the schema to; a gzipped copy is written alongside it.",
+    ),
+):
+    """Generate the OpenAPI schema ahead of time, to be served from OPENAPI_SCHEMA_FILE."""
+    from fastapi import FastAPI
+
+    from .openapi import write_openapi_document
+    from .server import FastApiAppProtocol
+
+    if not output:
+        typer.echo("Set OPENAPI_SCHEMA_FILE or pass --output.", err=True)
+        raise typer.Exit(1)
+
+    app = cast(FastApiAppProtocol, importlib.import_module(settings.APP_MODULE)).app
+    # Call FastAPI's own implementation, so we don't just load the existing file
+    app.openapi_schema = None
+    document = write_openapi_document(FastAPI.openapi(app), output)
+    typer.echo(f"Wrote OpenAPI schema to {output} ({len(document.body)} bytes)")
+
 
 @cli.command()
 def runworker(
     hostname: str = typer.Option(settings.SERVER_HOST),
     processes: int = typer.Option(settings.WORKER_PROCESSES),
     reload: bool = typer.Option(settings.WORKER_RELOAD),
+    scheduler: bool = typer.Option(
+        settings.WORKER_EMBED_SCHEDULER,
+        help="Run the scheduler inside the worker processes, instead of a separate runscheduler process.",
+    ),
 ):
     # Only consume 'default' queue normally, because we don't want to get scheduler events
     queues = settings.WORKER_QUEUES
@@ -119,24 +195,159 @@ def runworker(
         str(processes),
         "-Q",
         *queues,
+        # Leave room to requeue the tasks that get interrupted, see GracefulShutdownNotifications
+        "--worker-shutdown-timeout",
+        str(settings.SHUTDOWN_TIMEOUT * 1000),
     ]
     if reload:
         cmd += ["--watch", "."]
 
+    from .metrics import clear_metrics_dir
+
+    clear_metrics_dir("worker")
+
+    # The worker processes run setup() again, so pass the scheduler option through as a setting
+    env = {
+        **os.environ,
+        "FASTAPI_WORKER_EMBED_SCHEDULER": "true" if scheduler else "false",
+    }
+
     # fixme: do we need to double check that environ variables are passed through?
-    ret = subprocess.call(cmd)
+    ret = subprocess.call(cmd, env=env)
     if ret != 0:
         raise typer.Exit(ret)
 
 
 @cli.command()
 def runscheduler():
+    from .metrics import clear_metrics_dir
     from .scheduler import run_scheduler
 
-    # fixme: make an option on runworker to add --scheduler, and run this as an extra thread/process.
+    clear_metrics_dir("scheduler")
+    # See also 'runworker --scheduler', which runs the scheduler inside the worker processes instead.
     run_scheduler()
 
 
+profiles = typer.Typer(help="Look at the profiles saved by the sampling profiler.")
+cli.add_typer(profiles, name="profiles")
+
+
+@profiles.command("list")
+def profiles_list(limit: int = typer.Option(20)):
+    """List the most recent profiles"""
+    from datetime import datetime
+
+    from .profiling import list_profiles
+
+    found = list_profiles(settings.PROFILING_DIR)
+    if not found:
+        typer.echo(f"No profiles in {settings.PROFILING_DIR}")
+        return
+    for path in found[:limit]:
+        stat = path.stat()
+        typer.echo(
+            f"{datetime.fromtimestamp(stat.st_mtime):%Y-%m-%d %H:%M:%S}  "
+            f"{stat.st_size // 1024:>6}K  {path.name}"
+        )
+
+
+@profiles.command("show")
+def profiles_show(name: Optional[str] = typer.Argument(None)):
+    """Open a profile (the most recent, if no name is given)"""
+    import webbrowser
+
+    from .profiling import list_profiles
+
+    found = list_profiles(settings.PROFILING_DIR)
+    if name is not None:
+        found = [path for path in found if path.name == name]
+    if not found:
+        typer.echo("No such profile.", err=True)
+        raise typer.Exit(1)
+
+    path = found[0].resolve()
+    if path.name.endswith(".html"):
+        webbrowser.open(path.as_uri())
+    else:
+        typer.echo(
+            f"{path}\nOpen it with 'speedscope {path}', or at https://www.speedscope.app"
+        )
+
+
+@profiles.command("clear")
+def profiles_clear():
+    """Remove all saved profiles"""
+    from .profiling import list_profiles
+
+    found = list_profiles(settings.PROFILING_DIR)
+    for path in found:
+        path.unlink()
+    typer.echo(f"Removed {len(found)} profiles.")
+
+
+@cli.command()
+def bench(
+    output: Optional[str] = typer.Option(
+        None, help="Write the results to this JSON file."
+    ),
+    requests: int = typer.Option(
+        2000,
+        help="Requests per HTTP scenario; the cheaper scenarios run more operations.",
+    ),
+    scenario: List[str] = typer.Option(
+        [], help="Only run the scenarios starting with this, e.g. http or db.session."
+    ),
+    compare: Optional[str] = typer.Option(
+        None, help="Compare with the results of an earlier run."
+    ),
+    max_regression: Optional[float] = typer.Option(
+        None, help="Fail if any scenario is this many percent slower than in --compare."
+    ),
+    real_broker: bool = typer.Option(
+        False,
+        help="Send the tasks to the configured broker, rather than a stub; the queue is flushed afterwards.",
+    ),
+):
+    """Benchmark the framework's hot paths against the configured app"""
+    from pathlib import Path
+
+    from . import bench as benchmarks
+
+    report = benchmarks.run_benchmarks(
+        requests=requests, scenarios=scenario, real_broker=real_broker
+    )
+    typer.echo(
+        f"{'scenario':<16} {'ops/s':>12} {'mean':>10} {'p50':>10} {'p90':>10} {'p99':>10}"
+    )
+    for result in report.results:
+        typer.echo(
+            f"{result.name:<16} {result.ops_per_second:>12,.0f} {result.mean_us:>8.1f}us "
+            f"{result.p50_us:>8.1f}us {result.p90_us:>8.1f}us {result.p99_us:>8.1f}us"
+        )
+    if output:
+        Path(output).write_text(report.json(indent=2))
+        typer.echo(f"Wrote the results to {output}")
+
+    if compare:
+        baseline = benchmarks.Report.parse_file(compare)
+        typer.echo(
+            f"\nCompared with {compare} (commit {baseline.environment.get('commit')}):"
+        )
+        regressions = []
+        for name, before, after, change in benchmarks.compare(report, baseline):
+            typer.echo(
+                f"{name:<16} {before:>12,.0f} -> {after:>12,.0f} ops/s  {change:+.1f}%"
+            )
+            if max_regression is not None and -change > max_regression:
+                regressions.append(name)
+        if regressions:
+            typer.echo(
+                f"More than {max_regression}% slower: {', '.join(regressions)}",
+                err=True,
+            )
+            raise typer.Exit(1)
+
+
 @cli.command()
 def checktypes():
     from mypy import api
@@ -160,10 +371,31 @@ def cmd_format(args: List[str]):
         raise typer.Exit(ret)
 
 
-@cli.command()
-def test():
-    # Run pytest
-    pass
+@cli.command(
+    context_settings={"allow_extra_args": True, "ignore_unknown_options": True}
+)
+def test(
+    ctx: typer.Context,
+    workers: Optional[int] = typer.Option(
+        settings.TEST_WORKERS,
+        help="Number of test processes (needs pytest-xdist). Defaults to the number of CPUs.",
+    ),
+):
+    """Run the tests with pytest, in parallel, each process with its own database. Other options go to pytest."""
+    # pytest must load the plugin itself, before anything imports the app, so it runs in its own process
+    cmd = [sys.executable, "-m", "pytest", "-p", "opinionated.fastapi.testing"]
+    if workers != 1:
+        if importlib.util.find_spec("xdist") is None:
+            typer.echo(
+                "pytest-xdist is not installed, running the tests in one process.",
+                err=True,
+            )
+        else:
+            cmd += ["-n", str(workers or "auto")]
+
+    ret = subprocess.call([*cmd, *ctx.args])
+    if ret != 0:
+        raise typer.Exit(ret)
 
 
 @cli.command()
@@ -217,7 +449,69 @@ def dbshell():
     pass
 
 
-@cli.command()
-def backups():
-    # Subcommand (backups create, backups list, backups restore, backups remove)
-    pass
+backups = typer.Typer(help="Back up and restore the database.")
+cli.add_typer(backups, name="backups")
+
+
+@backups.command("create")
+def backups_create(name: Optional[str] = typer.Option(None)):
+    """Back up the database, while the application keeps running"""
+    from .backups import create_backup
+
+    manifest = create_backup(name)
+    typer.echo(
+        f"Created backup {manifest.name}: {len(manifest.files)} files, "
+        f"{manifest.bytes // 1024}K in {manifest.seconds}s"
+    )
+
+
+@backups.command("list")
+def backups_list():
+    """List the backups, most recent first"""
+    from .backups import list_backups
+
+    found = list_backups()
+    if not found:
+        typer.echo(f"No backups in {settings.BACKUPS_DIR}")
+        return
+    for manifest in found:
+        typer.echo(
+            f"{manifest.created:%Y-%m-%d %H:%M:%S}  {manifest.bytes // 1024:>8}K  "
+            f"{manifest.dialect:<10}  {manifest.name}"
+        )
+
+
+@backups.command("restore")
+def backups_restore(
+    name: str,
+    yes: bool = typer.Option(False, "--yes", help="Don't ask for confirmation."),
+):
+    """
+    Replace everything in the database with a backup. Unlike creating one, restoring isn't parallel: it runs in a
+    single transaction, so a failed restore leaves the database as it was. On PostgreSQL that loads the tables one
+    after another, and then the indexes and foreign keys are rebuilt in parallel.
+    """
+    from .backups import restore_backup
+
+    if not yes:
+        typer.confirm(
+            f"This replaces all the data in the database with backup {name}. Continue?",
+            abort=True,
+        )
+    start = time.monotonic()
+    manifest = restore_backup(name)
+    typer.echo(f"Restored backup {manifest.name} in {time.monotonic() - start:.1f}s")
+
+
+@backups.command("remove")
+def backups_remove(
+    name: str,
+    yes: bool = typer.Option(False, "--yes", help="Don't ask for confirmation."),
+):
+    """Remove a backup"""
+    from .backups import remove_backup
+
+    if not yes:
+        typer.confirm(f"Remove backup {name}?", abort=True)
+    remove_backup(name)
+    typer.echo(f"Removed backup {name}.")
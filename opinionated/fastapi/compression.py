@@ -0,0 +1,292 @@
+"""
+compression
+
+ASGI middleware that compresses responses with brotli, zstd or gzip, depending on what the client accepts and what
+is enabled in the settings. Streaming responses are compressed chunk by chunk as they are sent. Responses that are
+already encoded, too small, or of a content type not in the allowlist are passed through untouched. A strong ETag
+on a compressed response is made weak, as the bytes sent are no longer the ones it was for.
+"""
+import logging
+import zlib
+from typing import Callable, Dict, List, Optional, Protocol, Sequence, Tuple
+
+from fastapi import FastAPI
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+
+class Compressor(Protocol):
+    def compress(self, data: bytes) -> bytes:
+        ...
+
+    def flush(self) -> bytes:
+        """Return everything compressed so far, so it can be sent as a chunk of a streaming response"""
+        ...
+
+    def finish(self) -> bytes:
+        ...
+
+
+class GzipCompressor:
+    def __init__(self, level: int):
+        # wbits=31 gives us the gzip header and trailer
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._obj.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    def __init__(self, level: int):
+        import brotli
+
+        self._obj = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.process(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush()
+
+    def finish(self) -> bytes:
+        return self._obj.finish()
+
+
+class ZstdCompressor:
+    def __init__(self, level: int):
+        import zstandard
+
+        self._flush_block = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush(self._flush_block)
+
+    def finish(self) -> bytes:
+        return self._obj.flush()
+
+
+# Encoding: (compressor class, taking the level; the package it needs, if any)
+COMPRESSORS: Dict[str, Tuple[Callable[[int], Compressor], Optional[str]]] = {
+    "br": (BrotliCompressor, "brotli"),
+    "zstd": (ZstdCompressor, "zstandard"),
+    "gzip": (GzipCompressor, None),
+}
+
+
+def parse_accept_encoding(value: str) -> Dict[str, float]:
+    """
+    Parse an Accept-Encoding header into {encoding: q}. Encodings refused with q=0 are kept, since that overrides
+    a "*" for them.
+    """
+    accepted = {}
+    for item in value.split(","):
+        encoding, *params = (part.strip() for part in item.split(";"))
+        if not encoding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, param_value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = min(max(float(param_value.strip()), 0.0), 1.0)
+                except ValueError:
+                    q = 0.0
+        accepted[encoding.lower()] = q
+    return accepted
+
+
+def accepted_quality(accepted: Dict[str, float], encoding: str) -> float:
+    """How much the client wants this encoding (0 if not at all), given its parsed Accept-Encoding"""
+    return accepted.get(encoding, accepted.get("*", 0.0))
+
+
+def select_encodings(accept_encoding: str, encodings: Sequence[str]) -> List[str]:
+    """The encodings the client accepts, best first, breaking ties with our order of preference"""
+    accepted = parse_accept_encoding(accept_encoding)
+    qualities = {
+        encoding: accepted_quality(accepted, encoding) for encoding in encodings
+    }
+    # sorted() is stable, so equal qualities stay in our order
+    return sorted(
+        (encoding for encoding in encodings if qualities[encoding] > 0),
+        key=lambda encoding: -qualities[encoding],
+    )
+
+
+def select_encoding(accept_encoding: str, encodings: Sequence[str]) -> Optional[str]:
+    """Pick the encoding the client likes best, breaking ties with our order of preference"""
+    selected = select_encodings(accept_encoding, encodings)
+    return selected[0] if selected else None
+
+
+class CompressionMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        encodings: Sequence[str] = ("gzip",),
+        minimum_size: int = 1000,
+        content_types: Sequence[str] = ("application/json", "text/"),
+        levels: Optional[Dict[str, int]] = None,
+    ) -> None:
+        self.app = app
+        self.encodings = list(encodings)
+        self.minimum_size = minimum_size
+        self.content_types = tuple(content_types)
+        self.levels = {"br": 4, "zstd": 3, "gzip": 6, **(levels or {})}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            encoding = select_encoding(
+                Headers(scope=scope).get("accept-encoding", ""), self.encodings
+            )
+            if encoding is not None:
+                responder = CompressionResponder(self, encoding)
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+class CompressionResponder:
+    def __init__(self, middleware: CompressionMiddleware, encoding: str) -> None:
+        self.middleware = middleware
+        self.encoding = encoding
+        self.send: Send = unattached_send
+        self.initial_message: Message = {}
+        self.started = False
+        self.compressor: Optional[Compressor] = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.middleware.app(scope, receive, self.send_compressed)
+
+    def should_compress(self, headers: MutableHeaders, body: bytes, more_body: bool):
+        if "content-encoding" in headers:
+            return False
+        content_type = headers.get("content-type", "")
+        if not content_type.startswith(self.middleware.content_types):
+            return False
+        # We can't know the size of a streaming response, so those always get compressed
+        return more_body or len(body) >= self.middleware.minimum_size
+
+    async def send_compressed(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            # Don't send the initial message until we've seen the first chunk of the body, so we know whether to
+            #  compress it.
+            self.initial_message = message
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if not self.started:
+            self.started = True
+            headers = MutableHeaders(raw=self.initial_message["headers"])
+            if not self.should_compress(headers, body, more_body):
+                await self.send(self.initial_message)
+                await self.send(message)
+                return
+
+            compressor_cls, _ = COMPRESSORS[self.encoding]
+            compressor = compressor_cls(self.middleware.levels[self.encoding])
+            self.compressor = compressor
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag is not None and not etag.startswith("W/"):
+                # A strong ETag promises the exact bytes, which differ with each encoding (and level)
+                headers["ETag"] = f"W/{etag}"
+            if more_body:
+                del headers["Content-Length"]
+                body = compressor.compress(body) + compressor.flush()
+            else:
+                body = compressor.compress(body) + compressor.finish()
+                headers["Content-Length"] = str(len(body))
+            await self.send(self.initial_message)
+            await self.send(
+                {"type": "http.response.body", "body": body, "more_body": more_body}
+            )
+            return
+
+        if self.compressor is None:
+            # We decided not to compress this one
+            await self.send(message)
+            return
+
+        if more_body:
+            body = self.compressor.compress(body) + self.compressor.flush()
+        else:
+            body = self.compressor.compress(body) + self.compressor.finish()
+        await self.send(
+            {"type": "http.response.body", "body": body, "more_body": more_body}
+        )
+
+
+async def unattached_send(message: Message) -> None:
+    raise RuntimeError("send awaitable not set")  # pragma: no cover
+
+
+def available_encodings(encodings: List[str]) -> List[str]:
+    """Filter out any encodings we don't support, or whose library isn't installed"""
+    import importlib.util
+
+    res = []
+    for encoding in encodings:
+        if encoding not in COMPRESSORS:
+            logger.warning("Unknown compression encoding '%s', ignoring", encoding)
+            continue
+        module = COMPRESSORS[encoding][1]
+        if module is not None and importlib.util.find_spec(module) is None:
+            logger.warning(
+                "Compression encoding '%s' needs the '%s' package, which is not installed",
+                encoding,
+                module,
+            )
+            continue
+        res.append(encoding)
+    return res
+
+
+def setup_compression_middleware(app: FastAPI) -> FastAPI:
+    """Add response compression middleware to FastAPI application"""
+
+    from .config import settings
+
+    encodings = available_encodings(settings.COMPRESSION_ENCODINGS)
+    if encodings:
+        logger.debug("Loading compression middleware for %s", ", ".join(encodings))
+        app.add_middleware(
+            CompressionMiddleware,
+            encodings=encodings,
+            minimum_size=settings.COMPRESSION_MINIMUM_SIZE,
+            content_types=settings.COMPRESSION_CONTENT_TYPES,
+            levels=settings.COMPRESSION_LEVELS,
+        )
+
+    if settings.STATIC_DIR is not None:
+        # Import locally; starlette's StaticFiles needs aiofiles installed
+        from .staticfiles import PrecompressedStaticFiles
+
+        app.mount(
+            settings.STATIC_URL,
+            PrecompressedStaticFiles(
+                directory=settings.STATIC_DIR, encodings=settings.STATIC_ENCODINGS
+            ),
+            name="static",
+        )
+
+    return app
@@ -2,12 +2,23 @@
 config
 
 Utilities for managing FastAPI settings module(s)
+
+init_config() resolves the settings once, into a read-only snapshot: an instance of a subclass of the settings class,
+so its methods, properties, class attributes and isinstance() all work as before. Until setup() has finished,
+'settings' is a proxy for it. Then bind_settings() gives the modules that have registered for it (the framework's own,
+and those setup() loads from the settings) the snapshot itself, so reading a setting there is a plain attribute
+lookup. Everything else keeps the proxy, which is slower, but always has the current settings.
+
+Use reload_settings() or override_settings() to change the settings, e.g. in tests, rather than assigning to them.
+The snapshot can't be assigned to, but the values in it are the settings' own: don't change lists or dicts in place.
 """
 
 import importlib
 import logging
 import os
-from typing import Any, Optional, Type, cast
+import sys
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Set, Type, cast
 
 from .default_settings import DefaultSettings
 
@@ -18,6 +29,46 @@ class NotReadyError(Exception):
     pass
 
 
+class SettingsSnapshot:
+    """Mixed into the settings class to make a snapshot of it: read-only, and with no validation to build"""
+
+    def __delattr__(self, *args) -> None:
+        raise RuntimeError("FastAPI settings object is read-only")
+
+    def __setattr__(self, *args) -> None:
+        raise RuntimeError("FastAPI settings object is read-only")
+
+    def __reduce__(self) -> Any:
+        # The snapshot class is made on the fly, so pickle the settings themselves, and make a snapshot of them again
+        values = cast(DefaultSettings, self)
+        settings_cls = settings_class(values)
+        return (
+            make_snapshot,
+            (settings_cls.construct(values.__fields_set__, **values.__dict__),),
+        )
+
+
+_snapshot_classes: Dict[Type[DefaultSettings], Type[DefaultSettings]] = {}
+
+
+def settings_class(snapshot: DefaultSettings) -> Type[DefaultSettings]:
+    """The settings class a snapshot was made from"""
+    return type(snapshot).__bases__[1]
+
+
+def make_snapshot(obj: DefaultSettings) -> DefaultSettings:
+    settings_cls = type(obj)
+    snapshot_cls = _snapshot_classes.get(settings_cls)
+    if snapshot_cls is None:
+        snapshot_cls = _snapshot_classes[settings_cls] = type(
+            f"{settings_cls.__name__}Snapshot",
+            (SettingsSnapshot, settings_cls),
+            {"__module__": settings_cls.__module__},
+        )
+    # Copy the validated values, rather than validating them all over again
+    return snapshot_cls.construct(obj.__fields_set__, **obj.__dict__)
+
+
 class SettingsProxy(object):
     """
     When you do 'from config import settings', we need to either have already initialized the value in this module,
@@ -114,6 +165,102 @@ def init_config() -> None:
         )
 
     logger.debug("Setting up new settings class '%r' as SettingsProxy.", settings_cls)
-    # fixme think about whether we set settings up as a injectable dependency as well ?
     # Instantiate the settings object
-    settings_proxy.set_proxy_object(settings_cls())
+    settings_proxy.set_proxy_object(make_snapshot(settings_cls()))
+
+
+def current_snapshot() -> DefaultSettings:
+    snapshot = object.__getattribute__(settings_proxy, "_proxy_obj")
+    if snapshot is None:
+        raise NotReadyError(
+            "The settings object has not been initialized yet, "
+            "did you try to access it before running bootstrap.setup()?"
+        )
+    return snapshot
+
+
+def get_settings() -> DefaultSettings:
+    """
+    FastAPI dependency for the settings. FastAPI caches it for the rest of the request, so everything in a request
+    sees the same settings, even if they are reloaded meanwhile. Tests can replace it with app.dependency_overrides.
+    """
+    return current_snapshot()
+
+
+# The modules, and packages (with all of their modules), whose 'settings' is bound to the snapshot
+_settings_modules: Set[str] = {"opinionated.fastapi"}
+_bound = False
+
+
+def is_registered(module_name: str) -> bool:
+    return any(
+        module_name == name or module_name.startswith(f"{name}.")
+        for name in _settings_modules
+    )
+
+
+def rebind(snapshot: DefaultSettings) -> None:
+    """Point 'settings' in each registered module at the snapshot, if it's the proxy or an earlier snapshot"""
+    for module_name, module in list(sys.modules.items()):
+        # This module's own 'settings' stays the proxy, for everything that imports it later
+        if module_name == __name__ or not is_registered(module_name):
+            continue
+        namespace = getattr(module, "__dict__", None)
+        if namespace is None:
+            continue
+        value = namespace.get("settings")
+        if value is settings_proxy or isinstance(value, SettingsSnapshot):
+            namespace["settings"] = snapshot
+
+
+def register_settings_module(name: str) -> None:
+    """
+    Give the module (or the package, and every module in it) the settings snapshot as its 'settings', rather than the
+    proxy, from the end of setup() on. setup() registers the modules it loads from the settings (APPS, MODELS, TASKS
+    and so on); register any others that read the settings in hot paths. Modules that keep a 'settings' of their own
+    some other way, e.g. in a closure or a default argument, won't see the settings change.
+    """
+    _settings_modules.add(name)
+    if _bound:
+        rebind(current_snapshot())
+
+
+def bind_settings() -> None:
+    """Called at the end of setup(): give the registered modules the snapshot, rather than the proxy"""
+    global _bound
+
+    rebind(current_snapshot())
+    _bound = True
+
+
+def install_snapshot(snapshot: DefaultSettings) -> None:
+    settings_proxy.set_proxy_object(snapshot)
+    if _bound:
+        rebind(snapshot)
+
+
+def reload_settings() -> DefaultSettings:
+    """
+    Read the settings again, from the environment as it is now. Anything already set up from the old settings (the
+    database engine, the broker) stays as it is.
+    """
+    install_snapshot(make_snapshot(settings_class(current_snapshot())()))
+    return get_settings()
+
+
+@contextmanager
+def override_settings(**values: Any) -> Iterator[DefaultSettings]:
+    """
+    Change some settings (validated as usual) until the block exits, e.g. in a test. As with reload_settings(),
+    this only affects code that reads them afterwards.
+
+        with override_settings(HEALTH_CACHE_SECONDS=0):
+            ...
+    """
+    previous = current_snapshot()
+    settings_cls = settings_class(previous)
+    install_snapshot(make_snapshot(settings_cls(**{**previous.dict(), **values})))
+    try:
+        yield get_settings()
+    finally:
+        install_snapshot(previous)
@@ -1,11 +1,14 @@
 import importlib
 import logging
-from typing import Any
+import time
+from typing import Any, Callable, List
 
 from sqlalchemy import create_engine
-from sqlalchemy.engine import Engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import DeclarativeMeta
+from sqlalchemy.future import Engine
 from sqlalchemy.orm import declared_attr, registry, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from opinionated.fastapi.config import settings
 
@@ -19,13 +22,61 @@ if settings.DATABASE_URL.startswith("sqlite://"):
     # Special setting for sqlite only
     args["check_same_thread"] = False
 
+
+class TimedQueuePool(QueuePool):
+    """
+    A QueuePool that tells its wait observers how long each checkout took, including any wait for a connection to
+    be returned when the pool is exhausted. SQLAlchemy has no event for before a checkout, so this is the only way
+    to see that wait. The observers carry over when the pool is recreated, e.g. after a fork.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.wait_observers: List[Callable[[float], None]] = []
+
+    # _do_get() is private, so it isn't in SQLAlchemy's type stubs
+    def _do_get(self) -> Any:
+        if not self.wait_observers:
+            return super()._do_get()  # type: ignore[misc]
+        start = time.perf_counter()
+        try:
+            return super()._do_get()  # type: ignore[misc]
+        finally:
+            elapsed = time.perf_counter() - start
+            for observer in self.wait_observers:
+                observer(elapsed)
+
+    def recreate(self) -> "TimedQueuePool":
+        pool = super().recreate()
+        pool.wait_observers = self.wait_observers
+        return pool
+
+
+pool_args: dict = {}
+database_url = make_url(settings.DATABASE_URL)
+dialect_cls: Any = database_url.get_dialect()
+if dialect_cls.get_pool_class(database_url) is QueuePool:
+    # Same pool as the default, but checkout waits can be measured (see metrics.py)
+    pool_args["poolclass"] = TimedQueuePool
+
 engine: Engine = create_engine(
     settings.DATABASE_URL,
     future=True,
     connect_args=args,
+    **pool_args,
 )
 Session: sessionmaker = sessionmaker(bind=engine, autoflush=False, future=True)
 
+
+def reset_engine_after_fork() -> None:
+    """
+    Give a forked process a fresh connection pool. Any connections inherited from the parent still belong to the
+    parent, so we drop our references to them without closing them.
+    """
+    # close= is newer (SQLAlchemy 1.4.33) than the type stubs
+    engine.dispose(close=False)  # type: ignore[call-arg]
+
+
 Registry = registry()
 
 
@@ -1,6 +1,8 @@
+import os
+import tempfile
 from typing import Any, Dict, List, Literal, Optional, TypedDict
 
-from pydantic import AnyUrl, BaseSettings, HttpUrl, validator
+from pydantic import AnyUrl, BaseSettings, HttpUrl, SecretStr, validator
 
 DEFAULT_LOGGING: Dict[str, Any] = {
     "version": 1,
@@ -25,7 +27,7 @@ DEFAULT_LOGGING: Dict[str, Any] = {
             "level": "WARN",
         },
         "opinionated": {
-            "level": "DEBUG",
+            "level": "INFO",
             "propagate": True,
         },
     },
@@ -33,7 +35,7 @@ DEFAULT_LOGGING: Dict[str, Any] = {
         "handlers": [
             "console",
         ],
-        "level": "DEBUG",
+        "level": "INFO",
     },
 }
 
@@ -52,6 +54,41 @@ class DefaultSettings(BaseSettings):
     SERVER_HOST = "127.0.0.1"
     SERVER_PORT = 5000
 
+    # Production server (runserver) options, passed on to gunicorn. Addresses to bind to are HOST:PORT or
+    #  unix:PATH; if none are given, bind to SERVER_HOST:SERVER_PORT.
+    SERVER_BIND: List[str] = []
+    # Number of worker processes; defaults to the number of CPUs available.
+    SERVER_WORKERS: Optional[int] = None
+    # Load the app in the master process before forking, so the workers share its memory and start faster. Off by
+    #  default, as the master then runs the whole setup: the database pool and the log listener thread are set up
+    #  again in each worker, but anything else the app opens at import time would be shared between them.
+    SERVER_PRELOAD_APP = False
+    # Restart each worker after this many requests (0 to disable), plus up to the jitter so they don't all restart
+    #  at once.
+    SERVER_MAX_REQUESTS = 10000
+    SERVER_MAX_REQUESTS_JITTER = 1000
+    SERVER_KEEPALIVE = 5
+    SERVER_BACKLOG = 2048
+    SERVER_TIMEOUT = 30
+    # Answer with a 503 once a worker has this many connections and tasks in progress (no limit if None). Note that
+    #  idle keep-alive connections count towards it.
+    SERVER_LIMIT_CONCURRENCY: Optional[int] = None
+    # Event loop and HTTP parser for the uvicorn workers; uvloop and httptools are faster, but must be installed.
+    SERVER_LOOP: Literal["auto", "asyncio", "uvloop"] = "auto"
+    SERVER_HTTP: Literal["auto", "h11", "httptools"] = "auto"
+
+    # Warm up each web worker on startup, before it starts accepting requests
+    # - number of pooled database connections to open
+    WARMUP_DB_CONNECTIONS = 1
+    # - connect to the broker
+    WARMUP_BROKER = True
+    # - build the OpenAPI schema
+    WARMUP_OPENAPI = True
+    # - GET these paths (including BASE_URL_PREFIX) through the app; responses are discarded
+    WARMUP_ROUTES: List[str] = []
+    # - import these modules, for anything that is imported lazily
+    WARMUP_MODULES: List[str] = []
+
     # Show remote IP etc using Forwarded-for headers, etc (this means you trust the proxy server)
     SERVER_PROXY_HEADERS = False
 
@@ -68,17 +105,116 @@ class DefaultSettings(BaseSettings):
     SENTRY_RELEASE: Optional[str] = None
     SENTRY_SAMPLE_RATE = 1.0
     SENTRY_SEND_PII = False
-    SENTRY_TRACES_SAMPLE_RATE = 1.0
+    # Performance tracing, which is off unless SENTRY_TRACES_ENABLED is set (if it's left unset, setting
+    #  SENTRY_TRACES_SAMPLE_RATE turns tracing on, as it used to): the fraction of requests and tasks to trace (0.1 if
+    #  unset), unless overridden for a route template (e.g. {"/items/{item_id}": 0.5}) or actor name.
+    SENTRY_TRACES_ENABLED: Optional[bool] = None
+    SENTRY_TRACES_SAMPLE_RATE: Optional[float] = None
+    SENTRY_TRACES_ROUTE_RATES: Dict[str, float] = {}
+    SENTRY_TRACES_ACTOR_RATES: Dict[str, float] = {}
+    # Send transactions that weren't sampled anyway if they fail, or are slower than these thresholds. Their spans
+    #  weren't recorded, so they only have the overall timing.
+    SENTRY_TRACES_ON_ERROR = True
+    SENTRY_TRACES_SLOW_REQUEST_SECONDS: Optional[float] = 2.0
+    SENTRY_TRACES_SLOW_TASK_SECONDS: Optional[float] = 60.0
+    # Most transactions to send per second (no limit if None). This is per process, so the whole deployment may send
+    #  up to this times the number of web and worker processes. It also applies to requests whose caller already
+    #  sampled the trace, so when it's exceeded those traces will be missing our part.
+    SENTRY_TRACES_MAX_PER_SECOND: Optional[float] = None
+
+    # Sampling profiler for requests and tasks (requires pyinstrument). Profiles a fraction of them, and saves the
+    #  profile of any that take longer than the threshold to PROFILING_DIR, keeping the most recent PROFILING_MAX_FILES.
+    PROFILING_ENABLED = False
+    PROFILING_SAMPLE_RATE = 0.01
+    PROFILING_THRESHOLD_SECONDS = 1.0
+    # Seconds between samples
+    PROFILING_INTERVAL = 0.001
+    PROFILING_DIR = "./profiles"
+    PROFILING_FORMAT: Literal["speedscope", "html"] = "speedscope"
+    PROFILING_MAX_FILES = 100
+
+    # Database backups (fastapi-admin backups ...). PostgreSQL tables are dumped, and their indexes rebuilt after a
+    #  restore, BACKUPS_PARALLEL at a time, each on its own pooled connection (the data itself is restored in a single
+    #  transaction); SQLite is copied BACKUPS_SQLITE_PAGES pages at a time. PostgreSQL needs psycopg2.
+    BACKUPS_DIR = "./backups"
+    BACKUPS_PARALLEL = 4
+    BACKUPS_COMPRESSION: Literal["gzip", "zstd", "none"] = "gzip"
+    BACKUPS_COMPRESSION_LEVEL = 3
+    BACKUPS_SQLITE_PAGES = 1024
+
+    # Prometheus metrics for the web server (served at METRICS_PATH), workers and scheduler (served on their own
+    #  ports). Each role keeps its multiprocess metrics files in a subdirectory of METRICS_DIR, which must not be
+    #  shared with another application.
+    METRICS_ENABLED = False
+    METRICS_DIR = os.path.join(tempfile.gettempdir(), "opinionated-fastapi-metrics")
+    METRICS_PATH = "/metrics"
+    METRICS_HOST = "0.0.0.0"
+    METRICS_WORKER_PORT = 9191
+    METRICS_SCHEDULER_PORT = 9192
+
+    # Seconds allowed for a graceful shutdown. Web workers finish in-flight requests, dramatiq workers let running
+    #  tasks finish (interrupting and requeueing them at 80% of this), and the scheduler hands off its leadership.
+    #  Your process manager should wait at least this long before killing anything.
+    SHUTDOWN_TIMEOUT = 30
+
+    # Pools for blocking and CPU-heavy work in endpoints (see executors.py), started in each web worker. 0 disables a
+    #  pool; the process pool is off unless you set a number of processes. Once a pool has its queue size of work
+    #  waiting, requests that need it get a 503 with Retry-After.
+    EXECUTOR_THREADS = 16
+    EXECUTOR_THREAD_QUEUE_SIZE = 64
+    EXECUTOR_PROCESSES = 0
+    EXECUTOR_PROCESS_QUEUE_SIZE = 8
+    # How the pool processes are started; forking a worker with threads running can deadlock, so by default they're
+    #  forked from a fresh server process instead
+    EXECUTOR_START_METHOD: Literal["fork", "forkserver", "spawn"] = "forkserver"
+    EXECUTOR_RETRY_AFTER = 1
+
+    # Liveness and readiness endpoints (under BASE_URL_PREFIX). Readiness runs these checks, caching the result for
+    #  HEALTH_CACHE_SECONDS.
+    #  "scheduler" checks that some process holds the scheduler leadership.
+    HEALTH_ENABLED = True
+    HEALTH_LIVE_PATH = "/health/live"
+    HEALTH_READY_PATH = "/health/ready"
+    HEALTH_CHECKS: List[Literal["database", "broker", "scheduler"]] = [
+        "database",
+        "broker",
+    ]
+    HEALTH_CACHE_SECONDS = 5.0
 
     # Database URL - can be sqlite://, postgres://, postgis://, or mysql://
     DATABASE_URL = "sqlite:///./db.sqlite"
 
+    # Migrations commit one at a time, and on PostgreSQL give up (rather than stall traffic) when they wait longer than
+    #  MIGRATIONS_LOCK_TIMEOUT seconds for a lock, or run a statement longer than MIGRATIONS_STATEMENT_TIMEOUT seconds.
+    #  None disables a timeout. migrations.backfill() updates MIGRATIONS_BATCH_SIZE rows at a time, pausing between.
+    MIGRATIONS_TRANSACTION_PER_MIGRATION = True
+    MIGRATIONS_LOCK_TIMEOUT: Optional[float] = 5.0
+    MIGRATIONS_STATEMENT_TIMEOUT: Optional[float] = 60.0
+    MIGRATIONS_BATCH_SIZE = 10000
+    MIGRATIONS_BATCH_PAUSE = 0.1
+
+    # Cache the results of queries that ask for it with .execution_options(query_cache=True), see cache.py.
+    #  The memory backend is an LRU cache per process; if QUERY_CACHE_REDIS_URL is set, invalidations are broadcast
+    #  to the other processes through it. The redis backend stores the results themselves in redis.
+    QUERY_CACHE_ENABLED = False
+    QUERY_CACHE_BACKEND: Literal["memory", "redis"] = "memory"
+    QUERY_CACHE_REDIS_URL: Optional[str] = None
+    # Required for the redis backend: results are pickled, and signed with this key so that nobody who can write to
+    #  redis can get us to unpickle anything else. Use a long random string, the same in every process.
+    QUERY_CACHE_SECRET_KEY: Optional[SecretStr] = None
+    QUERY_CACHE_PREFIX = "querycache:"
+    # Default time to live in seconds, which also bounds how stale results can be after writes we don't see
+    QUERY_CACHE_TTL = 300.0
+    QUERY_CACHE_MAX_ENTRIES = 10000
+
     # Watch for changes and reload worker
     WORKER_RELOAD = True
     WORKER_PROCESSES = 2
     WORKER_QUEUES: List[str] = ["default"]
     WORKER_BROKER_TYPE: Literal["redis", "stub", "rabbitmq"] = "stub"
     WORKER_BROKER_URL: Optional[AnyUrl] = None
+    # With the stub broker, run each task as soon as it's sent, in the thread that sent it
+    WORKER_BROKER_INLINE = False
 
     @validator("WORKER_BROKER_URL")
     def url_must_be_set_for_non_stub(
@@ -92,7 +228,53 @@ class DefaultSettings(BaseSettings):
             )
         return v
 
+    # Run the scheduler inside the worker processes, instead of a separate runscheduler process. Either way, only
+    #  the process holding the leadership lease will actually schedule jobs.
+    WORKER_EMBED_SCHEDULER = False
+    # How long the scheduler leadership lease lasts before another process may take over from a dead leader
+    SCHEDULER_LEASE_SECONDS = 30
+    # Threads consuming the 'scheduler' wakeup queue on the leader
+    SCHEDULER_WAKEUP_THREADS = 1
+
+    # 'fastapi-admin test' runs pytest in TEST_WORKERS processes (one per CPU if None; needs pytest-xdist), each with
+    #  its own copy of a template database migrated with TEST_ALEMBIC_CONFIG (or created from the models, if that
+    #  doesn't exist). Tests use the stub broker, which runs tasks as soon as they're sent if TEST_INLINE_TASKS is set.
+    TEST_WORKERS: Optional[int] = None
+    TEST_ALEMBIC_CONFIG = "alembic.ini"
+    TEST_INLINE_TASKS = True
+
+    # JSON encoder for the default response class: the stdlib json module, or the faster orjson or ujson (which
+    #  must be installed separately)
+    JSON_RESPONSE_CLASS: Literal["json", "orjson", "ujson"] = "json"
+
+    # Response compression, in order of preference, e.g. ["br", "gzip"]; "br" and "zstd" need the brotli and zstandard
+    #  packages installed. Off by default, since it costs CPU in every worker and your proxy server may already do it.
+    COMPRESSION_ENCODINGS: List[str] = []
+    # Don't compress responses smaller than this many bytes
+    COMPRESSION_MINIMUM_SIZE = 1000
+    # Only compress content types starting with one of these
+    COMPRESSION_CONTENT_TYPES: List[str] = [
+        "application/json",
+        "application/javascript",
+        "application/xml",
+        "image/svg+xml",
+        "text/",
+    ]
+    # Compression level for each encoding, if you don't want the defaults
+    COMPRESSION_LEVELS: Dict[str, int] = {}
+
+    # Serve static files from this directory, if set. If there's a compressed copy of a file alongside it
+    #  (e.g. app.js.br or app.js.gz), that's served to clients that accept it. Requires aiofiles to be installed.
+    STATIC_DIR: Optional[str] = None
+    STATIC_URL = "/static"
+    # Compressed copies to look for, in order of preference; they're already compressed, so this doesn't depend on
+    #  COMPRESSION_ENCODINGS or on the compression libraries being installed
+    STATIC_ENCODINGS: List[str] = ["br", "zstd", "gzip"]
+
     BASE_URL_PREFIX: str = ""
+    # Serve the OpenAPI schema from this file, written by 'fastapi-admin buildopenapi'. If it's not set, or the file is
+    #  missing, the schema is generated in-process.
+    OPENAPI_SCHEMA_FILE: Optional[str] = None
     SERVER_TITLE: str = "FastAPI Server"
     DEBUG: bool = False
 
@@ -105,7 +287,20 @@ class DefaultSettings(BaseSettings):
     COMMANDS: List[str] = []
     CONTROLLERS: List[str] = []
 
+    # Merged (shallowly) over the logging configuration built from the settings below
     LOGGING: Dict[str, Any] = {}
+    LOG_LEVEL: Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"] = "INFO"
+    LOG_FORMAT: Literal["text", "json"] = "text"
+    # Format and write log records from a background thread, rather than in the thread that logged them. Records are
+    #  dropped if more than LOG_QUEUE_SIZE are waiting.
+    LOG_ASYNC = True
+    LOG_QUEUE_SIZE = 10000
+    # Keep only this fraction of records below WARNING from these loggers (and their children), e.g. {"myapp.db": 0.1}
+    LOG_SAMPLING: Dict[str, float] = {}
+    # Keep at most this many records per second below WARNING from these loggers (and their children)
+    LOG_RATE_LIMITS: Dict[str, float] = {}
+    # Header to take each request's correlation ID from (one is generated if it's missing), and return it in
+    LOG_REQUEST_ID_HEADER = "X-Request-ID"
 
     class Config:
         case_sensitive = True
@@ -0,0 +1,233 @@
+"""
+executors
+
+Pools for work that would otherwise stall the event loop, but has to finish within the request (so it can't go through
+the task broker): a thread pool for blocking calls, sized separately from Starlette's shared one, and a process pool
+for CPU-heavy work such as rendering PDFs or resizing images. Each web worker starts its own pools as it starts up,
+after gunicorn has forked it, and shuts them down when it stops.
+
+Endpoints get the pools as dependencies, and await the result:
+
+    @router.post("/thumbnail")
+    async def thumbnail(file: UploadFile, processes: Executor = Depends(process_pool)):
+        return Response(await processes.run(resize, await file.read(), 200), media_type="image/png")
+
+Functions run in the process pool must be importable (module-level), and their arguments and results picklable. As
+with any multiprocessing that doesn't fork, the script that started the server is imported again in each process, so
+it must use the 'if __name__ == "__main__"' idiom (gunicorn, uvicorn and fastapi-admin all do).
+Only so much work may wait for a free thread or process; once that's full, requests get a 503 straight away, rather
+than queueing up behind work that won't finish in time. If a pool process dies (e.g. killed for using too much
+memory), the whole pool breaks, failing the work it had; the pool is then replaced for the work that comes after.
+"""
+import asyncio
+import contextvars
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Executor as BaseExecutor
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Any, Callable, Optional, Set, TypeVar, cast
+
+from fastapi import FastAPI
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ExecutorFull(Exception):
+    """There's already as much work waiting for the pool as it will take"""
+
+    def __init__(self, name: str):
+        super().__init__(f"The {name} pool is full")
+        self.name = name
+
+
+class Executor:
+    """A pool, with a limit on how much work can be waiting for it"""
+
+    def __init__(
+        self, name: str, executor: BaseExecutor, workers: int, queue_size: int
+    ):
+        self.name = name
+        self.executor = executor
+        self.workers = workers
+        self.queue_size = queue_size
+        # Running and waiting work; released from whichever thread completes the future
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        # The work that hasn't finished yet, so it can be cancelled on shutdown
+        self.futures: Set[Future] = set()
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Run func(*args, **kwargs) in the pool, raising ExecutorFull if there's no room for it"""
+        if not self.slots.acquire(blocking=False):
+            raise ExecutorFull(self.name)
+        try:
+            future = self.submit(self.prepare(func), *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        self.futures.add(future)
+        future.add_done_callback(self.done)
+        # If the request is cancelled first, so is the work, unless it has already started
+        return await asyncio.wrap_future(future)
+
+    def submit(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> Future:
+        return self.executor.submit(func, *args, **kwargs)
+
+    def prepare(self, func: Callable[..., T]) -> Callable[..., T]:
+        return func
+
+    def done(self, future: Future) -> None:
+        self.futures.discard(future)
+        self.slots.release()
+
+    def shutdown(self) -> None:
+        """Wait for the running work to finish, and cancel the rest"""
+        # Rather than shutdown(cancel_futures=True), which needs Python 3.9. Work that has started can't be cancelled.
+        for future in list(self.futures):
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+
+class ThreadExecutor(Executor):
+    def __init__(self, threads: int, queue_size: int):
+        super().__init__(
+            "thread",
+            ThreadPoolExecutor(threads, thread_name_prefix="executor"),
+            threads,
+            queue_size,
+        )
+
+    def prepare(self, func: Callable[..., T]) -> Callable[..., T]:
+        # Keep the request's context (request ID, Sentry scope) for logging from the thread
+        return cast(Callable[..., T], partial(contextvars.copy_context().run, func))
+
+
+class ProcessExecutor(Executor):
+    def __init__(self, processes: int, queue_size: int, start_method: str):
+        self.start_method = start_method
+        super().__init__("process", self.create_pool(processes), processes, queue_size)
+
+    def create_pool(self, processes: int) -> ProcessPoolExecutor:
+        context = multiprocessing.get_context(self.start_method)
+        if self.start_method == "forkserver":
+            # Import the framework once in the fork server, rather than in every process forked from it
+            context.set_forkserver_preload([__name__, "opinionated.fastapi.bootstrap"])
+        return ProcessPoolExecutor(
+            processes, mp_context=context, initializer=init_process
+        )
+
+    def replace(self, broken: BaseExecutor) -> None:
+        """Replace the pool with a new one, unless that has already been done since it broke"""
+        if self.executor is broken:
+            logger.error(
+                "The process pool broke, a process must have died; replacing it"
+            )
+            self.executor = self.create_pool(self.workers)
+            broken.shutdown(wait=False)
+
+    def submit(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> Future:
+        executor = self.executor
+        try:
+            return executor.submit(func, *args, **kwargs)
+        except BrokenProcessPool:
+            # It broke while idle, so nothing was lost but the pool itself
+            self.replace(executor)
+            return self.executor.submit(func, *args, **kwargs)
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        executor = self.executor
+        try:
+            return await super().run(func, *args, **kwargs)
+        except BrokenProcessPool:
+            # This may well be the work that killed it, so don't try it again; but give the next requests a new pool
+            self.replace(executor)
+            raise
+
+
+def init_process() -> None:
+    """Runs in each pool process as it starts, so the functions it runs can use the settings, database and so on"""
+    from .bootstrap import setup
+
+    # Does nothing if we were forked from a process that already ran it, but then we need our own connections
+    setup()
+
+    # Only import this once setup() has loaded the settings the engine is created from
+    from .db import reset_engine_after_fork
+
+    reset_engine_after_fork()
+
+
+def noop() -> None:
+    pass
+
+
+threads: Optional[Executor] = None
+processes: Optional[Executor] = None
+
+
+async def thread_pool() -> Executor:
+    """FastAPI dependency: the thread pool (async, so FastAPI doesn't run it in a thread of its own)"""
+    if threads is None:
+        raise RuntimeError("The thread pool isn't running; is EXECUTOR_THREADS set?")
+    return threads
+
+
+async def process_pool() -> Executor:
+    """FastAPI dependency: the process pool"""
+    if processes is None:
+        raise RuntimeError("The process pool isn't running; is EXECUTOR_PROCESSES set?")
+    return processes
+
+
+async def start_executors() -> None:
+    global threads, processes
+    from .config import settings
+
+    if settings.EXECUTOR_THREADS and threads is None:
+        threads = ThreadExecutor(
+            settings.EXECUTOR_THREADS, settings.EXECUTOR_THREAD_QUEUE_SIZE
+        )
+    if settings.EXECUTOR_PROCESSES and processes is None:
+        processes = ProcessExecutor(
+            settings.EXECUTOR_PROCESSES,
+            settings.EXECUTOR_PROCESS_QUEUE_SIZE,
+            settings.EXECUTOR_START_METHOD,
+        )
+        # Start a process now (and with it the fork server), rather than during the first request that needs one
+        await processes.run(noop)
+        logger.debug("Started the process pool")
+
+
+async def shutdown_executors() -> None:
+    global threads, processes
+
+    for executor in (threads, processes):
+        if executor is not None:
+            # Don't block the event loop while the work finishes
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+    threads = processes = None
+
+
+async def executor_full(request: Request, exc: ExecutorFull) -> JSONResponse:
+    from .config import settings
+
+    logger.warning("Turned away a request: %s", exc)
+    return JSONResponse(
+        {"detail": "The server is too busy, try again shortly"},
+        status_code=503,
+        headers={"Retry-After": str(settings.EXECUTOR_RETRY_AFTER)},
+    )
+
+
+def setup_executors(app: FastAPI) -> FastAPI:
+    """Start the pools as each worker starts, and answer with a 503 when they're full"""
+    app.add_exception_handler(ExecutorFull, executor_full)
+    app.add_event_handler("startup", start_executors)
+    app.add_event_handler("shutdown", shutdown_executors)
+    return app
@@ -0,0 +1,115 @@
+"""
+health
+
+Liveness and readiness endpoints for load balancers and orchestrators. Liveness only shows the process is serving
+requests. Readiness checks the database, the broker and (optionally) that some process holds the scheduler
+leadership. The readiness result is cached for a short time, and concurrent probes share one run of the checks,
+so frequent probes don't each cost a database connection and a broker round trip.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+from fastapi import FastAPI
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+
+def check_database() -> None:
+    from sqlalchemy import text
+
+    from .db import engine
+
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+
+
+def check_broker() -> None:
+    from .tasks import ping_broker
+
+    ping_broker()
+
+
+def check_scheduler() -> None:
+    from .scheduler import current_leader
+
+    if current_leader() is None:
+        raise RuntimeError("No process holds the scheduler leadership")
+
+
+CHECKS: Dict[str, Callable[[], None]] = {
+    "database": check_database,
+    "broker": check_broker,
+    "scheduler": check_scheduler,
+}
+
+
+class HealthChecks:
+    def __init__(self, checks: Sequence[str], ttl: float):
+        self.checks = {name: CHECKS[name] for name in checks}
+        self.ttl = ttl
+        # Expired from the start, so never returned before the checks have run
+        self._result: Tuple[bool, Dict[str, Any]] = (False, {})
+        self._expires = 0.0
+        # Created on first use, so it belongs to the right event loop
+        self._lock: Optional[asyncio.Lock] = None
+
+    def run_checks(self) -> Tuple[bool, Dict[str, Any]]:
+        healthy = True
+        results: Dict[str, Any] = {}
+        for name, check in self.checks.items():
+            start = time.perf_counter()
+            try:
+                check()
+            except Exception as exc:
+                logger.warning("Health check %s failed: %r", name, exc)
+                healthy = False
+                results[name] = {"ok": False, "error": type(exc).__name__}
+            else:
+                results[name] = {"ok": True}
+            results[name]["ms"] = round((time.perf_counter() - start) * 1000, 1)
+        return healthy, results
+
+    async def run(self) -> Tuple[bool, Dict[str, Any]]:
+        if time.monotonic() < self._expires:
+            return self._result
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            # Someone else may have run them while we were waiting
+            if time.monotonic() >= self._expires:
+                self._result = await run_in_threadpool(self.run_checks)
+                self._expires = time.monotonic() + self.ttl
+        return self._result
+
+
+def setup_health_checks(app: FastAPI) -> FastAPI:
+    """Add the liveness and readiness endpoints to FastAPI application"""
+    from .config import settings
+
+    if not settings.HEALTH_ENABLED:
+        return app
+
+    health_checks = HealthChecks(settings.HEALTH_CHECKS, settings.HEALTH_CACHE_SECONDS)
+
+    async def live(request: Request) -> JSONResponse:
+        return JSONResponse({"status": "ok"})
+
+    async def ready(request: Request) -> JSONResponse:
+        healthy, results = await health_checks.run()
+        return JSONResponse(
+            {"status": "ok" if healthy else "fail", "checks": results},
+            status_code=200 if healthy else 503,
+            headers={"Cache-Control": "no-store"},
+        )
+
+    prefix = settings.BASE_URL_PREFIX
+    app.add_route(f"{prefix}{settings.HEALTH_LIVE_PATH}", live, include_in_schema=False)
+    app.add_route(
+        f"{prefix}{settings.HEALTH_READY_PATH}", ready, include_in_schema=False
+    )
+    return app
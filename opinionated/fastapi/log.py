@@ -0,0 +1,273 @@
+"""
+log
+
+Logging setup. By default, records are put on a queue by the logging call and formatted and written by a
+background thread (a QueueListener), so the hot path never blocks on I/O. On top of that:
+
+- a JSON formatter, for log aggregators
+- correlation IDs: every record gets the request_id of the web request and the task_id of the dramatiq message
+  it was logged from (and the request_id is passed on to any messages sent while handling that request)
+- per-logger sampling and rate limits for chatty loggers, applied to records below WARNING only
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.config
+import os
+import queue
+import random
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from dramatiq import Middleware
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .default_settings import DEFAULT_LOGGING, DefaultSettings
+from .utils import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+task_id: ContextVar[Optional[str]] = ContextVar("task_id", default=None)
+
+
+class ContextFilter(logging.Filter):
+    """Adds the current request_id and task_id to each record"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # setattr, as LogRecord doesn't declare these attributes
+        setattr(record, "request_id", request_id.get())
+        setattr(record, "task_id", task_id.get())
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the records from some loggers, and/or limits them to a number of records per second. Loggers
+    are matched by name prefix, so 'sqlalchemy' covers 'sqlalchemy.engine' too. Warnings and above always get through.
+    """
+
+    def __init__(self, sample_rates: Dict[str, float], rate_limits: Dict[str, float]):
+        super().__init__()
+        self.sample_rates = sample_rates
+        self.rate_limits = rate_limits
+        self._limiters = {
+            name: RateLimiter(limit) for name, limit in rate_limits.items()
+        }
+        self._matches: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+
+    @staticmethod
+    def _match(name: str, prefixes: Dict[str, float]) -> Optional[str]:
+        best = None
+        for prefix in prefixes:
+            if name == prefix or name.startswith(f"{prefix}."):
+                if best is None or len(prefix) > len(best):
+                    best = prefix
+        return best
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        matches = self._matches.get(record.name)
+        if matches is None:
+            matches = (
+                self._match(record.name, self.sample_rates),
+                self._match(record.name, self.rate_limits),
+            )
+            self._matches[record.name] = matches
+        sampled, limited = matches
+
+        if sampled is not None and random.random() >= self.sample_rates[sampled]:
+            return False
+        if limited is not None and not self._limiters[limited].allow():
+            return False
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data: Dict[str, Any] = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.processName,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key in ("request_id", "task_id"):
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            data["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(data, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    A QueueHandler that leaves the formatting to the listener thread, and drops records rather than blocking when the
+    queue is full.
+    """
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The listener is in the same process, so unlike the base class we don't need to make the record picklable;
+        #  just merge the args, in case they're mutated before the listener gets to them.
+        record.msg = record.getMessage()
+        record.args = ()
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            if self.dropped:
+                self.queue.put_nowait(
+                    logging.makeLogRecord(
+                        {
+                            "name": __name__,
+                            "levelno": logging.WARNING,
+                            "levelname": "WARNING",
+                            "msg": f"Dropped {self.dropped} log records, the log queue was full",
+                        }
+                    )
+                )
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_queue_handler: Optional[NonBlockingQueueHandler] = None
+_listener: Optional[QueueListener] = None
+# The handlers behind the queue and its size, while logging is asynchronous
+_listener_config: Optional[Tuple[List[logging.Handler], int]] = None
+_hooks_registered = False
+
+
+def _start_listener(handlers: List[logging.Handler], size: int) -> None:
+    global _listener
+
+    log_queue: queue.Queue = queue.Queue(maxsize=size)
+    if _queue_handler is not None:
+        _queue_handler.queue = log_queue
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_listener_in_child() -> None:
+    # The listener thread doesn't survive a fork (e.g. gunicorn with preload_app), so start a new one in the child
+    if _listener_config is not None:
+        _start_listener(*_listener_config)
+
+
+def stop_logging() -> None:
+    """Flush any queued records and stop the listener thread"""
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def build_logging_config(settings: DefaultSettings) -> Dict[str, Any]:
+    config = copy.deepcopy(DEFAULT_LOGGING)
+    config["root"]["level"] = settings.LOG_LEVEL
+    config["loggers"]["opinionated"]["level"] = settings.LOG_LEVEL
+    config["formatters"]["json"] = {"()": "opinionated.fastapi.log.JSONFormatter"}
+    if settings.LOG_FORMAT == "json":
+        config["handlers"]["console"]["formatter"] = "json"
+    return {**config, **settings.LOGGING}
+
+
+def init_logging() -> None:
+    """Configure logging from the settings. It can be called again, e.g. after the settings change."""
+    global _queue_handler, _listener_config, _hooks_registered
+
+    from .config import settings
+
+    # Flush the previous listener, if any, before dictConfig closes the handlers it writes to
+    stop_logging()
+    _listener_config = None
+    logging.config.dictConfig(build_logging_config(settings))
+
+    filters = [
+        ContextFilter(),
+        SamplingFilter(settings.LOG_SAMPLING, settings.LOG_RATE_LIMITS),
+    ]
+    root = logging.getLogger()
+    if not settings.LOG_ASYNC:
+        for handler in root.handlers:
+            for log_filter in filters:
+                handler.addFilter(log_filter)
+        return
+
+    # Move the root handlers behind a queue. The filters go on the queue handler, so they run in the thread that
+    #  logged the record (where the context variables are).
+    handlers = root.handlers[:]
+    for handler in handlers:
+        root.removeHandler(handler)
+    _queue_handler = NonBlockingQueueHandler(queue.Queue())
+    for log_filter in filters:
+        _queue_handler.addFilter(log_filter)
+    root.addHandler(_queue_handler)
+    _listener_config = (handlers, settings.LOG_QUEUE_SIZE)
+    _start_listener(*_listener_config)
+
+    if not _hooks_registered:
+        _hooks_registered = True
+        atexit.register(stop_logging)
+        # Windows has no fork, or register_at_fork
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=_restart_listener_in_child)
+
+
+class RequestIDMiddleware:
+    """Sets request_id for each request from the request header (or a new one), and returns it in the response"""
+
+    def __init__(self, app: ASGIApp, header: str = "X-Request-ID") -> None:
+        self.app = app
+        self.header = header
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        value = Headers(scope=scope).get(self.header) or uuid4().hex
+
+        async def send_with_request_id(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message)[self.header] = value
+            await send(message)
+
+        token = request_id.set(value)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id.reset(token)
+
+
+class CorrelationIDs(Middleware):
+    """Dramatiq middleware that sets task_id while processing a message, and passes request_id along with it"""
+
+    def before_enqueue(self, broker, message, delay):
+        value = request_id.get()
+        if value is not None:
+            message.options.setdefault("request_id", value)
+
+    def before_process_message(self, broker, message):
+        task_id.set(message.message_id)
+        request_id.set(message.options.get("request_id"))
+
+    def after_process_message(self, broker, message, *, result=None, exception=None):
+        task_id.set(None)
+        request_id.set(None)
+
+    after_skip_message = after_process_message
@@ -0,0 +1,402 @@
+"""
+metrics
+
+Prometheus metrics for the web server, workers and scheduler, configured from the settings:
+
+- HTTP request counts and latency per route template, and requests in progress
+- database pool checkouts, connections in use, time spent waiting for a connection, and time spent opening new
+  connections
+- dramatiq message counts, errors, retries, rejections, durations and messages in progress
+- whether this process holds the scheduler leadership
+
+Each of them runs several processes, so prometheus_client is used in multiprocess mode, with a directory per
+role under METRICS_DIR. The web server serves the metrics at METRICS_PATH; workers and the scheduler run a small
+HTTP server on their own port.
+
+prometheus_client picks multiprocess mode when it is first imported, so it must only be imported (here or
+anywhere else) after init_metrics() has been called.
+"""
+import glob
+import logging
+import multiprocessing.util
+import os
+import shutil
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Any, List, Optional
+
+from dramatiq import Middleware
+from fastapi import FastAPI
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Router
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .utils import RouteTemplates
+
+logger = logging.getLogger(__name__)
+
+
+def metrics_dir(role: str) -> str:
+    from .config import settings
+
+    return os.path.join(settings.METRICS_DIR, role)
+
+
+def clear_metrics_dir(role: str) -> None:
+    """Remove the files left over from previous runs; call before starting the processes for a role"""
+    from .config import settings
+
+    if settings.METRICS_ENABLED:
+        shutil.rmtree(metrics_dir(role), ignore_errors=True)
+
+
+class FrameworkMetrics:
+    def __init__(self, role: str):
+        import prometheus_client as prom
+
+        self.role = role
+        # Register with our own registry; in multiprocess mode they're collected from the files instead
+        registry = prom.CollectorRegistry()
+
+        self.http_requests = prom.Counter(
+            "http_requests_total",
+            "The total number of HTTP requests.",
+            ["method", "route", "status"],
+            registry=registry,
+        )
+        self.http_request_duration = prom.Histogram(
+            "http_request_duration_seconds",
+            "The time spent handling HTTP requests.",
+            ["method", "route"],
+            registry=registry,
+        )
+        self.http_requests_in_progress = prom.Gauge(
+            "http_requests_in_progress",
+            "The number of HTTP requests in progress.",
+            registry=registry,
+            multiprocess_mode="livesum",
+        )
+
+        self.db_pool_checkouts = prom.Counter(
+            "db_pool_checkouts_total",
+            "The total number of connections checked out of the database pool.",
+            registry=registry,
+        )
+        self.db_pool_in_use = prom.Gauge(
+            "db_pool_connections_in_use",
+            "The number of database connections checked out of the pool.",
+            registry=registry,
+            multiprocess_mode="livesum",
+        )
+        self.db_pool_wait = prom.Histogram(
+            "db_pool_checkout_wait_seconds",
+            "The time spent waiting to check a connection out of the database pool.",
+            buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, 30),
+            registry=registry,
+        )
+        self.db_connect_duration = prom.Histogram(
+            "db_connect_duration_seconds",
+            "The time spent opening new database connections.",
+            buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, 30),
+            registry=registry,
+        )
+
+        # The same names as dramatiq's own Prometheus middleware, which this replaces
+        labels = ["queue_name", "actor_name"]
+        self.messages = prom.Counter(
+            "dramatiq_messages_total",
+            "The total number of messages processed.",
+            labels,
+            registry=registry,
+        )
+        self.message_errors = prom.Counter(
+            "dramatiq_message_errors_total",
+            "The total number of errored messages.",
+            labels,
+            registry=registry,
+        )
+        self.message_retries = prom.Counter(
+            "dramatiq_message_retries_total",
+            "The total number of retried messages.",
+            labels,
+            registry=registry,
+        )
+        self.message_rejects = prom.Counter(
+            "dramatiq_message_rejects_total",
+            "The total number of dead-lettered messages.",
+            labels,
+            registry=registry,
+        )
+        self.messages_in_progress = prom.Gauge(
+            "dramatiq_messages_inprogress",
+            "The number of messages in progress.",
+            labels,
+            registry=registry,
+            multiprocess_mode="livesum",
+        )
+        self.message_duration = prom.Histogram(
+            "dramatiq_message_duration_milliseconds",
+            "The time spent processing messages.",
+            labels,
+            buckets=(5, 10, 25, 50, 75, 100, 250, 500, 750, 1000, 2500, 5000, 7500)
+            + (10000, 30000, 60000, 600000, 900000, float("inf")),
+            registry=registry,
+        )
+
+        self.scheduler_leader = prom.Gauge(
+            "scheduler_leader",
+            "Whether this process holds the scheduler leadership.",
+            registry=registry,
+            multiprocess_mode="liveall",
+        )
+
+
+metrics: Optional[FrameworkMetrics] = None
+
+
+def init_metrics(role: str) -> Optional[FrameworkMetrics]:
+    """Set up metrics for this process, if enabled. The first call decides the role."""
+    global metrics
+
+    from .config import settings
+
+    if not settings.METRICS_ENABLED:
+        return None
+    if metrics is not None:
+        return metrics
+
+    directory = metrics_dir(role)
+    os.makedirs(directory, exist_ok=True)
+    if "prometheus_client" in sys.modules:
+        logger.warning(
+            "prometheus_client was imported before metrics were set up, "
+            "metrics will not be collected across processes correctly"
+        )
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = directory
+    # Older prometheus_client versions only look at the lower case name
+    os.environ["prometheus_multiproc_dir"] = directory
+
+    logger.debug("Setting up %s metrics in %s", role, directory)
+    metrics = FrameworkMetrics(role)
+
+    from .db import engine
+
+    instrument_engine(metrics, engine)
+    return metrics
+
+
+def instrument_engine(framework_metrics: FrameworkMetrics, engine: Any) -> None:
+    """
+    Record the engine's pool checkouts, how long they wait for a connection, and how long new connections take to
+    open. The wait is only known for a TimedQueuePool (the default for databases that pool connections); everything
+    else uses SQLAlchemy's events. Both carry over when the pool is recreated, e.g. after a fork.
+    """
+    from sqlalchemy import event
+
+    from .db import TimedQueuePool
+
+    if isinstance(engine.pool, TimedQueuePool):
+        engine.pool.wait_observers.append(framework_metrics.db_pool_wait.observe)
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        framework_metrics.db_pool_checkouts.inc()
+        framework_metrics.db_pool_in_use.inc()
+
+    def on_checkin(dbapi_connection, connection_record):
+        framework_metrics.db_pool_in_use.dec()
+
+    def before_connect(dialect, connection_record, cargs, cparams):
+        # Returns None, so the dialect (or any other listener) still makes the connection
+        connection_record.info["metrics_connect_start"] = time.perf_counter()
+
+    def on_connect(dbapi_connection, connection_record):
+        start = connection_record.info.pop("metrics_connect_start", None)
+        if start is not None:
+            framework_metrics.db_connect_duration.observe(time.perf_counter() - start)
+
+    event.listen(engine, "checkout", on_checkout)
+    event.listen(engine, "checkin", on_checkin)
+    event.listen(engine, "do_connect", before_connect)
+    event.listen(engine, "connect", on_connect)
+
+
+def mark_process_dead(pid: int, role: str) -> None:
+    """
+    Remove a dead process's live gauges. This deletes the files itself, rather than using prometheus_client, which
+    mustn't be imported in the gunicorn master before it forks the workers.
+    """
+    from .config import settings
+
+    if not settings.METRICS_ENABLED:
+        return
+    for path in glob.glob(os.path.join(metrics_dir(role), f"gauge_live*_{pid}.db")):
+        os.remove(path)
+
+
+def set_scheduler_leader(leader: bool) -> None:
+    if metrics is not None:
+        metrics.scheduler_leader.set(1 if leader else 0)
+
+
+def generate_metrics(role: str) -> bytes:
+    """Collect the metrics for all the processes in a role"""
+    from prometheus_client import CollectorRegistry, generate_latest, multiprocess
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=metrics_dir(role))
+    return generate_latest(registry)
+
+
+class MetricsMiddleware:
+    """ASGI middleware that records request counts and latencies, by route template"""
+
+    def __init__(
+        self, app: ASGIApp, router: Router, framework_metrics: FrameworkMetrics
+    ) -> None:
+        self.app = app
+        self.templates = RouteTemplates(router)
+        self.metrics = framework_metrics
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        self.metrics.http_requests_in_progress.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - start
+            self.metrics.http_requests_in_progress.dec()
+            # Don't label by raw path for unmatched requests, or anyone can blow up our cardinality
+            route = self.templates.for_scope(scope) or "<unmatched>"
+            method = scope["method"]
+            self.metrics.http_requests.labels(method, route, status_code).inc()
+            self.metrics.http_request_duration.labels(method, route).observe(duration)
+
+
+def setup_metrics(app: FastAPI) -> FastAPI:
+    """Add the metrics middleware and endpoint to FastAPI application, if metrics are enabled"""
+    from .config import settings
+
+    framework_metrics = init_metrics("web")
+    if framework_metrics is None:
+        return app
+
+    logger.debug("Loading metrics middleware")
+    app.add_middleware(
+        MetricsMiddleware, router=app.router, framework_metrics=framework_metrics
+    )
+
+    async def metrics_endpoint(request: Request) -> Response:
+        from prometheus_client import CONTENT_TYPE_LATEST
+
+        return Response(generate_metrics("web"), media_type=CONTENT_TYPE_LATEST)
+
+    app.add_route(settings.METRICS_PATH, metrics_endpoint, include_in_schema=False)
+    return app
+
+
+def run_metrics_server(role: str, port: int) -> HTTPServer:
+    """Serve the metrics for a role from a background thread"""
+    from threading import Thread
+
+    from prometheus_client import CONTENT_TYPE_LATEST
+
+    from .config import settings
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = generate_metrics(role)
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE_LATEST)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            logger.debug(fmt, *args)
+
+    httpd = HTTPServer((settings.METRICS_HOST, port), MetricsHandler)
+    Thread(target=httpd.serve_forever, name="MetricsServer", daemon=True).start()
+    logger.info("Serving %s metrics on port %d", role, port)
+    return httpd
+
+
+def run_worker_metrics_server() -> int:
+    """Dramatiq fork function, serving the metrics for all the worker processes"""
+    from .config import settings
+    from .tasks import setup_dramatiq
+
+    setup_dramatiq()
+    init_metrics("worker")
+    run_metrics_server("worker", settings.METRICS_WORKER_PORT)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+class TaskMetrics(Middleware):
+    """Dramatiq middleware recording message metrics, in place of dramatiq's own Prometheus middleware"""
+
+    def __init__(self):
+        self.message_start_times: dict = {}
+
+    @property
+    def forks(self):
+        return [run_worker_metrics_server]
+
+    def after_process_boot(self, broker):
+        if init_metrics("worker") is not None:
+            # Once the process exits; a worker shutting down doesn't mean the process is (the embedded scheduler
+            #  starts and stops its own). Runs at exit in multiprocessing's children, which skip atexit.
+            multiprocessing.util.Finalize(
+                None, mark_process_dead, args=(os.getpid(), "worker"), exitpriority=0
+            )
+
+    def _labels(self, message) -> List[Any]:
+        return [message.queue_name, message.actor_name]
+
+    def after_nack(self, broker, message):
+        if metrics is not None:
+            metrics.message_rejects.labels(*self._labels(message)).inc()
+
+    def after_enqueue(self, broker, message, delay):
+        if metrics is not None and "retries" in message.options:
+            metrics.message_retries.labels(*self._labels(message)).inc()
+
+    def before_process_message(self, broker, message):
+        if metrics is None:
+            return
+        metrics.messages_in_progress.labels(*self._labels(message)).inc()
+        self.message_start_times[message.message_id] = time.monotonic()
+
+    def after_process_message(self, broker, message, *, result=None, exception=None):
+        if metrics is None:
+            return
+        labels = self._labels(message)
+        start = self.message_start_times.pop(message.message_id, None)
+        if start is not None:
+            metrics.message_duration.labels(*labels).observe(
+                (time.monotonic() - start) * 1000
+            )
+        metrics.messages_in_progress.labels(*labels).dec()
+        metrics.messages.labels(*labels).inc()
+        if exception is not None:
+            metrics.message_errors.labels(*labels).inc()
+
+    after_skip_message = after_process_message
@@ -1,12 +1,229 @@
+"""
+migrations
+
+Alembic environment functions (called from our alembic/env.py), and helpers for migrations on large tables:
+
+- backfill() updates a table in batches by primary key, each in its own transaction, pausing between batches
+- create_index_concurrently() / drop_index_concurrently() build indexes without blocking writes (on PostgreSQL)
+- timeouts() changes the lock_timeout / statement_timeout guards for part of a migration
+
+Online migrations run in a transaction per migration, with lock_timeout and statement_timeout set from the settings on
+PostgreSQL, so a migration waiting on a busy table fails instead of queueing all the traffic behind it. After an
+upgrade, we log how long each migration took.
+"""
 import logging
 import os
+import time
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 
+import sqlalchemy as sa
 from alembic.script import write_hooks
 
 logger = logging.getLogger(__name__)
 
 
+def is_postgresql(bind: Any) -> bool:
+    return bind.dialect.name == "postgresql"
+
+
+def set_timeouts(
+    bind: Any, lock_timeout: Optional[float], statement_timeout: Optional[float]
+) -> None:
+    """Set the guards for this connection's session, in seconds (None or 0 means no limit). PostgreSQL only."""
+    if not is_postgresql(bind):
+        return
+    bind.exec_driver_sql(f"SET lock_timeout = {int((lock_timeout or 0) * 1000)}")
+    bind.exec_driver_sql(
+        f"SET statement_timeout = {int((statement_timeout or 0) * 1000)}"
+    )
+
+
+@contextmanager
+def timeouts(
+    lock_timeout: Optional[float] = None, statement_timeout: Optional[float] = None
+) -> Iterator[None]:
+    """
+    Use different timeouts for part of a migration, in seconds; 0 means no limit, and any not given keep their
+    setting. E.g. timeouts(statement_timeout=0) for a big data migration.
+    """
+    from alembic import op
+
+    from .config import settings
+
+    bind = op.get_bind()
+    set_timeouts(
+        bind,
+        settings.MIGRATIONS_LOCK_TIMEOUT if lock_timeout is None else lock_timeout,
+        settings.MIGRATIONS_STATEMENT_TIMEOUT
+        if statement_timeout is None
+        else statement_timeout,
+    )
+    try:
+        yield
+    finally:
+        set_timeouts(
+            bind,
+            settings.MIGRATIONS_LOCK_TIMEOUT,
+            settings.MIGRATIONS_STATEMENT_TIMEOUT,
+        )
+
+
+@contextmanager
+def autocommit_block() -> Iterator[Any]:
+    """alembic's autocommit_block, for statements that must (or should) commit as they go"""
+    from alembic import op
+
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        try:
+            yield bind
+        finally:
+            # Our future-style connection begins a transaction even in autocommit mode (it doesn't do anything in
+            #  the database), which has to be ended before alembic can change the isolation level back
+            if bind.in_transaction():
+                bind.commit()
+
+
+def backfill(
+    table_name: str,
+    values: Dict[str, Any],
+    where: Optional[str] = None,
+    key: str = "id",
+    batch_size: Optional[int] = None,
+    pause: Optional[float] = None,
+) -> int:
+    """
+    UPDATE table_name SET values [WHERE where], in batches of primary key ranges. Each batch commits on its own, so
+    row locks are only held briefly, and we pause between batches to leave the database some room for other traffic.
+    Values can be literals or SQL expressions (e.g. sa.text("lower(email)")). Returns the number of rows updated.
+
+    Because the batches commit as they go, the migration can't be rolled back; write it so it can safely be rerun.
+    """
+    from alembic import context, op
+
+    from .config import settings
+
+    batch_size = batch_size or settings.MIGRATIONS_BATCH_SIZE
+    pause = settings.MIGRATIONS_BATCH_PAUSE if pause is None else pause
+    table = sa.table(table_name, sa.column(key), *(sa.column(name) for name in values))
+    column = table.c[key]
+
+    if context.is_offline_mode():
+        # We can't look at the data, so just write out the whole update
+        stmt = table.update().values(**values)
+        op.execute(stmt.where(sa.text(where)) if where else stmt)
+        return 0
+
+    low, high = (
+        op.get_bind().execute(sa.select(sa.func.min(column), sa.func.max(column))).one()
+    )
+    if low is None:
+        return 0
+
+    updated = 0
+    start = time.monotonic()
+    with autocommit_block() as bind:
+        while low <= high:
+            stmt = (
+                table.update()
+                .where(column >= low, column < low + batch_size)
+                .values(**values)
+            )
+            if where:
+                stmt = stmt.where(sa.text(where))
+            updated += bind.execute(stmt).rowcount
+            low += batch_size
+            if low <= high:
+                logger.info(
+                    "Backfilling %s: %d rows updated, up to %s=%s of %s",
+                    table_name,
+                    updated,
+                    key,
+                    low,
+                    high,
+                )
+                time.sleep(pause)
+    logger.info(
+        "Backfilled %s: %d rows in %.1fs",
+        table_name,
+        updated,
+        time.monotonic() - start,
+    )
+    return updated
+
+
+def create_index_concurrently(
+    index_name: str, table_name: str, columns: Sequence[Any], **kwargs: Any
+) -> None:
+    """
+    Create an index without locking out writes to the table. On PostgreSQL this has to run outside of a
+    transaction, waits for transactions already using the table, and can take a long time, so there are no timeouts.
+    Elsewhere, it's a normal create_index.
+    """
+    from alembic import op
+
+    if not is_postgresql(op.get_bind()):
+        op.create_index(index_name, table_name, columns, **kwargs)
+        return
+    with autocommit_block(), timeouts(0, 0):
+        # A failed concurrent build leaves an invalid index behind, which would stop a rerun
+        op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {quote(index_name)}")
+        op.create_index(
+            index_name, table_name, columns, postgresql_concurrently=True, **kwargs
+        )
+
+
+def drop_index_concurrently(index_name: str, table_name: Optional[str] = None) -> None:
+    """Drop an index without locking out reads and writes to the table (on PostgreSQL)"""
+    from alembic import op
+
+    if not is_postgresql(op.get_bind()):
+        op.drop_index(index_name, table_name=table_name)
+        return
+    with autocommit_block(), timeouts(0, 0):
+        op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True)
+
+
+def quote(name: str) -> str:
+    from alembic import op
+
+    return op.get_bind().dialect.identifier_preparer.quote(name)
+
+
+class MigrationTimer:
+    """
+    Collects how long each migration took, via alembic's on_version_apply callback. Call before_migration() just
+    before running them, so the first one isn't charged with connecting and setting up.
+    """
+
+    def __init__(self) -> None:
+        self.last = time.monotonic()
+        self.steps: List[Tuple[str, str, float]] = []
+
+    def before_migration(self) -> None:
+        self.last = time.monotonic()
+
+    def on_version_apply(self, ctx: Any, step: Any, heads: Any, run_args: Any) -> None:
+        now = time.monotonic()
+        doc = step.up_revision.doc if step.up_revision is not None else ""
+        name = "%s -> %s" % (
+            ", ".join(step.source_revision_ids) or "<base>",
+            ", ".join(step.destination_revision_ids) or "<base>",
+        )
+        self.steps.append((name, doc or "", now - self.last))
+        self.last = now
+
+    def report(self) -> None:
+        if not self.steps:
+            return
+        logger.info("Migration timings:")
+        for name, doc, seconds in self.steps:
+            logger.info("  %8.2fs  %s  %s", seconds, name, doc)
+        logger.info("  %8.2fs  total", sum(seconds for _, _, seconds in self.steps))
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -45,6 +262,7 @@ def run_migrations_online():
     """
     from alembic import context
 
+    from .config import settings
     from .db import Registry, engine
 
     def process_revision_directives(context, revision, directives):
@@ -54,16 +272,33 @@ def run_migrations_online():
                 print("No changes to database, not creating any new migration")
                 directives[:] = []
 
+    timer = MigrationTimer()
+
     with engine.connect() as connection:
+        set_timeouts(
+            connection,
+            settings.MIGRATIONS_LOCK_TIMEOUT,
+            settings.MIGRATIONS_STATEMENT_TIMEOUT,
+        )
+        # The SETs began a transaction, and last for the session. If it were left open, alembic would run inside
+        #  it instead of starting (and committing) its own transactions, and closing the connection would roll it back.
+        if connection.in_transaction():
+            connection.commit()
         context.configure(
             connection=connection,
             target_metadata=Registry.metadata,
             process_revision_directives=process_revision_directives,
+            # Commit after each migration, so we don't hold every lock until the end
+            transaction_per_migration=settings.MIGRATIONS_TRANSACTION_PER_MIGRATION,
+            on_version_apply=timer.on_version_apply,
         )
 
         with context.begin_transaction():
+            timer.before_migration()
             context.run_migrations()
 
+    timer.report()
+
 
 def load_alembic():
     # Order matters - these must be run BEFORE setup()
@@ -0,0 +1,95 @@
+"""
+openapi
+
+Serves the OpenAPI schema as pre-serialized (and pre-compressed) bytes with an ETag, rather than re-encoding it on
+every request. The schema can be generated ahead of time with 'fastapi-admin buildopenapi' and loaded from a file,
+saving every worker from building it on startup; without the file it is built in-process as usual.
+"""
+import gzip
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from .compression import select_encoding
+
+logger = logging.getLogger(__name__)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header matches the ETag: it's "*", or a list of ETags compared weakly (ignoring W/)"""
+    if if_none_match.strip() == "*":
+        return True
+    weak = etag.removeprefix("W/")
+    return any(
+        tag.strip().removeprefix("W/") == weak for tag in if_none_match.split(",")
+    )
+
+
+def serialize_schema(schema: Dict[str, Any]) -> bytes:
+    # Same encoding as FastAPI's own openapi.json response
+    return json.dumps(
+        schema, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def compress_schema(body: bytes) -> bytes:
+    # mtime=0 so the output is reproducible
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+
+class OpenAPIDocument:
+    """The schema, its serialized and compressed bytes, and an ETag for them"""
+
+    def __init__(self, body: bytes, gzipped: Optional[bytes] = None):
+        self.body = body
+        self.gzipped = gzipped if gzipped is not None else compress_schema(body)
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self.schema: Dict[str, Any] = json.loads(body)
+
+    @classmethod
+    def from_schema(cls, schema: Dict[str, Any]) -> "OpenAPIDocument":
+        return cls(serialize_schema(schema))
+
+    def response(self, request: Request) -> Response:
+        headers = {
+            "ETag": self.etag,
+            "Vary": "Accept-Encoding",
+            "Cache-Control": "no-cache",
+        }
+        if etag_matches(request.headers.get("if-none-match", ""), self.etag):
+            return Response(status_code=304, headers=headers)
+        if select_encoding(request.headers.get("accept-encoding", ""), ["gzip"]):
+            headers["Content-Encoding"] = "gzip"
+            return Response(
+                self.gzipped, media_type="application/json", headers=headers
+            )
+        return Response(self.body, media_type="application/json", headers=headers)
+
+
+def load_openapi_document(path: str) -> Optional[OpenAPIDocument]:
+    """Load a schema written by write_openapi_document(), or None if it isn't there"""
+    schema_path = Path(path)
+    if not schema_path.is_file():
+        logger.warning(
+            "OpenAPI schema file %s not found, generating the schema in-process", path
+        )
+        return None
+    gzipped_path = Path(f"{path}.gz")
+    logger.debug("Loading OpenAPI schema from %s", path)
+    return OpenAPIDocument(
+        schema_path.read_bytes(),
+        gzipped_path.read_bytes() if gzipped_path.is_file() else None,
+    )
+
+
+def write_openapi_document(schema: Dict[str, Any], path: str) -> OpenAPIDocument:
+    """Write the schema to path, and a gzipped copy alongside it"""
+    document = OpenAPIDocument.from_schema(schema)
+    Path(path).write_bytes(document.body)
+    Path(f"{path}.gz").write_bytes(document.gzipped)
+    return document
@@ -0,0 +1,203 @@
+"""
+profiling
+
+Opt-in sampling profiler for web requests and dramatiq tasks, using pyinstrument (which must be installed).
+A fraction of requests/tasks are profiled, and if one takes longer than the threshold, its profile is saved to
+PROFILING_DIR, as a speedscope (https://www.speedscope.app) or HTML file. Use 'fastapi-admin profiles' to
+look at them.
+"""
+import logging
+import random
+import re
+import time
+from pathlib import Path
+from typing import Any, List, Optional
+
+from dramatiq import Middleware
+from fastapi import FastAPI
+from starlette.concurrency import run_in_threadpool
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {"speedscope": "speedscope.json", "html": "html"}
+
+
+class ProfileWriter:
+    """Writes profiles to a directory, keeping only the most recent max_files"""
+
+    def __init__(self, directory: str, output_format: str, max_files: int):
+        self.directory = Path(directory)
+        self.output_format = output_format
+        self.max_files = max_files
+
+    def render(self, profiler: Any) -> str:
+        from pyinstrument.renderers import HTMLRenderer, SpeedscopeRenderer
+
+        if self.output_format == "html":
+            return profiler.output(HTMLRenderer())
+        return profiler.output(SpeedscopeRenderer())
+
+    def write(self, profiler: Any, kind: str, name: str, duration: float) -> Path:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]+", "_", name).strip("_")[:100]
+        path = self.directory / (
+            f"{time.strftime('%Y%m%d-%H%M%S')}-{kind}-{safe_name}-{int(duration * 1000)}ms."
+            f"{EXTENSIONS[self.output_format]}"
+        )
+        path.write_text(self.render(profiler))
+        logger.info("Saved profile of slow %s %s to %s", kind, name, path)
+
+        profiles = list_profiles(str(self.directory))
+        for old in profiles[self.max_files :]:
+            old.unlink()
+        return path
+
+
+def list_profiles(directory: str) -> List[Path]:
+    """The saved profiles, newest first"""
+    path = Path(directory)
+    if not path.is_dir():
+        return []
+    profiles = [
+        p
+        for p in path.iterdir()
+        if p.is_file() and p.name.endswith(tuple(EXTENSIONS.values()))
+    ]
+    return sorted(profiles, key=lambda p: p.stat().st_mtime, reverse=True)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles a fraction of requests, and saves the profiles of the slow ones"""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        writer: ProfileWriter,
+        sample_rate: float,
+        threshold: float,
+        interval: float,
+    ) -> None:
+        self.app = app
+        self.writer = writer
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.interval = interval
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or random.random() >= self.sample_rate:
+            await self.app(scope, receive, send)
+            return
+
+        from pyinstrument import Profiler
+
+        profiler = Profiler(interval=self.interval, async_mode="enabled")
+        start = time.monotonic()
+        profiler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.stop()
+            duration = time.monotonic() - start
+            if duration >= self.threshold:
+                name = f"{scope['method']} {scope['path']}"
+                try:
+                    await run_in_threadpool(
+                        self.writer.write, profiler, "web", name, duration
+                    )
+                except Exception:
+                    # Don't fail the request (or hide its own exception) over the profile
+                    logger.exception("Failed to save profile of %s", name)
+
+
+class TaskProfiling(Middleware):
+    """Dramatiq middleware that profiles a fraction of messages, and saves the profiles of the slow ones"""
+
+    def __init__(
+        self,
+        writer: ProfileWriter,
+        sample_rate: float,
+        threshold: float,
+        interval: float,
+    ):
+        self.writer = writer
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.interval = interval
+
+    def before_process_message(self, broker, message):
+        if random.random() >= self.sample_rate:
+            return
+
+        from pyinstrument import Profiler
+
+        # Worker threads don't run an event loop
+        profiler = Profiler(interval=self.interval, async_mode="disabled")
+        message._profiler = profiler
+        message._profiler_start = time.monotonic()
+        profiler.start()
+
+    def after_process_message(self, broker, message, *, result=None, exception=None):
+        profiler = getattr(message, "_profiler", None)
+        if profiler is None:
+            return
+        message._profiler = None
+        profiler.stop()
+        duration = time.monotonic() - message._profiler_start
+        if duration >= self.threshold:
+            try:
+                self.writer.write(profiler, "task", message.actor_name, duration)
+            except Exception:
+                logger.exception("Failed to save profile of %s", message.actor_name)
+
+    after_skip_message = after_process_message
+
+
+def create_profile_writer() -> Optional[ProfileWriter]:
+    """The writer to use if profiling is enabled and available, otherwise None"""
+    from .config import settings
+
+    if not settings.PROFILING_ENABLED:
+        return None
+    try:
+        import pyinstrument  # noqa
+    except ImportError:
+        logger.warning("PROFILING_ENABLED is set, but pyinstrument is not installed")
+        return None
+    return ProfileWriter(
+        settings.PROFILING_DIR, settings.PROFILING_FORMAT, settings.PROFILING_MAX_FILES
+    )
+
+
+def setup_profiling_middleware(app: FastAPI) -> FastAPI:
+    """Add the profiling middleware to FastAPI application, if profiling is enabled"""
+    from .config import settings
+
+    writer = create_profile_writer()
+    if writer is not None:
+        logger.debug("Loading profiling middleware")
+        app.add_middleware(
+            ProfilingMiddleware,
+            writer=writer,
+            sample_rate=settings.PROFILING_SAMPLE_RATE,
+            threshold=settings.PROFILING_THRESHOLD_SECONDS,
+            interval=settings.PROFILING_INTERVAL,
+        )
+    return app
+
+
+def profiling_broker_middleware() -> List[Middleware]:
+    """Dramatiq middleware to add to the broker for profiling, if it's enabled"""
+    from .config import settings
+
+    writer = create_profile_writer()
+    if writer is None:
+        return []
+    return [
+        TaskProfiling(
+            writer,
+            settings.PROFILING_SAMPLE_RATE,
+            settings.PROFILING_THRESHOLD_SECONDS,
+            settings.PROFILING_INTERVAL,
+        )
+    ]
@@ -0,0 +1,103 @@
+"""
+responses
+
+JSON response classes for the stdlib json, orjson and ujson encoders, all of which handle the types we commonly
+return: datetimes, UUIDs, Decimals, enums, pydantic models and SQLAlchemy rows and ORM objects. The default response
+class for the app is chosen with the JSON_RESPONSE_CLASS setting.
+
+JSON_RESPONSE_CLASS only changes the final encoding step. Endpoints still pass their return values through FastAPI's
+jsonable_encoder first, which is where most of the time goes for large responses, unless they return an instance of
+the response class directly (e.g. `return default_response_class()(rows)`), which skips it.
+"""
+import datetime
+import json
+from decimal import Decimal
+from enum import Enum
+from typing import Any, Type
+from uuid import UUID
+
+from pydantic import BaseModel
+from sqlalchemy import inspect
+from sqlalchemy.engine import Row
+from sqlalchemy.exc import NoInspectionAvailable
+from starlette.responses import JSONResponse as StarletteJSONResponse
+
+
+def json_default(obj: Any) -> Any:
+    """Convert the objects the encoders don't know about into something they do"""
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        # Same as jsonable_encoder
+        return float(obj)
+    if isinstance(obj, UUID):
+        return str(obj)
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    if isinstance(obj, Row):
+        return dict(obj._mapping)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, bytes):
+        return obj.decode()
+    try:
+        # SQLAlchemy ORM objects; just their column attributes, we never want to trigger a lazy load here
+        mapper = inspect(obj).mapper
+    except NoInspectionAvailable:
+        pass
+    else:
+        return {attr.key: getattr(obj, attr.key) for attr in mapper.column_attrs}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class JSONResponse(StarletteJSONResponse):
+    def render(self, content: Any) -> bytes:
+        return json.dumps(
+            content,
+            ensure_ascii=False,
+            allow_nan=False,
+            indent=None,
+            separators=(",", ":"),
+            default=json_default,
+        ).encode("utf-8")
+
+
+class ORJSONResponse(StarletteJSONResponse):
+    def render(self, content: Any) -> bytes:
+        import orjson
+
+        return orjson.dumps(
+            content, default=json_default, option=orjson.OPT_NON_STR_KEYS
+        )
+
+
+class UJSONResponse(StarletteJSONResponse):
+    def render(self, content: Any) -> bytes:
+        import ujson
+
+        return ujson.dumps(content, ensure_ascii=False, default=json_default).encode(
+            "utf-8"
+        )
+
+
+def default_response_class() -> Type[StarletteJSONResponse]:
+    """The response class selected by the JSON_RESPONSE_CLASS setting"""
+    from .config import settings
+
+    if settings.JSON_RESPONSE_CLASS == "orjson":
+        try:
+            import orjson  # noqa
+        except ImportError:
+            raise RuntimeError(
+                "JSON_RESPONSE_CLASS is 'orjson' but it is not installed"
+            )
+        return ORJSONResponse
+    if settings.JSON_RESPONSE_CLASS == "ujson":
+        try:
+            import ujson  # noqa
+        except ImportError:
+            raise RuntimeError("JSON_RESPONSE_CLASS is 'ujson' but it is not installed")
+        return UJSONResponse
+    return JSONResponse
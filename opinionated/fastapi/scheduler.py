@@ -9,8 +9,13 @@ or programmatically to request a task be scheduled dynamically (which will then
 persistently in the database).
 """
 import logging
-from threading import Event
-from typing import Callable
+import os
+import signal
+import socket
+from datetime import datetime, timedelta, timezone
+from threading import Event, Thread, current_thread
+from typing import Callable, Optional
+from uuid import uuid4
 
 import dramatiq
 from apscheduler.executors.debug import DebugExecutor
@@ -18,21 +23,173 @@ from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.base import STATE_STOPPED, BaseScheduler
 from apscheduler.util import TIMEOUT_MAX
-from dramatiq import Worker
+from dramatiq import Middleware, Worker
 from dramatiq.middleware import SkipMessage
 from dramatiq.worker import _WorkerThread  # noqa
 from pytz import utc
-
+from sqlalchemy import (
+    Column,
+    DateTime,
+    MetaData,
+    String,
+    Table,
+    delete,
+    func,
+    insert,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy.exc import (
+    IntegrityError,
+    OperationalError,
+    ProgrammingError,
+    SQLAlchemyError,
+)
+
+from opinionated.fastapi.config import settings
 from opinionated.fastapi.db import engine
+from opinionated.fastapi.metrics import (
+    init_metrics,
+    run_metrics_server,
+    set_scheduler_leader,
+)
 
 logger = logging.getLogger(__name__)
 
 
+# Like the APScheduler job store, the lease table has its own metadata and is created on demand, so it doesn't show
+#  up in the application's migrations.
+scheduler_leases = Table(
+    "scheduler_leases",
+    MetaData(),
+    Column("name", String(64), primary_key=True),
+    Column("holder", String(255), nullable=False),
+    Column("expires_at", DateTime, nullable=False),
+)
+
+
+def database_now(conn) -> datetime:
+    """
+    The database server's clock (as naive UTC, like expires_at), so every process judges the lease by the same clock,
+    however far their own clocks have drifted
+    """
+    now = conn.execute(select(func.now())).scalar_one()
+    if now.tzinfo is not None:
+        now = now.astimezone(timezone.utc).replace(tzinfo=None)
+    return now
+
+
+class SchedulerLeadership:
+    """
+    A leadership lease stored in the database, which makes sure only one scheduler server is running the scheduling
+    loop at any time. The leader renews the lease from its main loop; if it dies, another process takes over once the
+    lease has expired.
+    """
+
+    def __init__(self, name: str = "default", lease_seconds: int = 30):
+        self.name = name
+        self.lease_seconds = lease_seconds
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.is_leader = False
+        self._table_created = False
+
+    @property
+    def renew_interval(self) -> float:
+        # Renew well before the lease expires, so one slow iteration of the main loop doesn't lose us the lease
+        return self.lease_seconds / 3
+
+    def acquire(self) -> bool:
+        """Acquire the lease, or renew it if we already hold it. Returns True if we are the leader."""
+        try:
+            if not self._table_created:
+                scheduler_leases.create(engine, checkfirst=True)
+                self._table_created = True
+            with engine.begin() as conn:
+                now = database_now(conn)
+                expires_at = now + timedelta(seconds=self.lease_seconds)
+                res = conn.execute(
+                    update(scheduler_leases)
+                    .where(scheduler_leases.c.name == self.name)
+                    .where(
+                        or_(
+                            scheduler_leases.c.holder == self.holder,
+                            scheduler_leases.c.expires_at < now,
+                        )
+                    )
+                    .values(holder=self.holder, expires_at=expires_at)
+                )
+                if res.rowcount == 0:
+                    # Either nobody has ever held the lease, or someone else holds it; in the latter case the
+                    #  insert will fail on the primary key.
+                    conn.execute(
+                        insert(scheduler_leases).values(
+                            name=self.name, holder=self.holder, expires_at=expires_at
+                        )
+                    )
+            leader = True
+        except IntegrityError:
+            leader = False
+        except SQLAlchemyError:
+            logger.exception("Failed to acquire scheduler leadership lease")
+            leader = False
+
+        set_scheduler_leader(leader)
+        if leader != self.is_leader:
+            logger.info(
+                "Scheduler leadership %s by %s",
+                "acquired" if leader else "lost",
+                self.holder,
+            )
+        self.is_leader = leader
+        return leader
+
+    def release(self) -> None:
+        """Give up the lease if we hold it, so another process can take over straight away"""
+        if not self.is_leader:
+            return
+        try:
+            with engine.begin() as conn:
+                conn.execute(
+                    delete(scheduler_leases)
+                    .where(scheduler_leases.c.name == self.name)
+                    .where(scheduler_leases.c.holder == self.holder)
+                )
+            logger.info("Scheduler leadership released by %s", self.holder)
+            set_scheduler_leader(False)
+        except SQLAlchemyError:
+            logger.exception("Failed to release scheduler leadership lease")
+        self.is_leader = False
+
+
+def current_leader(name: str = "default") -> Optional[str]:
+    """The holder of the scheduler leadership lease, if anyone holds it"""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(
+                select(scheduler_leases.c.holder)
+                .where(scheduler_leases.c.name == name)
+                .where(scheduler_leases.c.expires_at >= database_now(conn))
+            ).scalar()
+    except (OperationalError, ProgrammingError):
+        # The table hasn't been created yet, so there has never been a leader
+        return None
+
+
 class CustomScheduler(BaseScheduler):
     server: bool = False
-
-    def __init__(self, scheduler_server=False):
+    leadership: Optional[SchedulerLeadership] = None
+
+    def __init__(
+        self,
+        scheduler_server=False,
+        leadership: Optional[SchedulerLeadership] = None,
+        wakeup_threads: int = 1,
+    ):
         self.server = scheduler_server
+        self.leadership = leadership
+        self.wakeup_threads = wakeup_threads
+        self._wakeup_worker: Optional[Worker] = None
         if self.server:
             pool = ThreadPoolExecutor()
         else:
@@ -41,6 +198,9 @@ class CustomScheduler(BaseScheduler):
 
         job_store = SQLAlchemyJobStore(engine=engine)
         self._event = Event()
+        # Set once the main loop has exited and given up the leadership
+        self._loop_done = Event()
+        self._loop_thread: Optional[Thread] = None
 
         super().__init__(
             jobstores={"default": job_store},
@@ -58,15 +218,73 @@ class CustomScheduler(BaseScheduler):
             self._main_loop()
 
     def shutdown(self, wait=True):
+        """
+        Stop the scheduler. When running the scheduling loop in another thread, wait (up to the shutdown timeout) for
+        it to hand off the leadership, so the next scheduler can take over straight away.
+        """
         super().shutdown(wait)
         self._event.set()
+        if self._loop_thread is not None and self._loop_thread is not current_thread():
+            if not self._loop_done.wait(settings.SHUTDOWN_TIMEOUT):
+                logger.warning("Scheduler loop did not stop in time")
 
     def _main_loop(self):
         wait_seconds = TIMEOUT_MAX
-        while self.state != STATE_STOPPED:
-            self._event.wait(wait_seconds)
-            self._event.clear()
-            wait_seconds = self._process_jobs()
+        self._loop_thread = current_thread()
+        self._loop_done.clear()
+        try:
+            while self.state != STATE_STOPPED:
+                self._event.wait(wait_seconds)
+                self._event.clear()
+                if self.state == STATE_STOPPED:
+                    break
+                if self._check_leadership():
+                    wait_seconds = self._process_jobs()
+                else:
+                    wait_seconds = TIMEOUT_MAX
+                if self.leadership is not None:
+                    # Wake up in time to renew the lease (or to try and take it over)
+                    if wait_seconds is None:
+                        wait_seconds = self.leadership.renew_interval
+                    else:
+                        wait_seconds = min(wait_seconds, self.leadership.renew_interval)
+        finally:
+            # Stopping the wakeup worker requeues any wakeup messages it prefetched, for the next leader to pick up
+            self._stop_wakeup_worker()
+            if self.leadership is not None:
+                self.leadership.release()
+            self._loop_done.set()
+
+    def _check_leadership(self) -> bool:
+        """Renew our leadership, and start or stop consuming wakeup messages if that changed"""
+        if self.leadership is None:
+            if self._wakeup_worker is None:
+                self._start_wakeup_worker()
+            return True
+
+        was_leader = self.leadership.is_leader
+        leader = self.leadership.acquire()
+        if leader and not was_leader:
+            self._start_wakeup_worker()
+        elif was_leader and not leader:
+            self._stop_wakeup_worker()
+        return leader
+
+    def _start_wakeup_worker(self):
+        # This is a custom worker that receives messages from the 'scheduler' queue, and uses those to "wake up" the
+        #  scheduler in the event of new/modified jobs. Only the leader consumes them.
+        self._wakeup_worker = CustomWorker(
+            dramatiq.get_broker(),
+            queues={"scheduler"},
+            worker_threads=self.wakeup_threads,
+            wakeup=self.wakeup,
+        )
+        self._wakeup_worker.start()
+
+    def _stop_wakeup_worker(self):
+        if self._wakeup_worker is not None:
+            self._wakeup_worker.stop(timeout=settings.SHUTDOWN_TIMEOUT * 1000)
+            self._wakeup_worker = None
 
     def wakeup(self):
         """Custom wakeup that sets event flag if we're in runscheduler, or otherwise sends a dramatiq event"""
@@ -115,6 +333,8 @@ class CustomWorker(Worker):
     """A custom dramatiq worker that overrides the normal actor mechanism and uses our own callback"""
 
     wakeup: Callable[..., None]
+    # Checked by GracefulShutdownNotifications; stopping this worker mustn't interrupt the tasks of the real one
+    runs_actors = False
 
     def __init__(self, *args, wakeup: Callable[..., None], **kwargs):
         super().__init__(*args, **kwargs)
@@ -134,30 +354,75 @@ class CustomWorker(Worker):
         self.workers.append(worker)
 
 
+def create_scheduler_server() -> CustomScheduler:
+    """Create a scheduler that runs the scheduling loop, whenever it holds the leadership lease."""
+
+    # This is separate from the scheduler that gets launched as part of the normal api server/worker startup, that
+    #  one doesn't actually run a scheduling loop, just provides the jobstore.
+    return CustomScheduler(
+        scheduler_server=True,
+        leadership=SchedulerLeadership(lease_seconds=settings.SCHEDULER_LEASE_SECONDS),
+        wakeup_threads=settings.SCHEDULER_WAKEUP_THREADS,
+    )
+
+
 def run_scheduler() -> None:
     """
-    Run a scheduler process, this should be a separate process and only one should be running at any time.
+    Run a scheduler process. More than one can be running, but only the one holding the leadership lease will
+    schedule anything; the others wait to take over.
     """
 
-    # Set up the scheduler. This is separate from the scheduler that gets launched as part of the normal
-    #  api server/worker startup, that one doesn't actually run a scheduling loop, just provides the jobstore.
-    scheduler_process = CustomScheduler(scheduler_server=True)
+    if init_metrics("scheduler") is not None:
+        run_metrics_server("scheduler", settings.METRICS_SCHEDULER_PORT)
 
-    # Now before we start the scheduler (which will block anything more on this thread), set up the dramatiq Worker.
-    # This is a custom worker that receives messages from the 'scheduler' queue, and uses those to "wake up" the
-    #  scheduler in the event of new/modified jobs.
-    def wakeup():
-        scheduler_process.wakeup()
+    scheduler_process = create_scheduler_server()
 
-    # We probably only need or want one thread, to be honest...lets see what works best though.
-    worker = CustomWorker(
-        dramatiq.get_broker(), queues={"scheduler"}, worker_threads=4, wakeup=wakeup
-    )
-    worker.start()
-    # Now that we've got everything running, start the scheduler.
+    def handle_signal(signum, frame):
+        logger.info("Received %s, shutting down scheduler", signal.Signals(signum).name)
+        # The main loop runs in this thread; it exits and releases the lease once the handler returns
+        if scheduler_process.running:
+            scheduler_process.shutdown()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    # This blocks until the scheduler is shut down. The wakeup worker is started once we are the leader.
     scheduler_process.start()
 
 
+class EmbeddedScheduler(Middleware):
+    """
+    Dramatiq middleware that runs a scheduler server in a background thread of each worker process, sharing the
+    worker's bootstrap, broker connection and database pool. Every worker process contends for the leadership lease,
+    and only the leader schedules jobs and consumes the 'scheduler' queue.
+    """
+
+    def __init__(self):
+        self.scheduler: Optional[CustomScheduler] = None
+        self.thread: Optional[Thread] = None
+
+    def after_worker_boot(self, broker, worker):
+        if isinstance(worker, CustomWorker):
+            # That's our own wakeup worker booting, not the main one
+            return
+        logger.info("Starting embedded scheduler")
+        self.scheduler = create_scheduler_server()
+        self.thread = Thread(
+            target=self.scheduler.start, name="EmbeddedScheduler", daemon=True
+        )
+        self.thread.start()
+
+    def before_worker_shutdown(self, broker, worker):
+        if isinstance(worker, CustomWorker) or self.scheduler is None:
+            return
+        logger.info("Stopping embedded scheduler")
+        self.scheduler.shutdown()
+        if self.thread is not None:
+            self.thread.join(settings.SHUTDOWN_TIMEOUT)
+        self.scheduler = None
+        self.thread = None
+
+
 dramatiq.get_broker().declare_queue("scheduler")
 # This is the scheduler we use for workers and the main webserver processes. It won't actually schedule anything, it
 #  will just add the jobs to the sqlalchemy table, and send a "wakeup" task to the scheduler queue in dramatiq, which
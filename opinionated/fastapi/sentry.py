@@ -1,12 +1,120 @@
 import logging
+import random
+import time
+from typing import Any, Dict, List, Optional
 
+from dramatiq import Middleware
 from fastapi import FastAPI
+from starlette.routing import Router, compile_path
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .utils import RateLimiter, RouteTemplates
 
 logger = logging.getLogger(__name__)
 
+# The fraction of requests and tasks to trace, when tracing is enabled but SENTRY_TRACES_SAMPLE_RATE isn't set
+DEFAULT_TRACES_SAMPLE_RATE = 0.1
+
+
+class TracesSampler:
+    """
+    Sentry traces_sampler using per-route and per-actor rates from the settings, falling back to the default rate,
+    and limited to a budget of transactions per second. Each process has its own budget, and it applies even when the
+    caller sampled the trace, so it caps what we send however much traffic comes in already sampled.
+    """
+
+    def __init__(
+        self,
+        default_rate: float,
+        route_rates: Dict[str, float],
+        actor_rates: Dict[str, float],
+        max_per_second: Optional[float] = None,
+    ):
+        self.default_rate = default_rate
+        # Routes are given as templates, e.g. "/items/{item_id}"
+        self.route_rates = [
+            (compile_path(template)[0], rate) for template, rate in route_rates.items()
+        ]
+        self.actor_rates = actor_rates
+        self.budget = RateLimiter(max_per_second) if max_per_second else None
+
+    def rate(self, sampling_context: Dict[str, Any]) -> float:
+        asgi_scope = sampling_context.get("asgi_scope")
+        if asgi_scope is not None:
+            path = asgi_scope.get("path", "")
+            for regex, rate in self.route_rates:
+                if regex.match(path):
+                    return rate
+        message = sampling_context.get("dramatiq_message")
+        if message is not None:
+            return self.actor_rates.get(message.actor_name, self.default_rate)
+        return self.default_rate
+
+    def __call__(self, sampling_context: Dict[str, Any]) -> bool:
+        parent_sampled = sampling_context.get("parent_sampled")
+        if parent_sampled is not None:
+            # Go with the upstream service's decision, so we get the whole trace (or none of it), within our budget
+            return parent_sampled and self.allow()
+        rate = self.rate(sampling_context)
+        if rate <= 0 or random.random() >= rate:
+            return False
+        return self.allow()
+
+    def allow(self) -> bool:
+        return self.budget is None or self.budget.allow()
+
+
+# The sampler in use, if tracing is enabled
+traces_sampler: Optional[TracesSampler] = None
+
+
+def traces_sample_rate() -> float:
+    from .config import settings
+
+    rate = settings.SENTRY_TRACES_SAMPLE_RATE
+    return DEFAULT_TRACES_SAMPLE_RATE if rate is None else rate
+
+
+def tracing_enabled() -> bool:
+    """Whether we need to create transactions at all; if not, we avoid the overhead entirely."""
+    from .config import settings
+
+    enabled = settings.SENTRY_TRACES_ENABLED
+    if enabled is None:
+        # Before SENTRY_TRACES_ENABLED, setting the sample rate was how tracing was configured
+        enabled = settings.SENTRY_TRACES_SAMPLE_RATE is not None
+    if not enabled:
+        return False
+    if settings.SENTRY_DSN is None or len(settings.SENTRY_DSN) == 0:
+        return False
+    return (
+        traces_sample_rate() > 0
+        or any(rate > 0 for rate in settings.SENTRY_TRACES_ROUTE_RATES.values())
+        or any(rate > 0 for rate in settings.SENTRY_TRACES_ACTOR_RATES.values())
+        or settings.SENTRY_TRACES_ON_ERROR
+        or settings.SENTRY_TRACES_SLOW_REQUEST_SECONDS is not None
+        or settings.SENTRY_TRACES_SLOW_TASK_SECONDS is not None
+    )
+
+
+def sample_after_the_fact(transaction: Any, reason: str) -> None:
+    """
+    Send a transaction that wasn't sampled at the start, because it turned out to be slow or to fail. We didn't
+    record its spans, so it will only have the overall timing.
+    """
+    if transaction is None or transaction.sampled:
+        return
+    if traces_sampler is not None and not traces_sampler.allow():
+        return
+    transaction.sampled = True
+    transaction.init_span_recorder(maxlen=1)
+    transaction.set_tag("sampled_because", reason)
+
 
 def init_sentry():
     """Initialize sentry on application startup"""
+    global traces_sampler
+
     from .config import settings
 
     if settings.SENTRY_DSN is not None and len(settings.SENTRY_DSN) > 0:
@@ -16,22 +124,144 @@ def init_sentry():
         from sentry_dramatiq import DramatiqIntegration
         from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
 
+        if tracing_enabled():
+            if settings.SENTRY_TRACES_ENABLED is None:
+                logger.info(
+                    "Sentry tracing is enabled because SENTRY_TRACES_SAMPLE_RATE is set"
+                )
+            traces_sampler = TracesSampler(
+                traces_sample_rate(),
+                settings.SENTRY_TRACES_ROUTE_RATES,
+                settings.SENTRY_TRACES_ACTOR_RATES,
+                settings.SENTRY_TRACES_MAX_PER_SECOND,
+            )
+
         sentry_sdk.init(
             dsn=settings.SENTRY_DSN,
             environment=settings.SENTRY_ENVIRONMENT,
             release=settings.SENTRY_RELEASE,
             sample_rate=settings.SENTRY_SAMPLE_RATE,
             send_default_pii=settings.SENTRY_SEND_PII,
-            traces_sample_rate=settings.SENTRY_TRACES_SAMPLE_RATE,
+            # Leaving both unset disables tracing in the SDK completely
+            traces_sampler=traces_sampler,
             integrations=[
                 # fixme write an integration for fastapi to add any other useful data to our events
-                #  (in particular, set transaction name based on route endpoint, add instrumentation, etc)
                 SqlalchemyIntegration(),
                 DramatiqIntegration(),
             ],
         )
 
 
+class SentryTracingMiddleware:
+    """
+    ASGI middleware that runs inside the Sentry middleware: it names the transaction after the route template,
+    and sends unsampled transactions anyway if the request fails or is slow.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        router: Router,
+        on_error: bool = True,
+        slow_seconds: Optional[float] = None,
+    ) -> None:
+        self.app = app
+        self.on_error = on_error
+        self.slow_seconds = slow_seconds
+        self.templates = RouteTemplates(router)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        from sentry_sdk import Hub
+
+        transaction = Hub.current.scope.transaction
+        status_code = 500
+        start = time.monotonic()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            if self.on_error:
+                sample_after_the_fact(transaction, "error")
+            raise
+        finally:
+            template = self.templates.for_scope(scope)
+            if transaction is not None and template is not None:
+                transaction.name = template
+
+        if self.on_error and status_code >= 500:
+            sample_after_the_fact(transaction, "error")
+        elif (
+            self.slow_seconds is not None
+            and time.monotonic() - start >= self.slow_seconds
+        ):
+            sample_after_the_fact(transaction, "slow")
+
+
+class SentryTracing(Middleware):
+    """Dramatiq middleware that traces each message as a transaction named after the actor"""
+
+    def __init__(self, on_error: bool = True, slow_seconds: Optional[float] = None):
+        self.on_error = on_error
+        self.slow_seconds = slow_seconds
+
+    def before_process_message(self, broker, message):
+        from sentry_sdk import Hub
+
+        transaction = Hub.current.start_transaction(
+            op="dramatiq.task",
+            name=message.actor_name,
+            custom_sampling_context={"dramatiq_message": message},
+        )
+        message._sentry_transaction = transaction
+        message._sentry_start = time.monotonic()
+        with Hub.current.configure_scope() as scope:
+            scope.span = transaction
+
+    def after_process_message(self, broker, message, *, result=None, exception=None):
+        transaction = getattr(message, "_sentry_transaction", None)
+        if transaction is None:
+            return
+        if exception is not None:
+            transaction.set_status("internal_error")
+            if self.on_error:
+                sample_after_the_fact(transaction, "error")
+        else:
+            transaction.set_status("ok")
+            if (
+                self.slow_seconds is not None
+                and time.monotonic() - message._sentry_start >= self.slow_seconds
+            ):
+                sample_after_the_fact(transaction, "slow")
+        transaction.finish()
+        message._sentry_transaction = None
+
+    after_skip_message = after_process_message
+
+
+def sentry_broker_middleware() -> List[Middleware]:
+    """Dramatiq middleware to add to the broker for tracing, if it's enabled"""
+    from .config import settings
+
+    if not tracing_enabled():
+        return []
+    return [
+        SentryTracing(
+            on_error=settings.SENTRY_TRACES_ON_ERROR,
+            slow_seconds=settings.SENTRY_TRACES_SLOW_TASK_SECONDS,
+        )
+    ]
+
+
 def setup_sentry_middleware(app: FastAPI) -> FastAPI:
     """Add sentry middleware to FastAPI application"""
 
@@ -41,6 +271,14 @@ def setup_sentry_middleware(app: FastAPI) -> FastAPI:
         logger.debug("Loading Sentry ASGI Middleware")
         from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
 
+        # Added first, so it runs inside the Sentry middleware and can see its transaction
+        if tracing_enabled():
+            app.add_middleware(
+                SentryTracingMiddleware,
+                router=app.router,
+                on_error=settings.SENTRY_TRACES_ON_ERROR,
+                slow_seconds=settings.SENTRY_TRACES_SLOW_REQUEST_SECONDS,
+            )
         app.add_middleware(SentryAsgiMiddleware)
 
     return app
@@ -0,0 +1,75 @@
+"""
+server
+
+Runs the production web server: gunicorn managing a pool of uvicorn workers.
+"""
+import importlib
+import logging
+import os
+from typing import Any, Dict, Protocol, cast
+
+from fastapi import FastAPI
+from gunicorn.app.base import BaseApplication
+from uvicorn.workers import UvicornWorker as BaseUvicornWorker
+
+logger = logging.getLogger(__name__)
+
+
+class FastApiAppProtocol(Protocol):
+    app: FastAPI
+
+
+def default_worker_count() -> int:
+    """The number of CPUs we are allowed to run on, which may be fewer than the machine has"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on all platforms
+        return os.cpu_count() or 1
+
+
+class UvicornWorker(BaseUvicornWorker):
+    """
+    Uvicorn worker for gunicorn. The event loop, HTTP implementation and concurrency limit are set on the class by
+    runserver (the workers are forked from the master, so they inherit it).
+    """
+
+    CONFIG_KWARGS: Dict[str, Any] = {
+        "loop": "auto",
+        "http": "auto",
+        "limit_concurrency": None,
+    }
+
+
+def post_fork(server, worker) -> None:
+    """Each worker needs its own database connection pool, not a copy of the master's"""
+    from .db import reset_engine_after_fork
+
+    reset_engine_after_fork()
+
+
+def child_exit(server, worker) -> None:
+    from .metrics import mark_process_dead
+
+    mark_process_dead(worker.pid, "web")
+
+
+class GunicornApplication(BaseApplication):
+    def __init__(self, app_module: str, options: Dict[str, Any]):
+        self.app_module = app_module
+        self.options = options
+        super().__init__()
+
+    def init(self, parser, opts, args):
+        pass
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set("worker_class", "opinionated.fastapi.server.UvicornWorker")
+        self.cfg.set("post_fork", post_fork)
+        self.cfg.set("child_exit", child_exit)
+
+    def load(self):
+        # With preload_app this runs once in the master, otherwise in each worker after it forks
+        return cast(FastApiAppProtocol, importlib.import_module(self.app_module)).app
@@ -0,0 +1,86 @@
+"""
+shutdown
+
+Coordinated graceful shutdown, all bounded by settings.SHUTDOWN_TIMEOUT:
+
+- the web server stops accepting connections and finishes in-flight requests (gunicorn's graceful timeout), then
+  closes the database pool
+- workers stop consuming, let running tasks finish, and requeue any they have to interrupt straight away - dramatiq
+  itself requeues the messages that were prefetched but not started
+- the scheduler releases its leadership lease, so another scheduler can take over without waiting for it to expire
+"""
+import logging
+import threading
+from typing import Optional
+
+from dramatiq.message import generate_unique_id
+from dramatiq.middleware import Retries, Shutdown, ShutdownNotifications
+
+logger = logging.getLogger(__name__)
+
+# Running tasks are interrupted at this fraction of the timeout, leaving the rest for requeueing and closing connections
+INTERRUPT_AT = 0.8
+
+
+def close_connections() -> None:
+    """Close the database pool once the last request or task has finished"""
+    from .db import engine
+
+    logger.info("Closing database connections")
+    engine.dispose()
+
+
+class GracefulShutdownNotifications(ShutdownNotifications):
+    """
+    Like ShutdownNotifications, but give running tasks until the shutdown timeout to finish before interrupting them.
+    """
+
+    def __init__(self, timeout: float, notify_shutdown: bool = False):
+        super().__init__(notify_shutdown=notify_shutdown)
+        self.timeout = timeout
+        self.timer: Optional[threading.Timer] = None
+
+    def before_worker_shutdown(self, broker, worker):
+        if not getattr(worker, "runs_actors", True):
+            # The scheduler's wakeup worker stopping must not interrupt the tasks
+            return
+        logger.info(
+            "Waiting up to %.1fs for running tasks to finish",
+            self.timeout * INTERRUPT_AT,
+        )
+        self.timer = threading.Timer(
+            self.timeout * INTERRUPT_AT,
+            super().before_worker_shutdown,
+            args=(broker, worker),
+        )
+        self.timer.daemon = True
+        self.timer.start()
+
+    def after_worker_shutdown(self, broker, worker):
+        if not getattr(worker, "runs_actors", True):
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        close_connections()
+
+
+class GracefulRetries(Retries):
+    """
+    Like Retries, but put messages for tasks that were interrupted by a shutdown straight back on the queue, without
+    backing off or using up a retry. What goes back is a copy with a message ID of its own: the worker still acks the
+    original afterwards, and nothing it does with that ID may touch the copy.
+    """
+
+    def after_process_message(self, broker, message, *, result=None, exception=None):
+        if isinstance(exception, Shutdown):
+            requeued = broker.enqueue(message.copy(message_id=generate_unique_id()))
+            logger.info(
+                "Requeued interrupted message %r as %r",
+                message.message_id,
+                requeued.message_id,
+            )
+            return
+        super().after_process_message(
+            broker, message, result=result, exception=exception
+        )
@@ -0,0 +1,44 @@
+"""
+staticfiles
+
+Static files that are served precompressed when there is a compressed copy alongside the original, e.g. app.js.br
+or app.js.gz next to app.js. Note this needs the aiofiles package, like starlette's StaticFiles.
+"""
+import stat
+from mimetypes import guess_type
+from typing import Sequence
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+from .compression import select_encodings
+
+SUFFIXES = {"br": ".br", "zstd": ".zst", "gzip": ".gz"}
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    def __init__(self, *args, encodings: Sequence[str] = ("br", "gzip"), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.encodings = [encoding for encoding in encodings if encoding in SUFFIXES]
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        if scope["method"] in ("GET", "HEAD"):
+            accepted = select_encodings(
+                Headers(scope=scope).get("accept-encoding", ""), self.encodings
+            )
+            for encoding in accepted:
+                full_path, stat_result = await self.lookup_path(
+                    path + SUFFIXES[encoding]
+                )
+                if stat_result and stat.S_ISREG(stat_result.st_mode):
+                    response = self.file_response(full_path, stat_result, scope)
+                    # The content type is that of the original file, not the compressed one
+                    response.headers["Content-Type"] = (
+                        guess_type(path)[0] or "text/plain"
+                    )
+                    response.headers["Content-Encoding"] = encoding
+                    response.headers["Vary"] = "Accept-Encoding"
+                    return response
+        return await super().get_response(path, scope)
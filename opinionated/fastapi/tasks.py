@@ -1,19 +1,14 @@
 import logging
 import os
-from typing import List, Optional
+import threading
+from typing import Any, List, Optional
 
 import dramatiq
-from dramatiq import Broker, Middleware, set_broker
+from dramatiq import Broker, Message, Middleware, get_broker, set_broker
 from dramatiq.brokers.rabbitmq import RabbitmqBroker
 from dramatiq.brokers.redis import RedisBroker
 from dramatiq.brokers.stub import StubBroker
-from dramatiq.middleware import (
-    AgeLimit,
-    Prometheus,
-    Retries,
-    ShutdownNotifications,
-    TimeLimit,
-)
+from dramatiq.middleware import AgeLimit, TimeLimit
 
 # from dramatiq.results import Results
 
@@ -21,10 +16,33 @@ from dramatiq.middleware import (
 logger = logging.getLogger(__name__)
 
 
+class InlineBroker(StubBroker):
+    """
+    A stub broker that runs each task as soon as it's sent, in the thread that sent it (e.g. for tests), raising any
+    exception it raises to the sender. Only the middleware's enqueue hooks run: there are no retries, time limits or
+    age limits, and a delay is ignored. Messages for actors it doesn't know, and for the scheduler's queue (its wakeup
+    messages), are queued as on the stub broker.
+    """
+
+    def enqueue(self, message: Message, *, delay: Optional[int] = None) -> Message:
+        actor = self.actors.get(message.actor_name)
+        if actor is None or message.queue_name == "scheduler":
+            return super().enqueue(message, delay=delay)
+        self.emit_before("enqueue", message, delay)
+        actor.fn(*message.args, **message.kwargs)
+        self.emit_after("enqueue", message, delay)
+        return message
+
+
 def create_broker(
-    broker_type: str, url: Optional[str], middleware: List[Middleware]
+    broker_type: str,
+    url: Optional[str],
+    middleware: List[Middleware],
+    inline: bool = False,
 ) -> Broker:
     if broker_type == "stub":
+        if inline:
+            return InlineBroker(middleware=middleware)
         return StubBroker(middleware=middleware)
     if url is None:
         raise RuntimeError("Must set WORKER_BROKER_URL")
@@ -34,34 +52,96 @@ def create_broker(
         return RabbitmqBroker(url=url, middleware=middleware)
 
 
+# The connection ping_broker() uses for RabbitMQ, kept open between pings; pika connections aren't thread-safe
+_ping_connection: Any = None
+_ping_lock = threading.Lock()
+
+
+def _ping_rabbitmq(broker: RabbitmqBroker) -> None:
+    global _ping_connection
+    import pika
+
+    with _ping_lock:
+        while True:
+            connection = _ping_connection
+            fresh = connection is None or not connection.is_open
+            try:
+                if fresh:
+                    connection = _ping_connection = pika.BlockingConnection(
+                        parameters=broker.parameters
+                    )
+                # Opening a channel is a round trip to the server
+                connection.channel().close()
+                return
+            except Exception:
+                # Whatever went wrong (including a timeout), don't leave the connection open
+                _ping_connection = None
+                if connection is not None and connection.is_open:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+                # The server may have dropped a connection that sat idle, so try a new one before giving up
+                if fresh:
+                    raise
+
+
+def ping_broker() -> None:
+    """Make sure we can talk to the broker, raising an exception if not"""
+    broker = get_broker()
+    if isinstance(broker, RedisBroker):
+        broker.client.ping()
+    elif isinstance(broker, RabbitmqBroker):
+        # The broker keeps a connection open for each thread that uses it, and the checks run in whichever thread
+        #  of the pool is free, so use a connection of our own rather than leaving one behind in each of them
+        _ping_rabbitmq(broker)
+
+
 def init_broker(reload=False):
     # Import locally to avoid circular imports
     from .config import settings
+    from .log import CorrelationIDs
+    from .metrics import TaskMetrics
+    from .profiling import profiling_broker_middleware
+    from .sentry import sentry_broker_middleware
+    from .shutdown import GracefulRetries, GracefulShutdownNotifications
 
     logger.info("Loading async task broker")
     middleware = [
+        CorrelationIDs(),
         # max time waiting in queue (one day)
         AgeLimit(max_age=3600000),
-        Retries(max_retries=10, min_backoff=15000, max_backoff=604800000),
-        ShutdownNotifications(notify_shutdown=True),
+        GracefulRetries(max_retries=10, min_backoff=15000, max_backoff=604800000),
+        GracefulShutdownNotifications(settings.SHUTDOWN_TIMEOUT, notify_shutdown=True),
         # max task execution time (10min)
         TimeLimit(time_limit=600000, interval=1000),
-        # fixme: dramatiq uses env vars for prometheus; maybe write our own using settings?
-        Prometheus(),
         # fixme: i doubt we'll use results; anything that requires a result should prob be
         #  run using fastapi async BackgroundTask, but keep it here to keep our options open
         # Results(),
     ]
+    if settings.METRICS_ENABLED:
+        middleware.append(TaskMetrics())
+    middleware += sentry_broker_middleware()
+    middleware += profiling_broker_middleware()
 
     set_broker(
         create_broker(
-            settings.WORKER_BROKER_TYPE, settings.WORKER_BROKER_URL, middleware
+            settings.WORKER_BROKER_TYPE,
+            settings.WORKER_BROKER_URL,
+            middleware,
+            inline=settings.WORKER_BROKER_INLINE,
         )
     )
 
+    if settings.WORKER_EMBED_SCHEDULER:
+        # Import after setting the broker; the scheduler module declares its queue on import
+        from .scheduler import EmbeddedScheduler
+
+        get_broker().add_middleware(EmbeddedScheduler())
+
 
 def setup_dramatiq():
-    """Called by dramatiq worker. Do NOT run this function from anywhere else"""
+    """Called by dramatiq worker (and its fork processes). Do NOT run this function from anywhere else"""
 
     os.environ.setdefault("FASTAPI_CONFIG_MODULE", "server.config")
     os.environ.setdefault("FASTAPI_SETTINGS", "Development")
@@ -0,0 +1,322 @@
+"""
+testing
+
+A pytest plugin (loaded by 'fastapi-admin test', or with "-p opinionated.fastapi.testing") that gives each test
+process its own database, cloned from a template that is migrated once and kept between runs: a file copy for SQLite,
+CREATE DATABASE ... TEMPLATE for PostgreSQL. Run in parallel with pytest-xdist, each worker gets its own clone.
+
+Each test runs inside a transaction that is rolled back afterwards, so tests don't have to recreate the schema or clean
+up after themselves: Sessions from db.Session join that transaction, and their commits only release a savepoint.
+Tasks use the stub broker, and by default (TEST_INLINE_TASKS) run as soon as they're sent, inside the test: without
+retries, time limits or delays (see tasks.InlineBroker).
+"""
+import logging
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import URL, Connection, Engine, make_url
+from sqlalchemy.pool import NullPool
+
+logger = logging.getLogger(__name__)
+
+
+def is_memory_database(url: URL) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in {None, "", ":memory:"}
+
+
+def database_name(url: URL) -> str:
+    """The database name, or file for SQLite (in-memory databases are used as they are, so never get here)"""
+    if not url.database:
+        raise pytest.UsageError(f"The database URL {url} has no database name.")
+    return url.database
+
+
+def database_url_for(url: URL, suffix: str) -> URL:
+    """The URL of the test database with this suffix ("template", or the xdist worker id)"""
+    backend = url.get_backend_name()
+    if backend == "sqlite":
+        path = Path(database_name(url))
+        return url.set(
+            database=str(path.with_name(f"{path.stem}.test-{suffix}{path.suffix}"))
+        )
+    if backend == "postgresql":
+        return url.set(database=f"test_{url.database}_{suffix}")
+    raise pytest.UsageError(
+        f"Test databases are only supported on SQLite and PostgreSQL, not {backend}."
+    )
+
+
+def admin_connection(url: URL) -> Connection:
+    """An autocommit connection to the maintenance database, for creating and dropping databases"""
+    engine = create_engine(
+        url.set(database="postgres"),
+        isolation_level="AUTOCOMMIT",
+        poolclass=NullPool,
+        future=True,
+    )
+    return engine.connect()
+
+
+def database_exists(url: URL) -> bool:
+    if url.get_backend_name() == "sqlite":
+        return Path(database_name(url)).exists()
+    with admin_connection(url) as connection:
+        return bool(
+            connection.execute(
+                text("SELECT 1 FROM pg_database WHERE datname = :name"),
+                {"name": url.database},
+            ).scalar()
+        )
+
+
+def create_database(url: URL, template: Optional[URL] = None) -> None:
+    """Create an empty database, or a copy of the template, replacing any database already there"""
+    drop_database(url)
+    if url.get_backend_name() == "sqlite":
+        if template is not None:
+            shutil.copyfile(database_name(template), database_name(url))
+        return
+    with admin_connection(url) as connection:
+        quote = connection.dialect.identifier_preparer.quote
+        statement = f"CREATE DATABASE {quote(url.database)}"
+        if template is not None:
+            statement += f" TEMPLATE {quote(template.database)}"
+        connection.execute(text(statement))
+
+
+def drop_database(url: URL) -> None:
+    if url.get_backend_name() == "sqlite":
+        Path(database_name(url)).unlink(missing_ok=True)
+        return
+    with admin_connection(url) as connection:
+        quote = connection.dialect.identifier_preparer.quote
+        connection.execute(text(f"DROP DATABASE IF EXISTS {quote(url.database)}"))
+
+
+def template_is_current(url: URL) -> bool:
+    """Whether the template exists and has been migrated to the latest revisions"""
+    from alembic.config import Config
+    from alembic.script import ScriptDirectory
+
+    from .config import settings
+
+    if not database_exists(url):
+        return False
+    heads = set(
+        ScriptDirectory.from_config(Config(settings.TEST_ALEMBIC_CONFIG)).get_heads()
+    )
+    engine = create_engine(url, poolclass=NullPool, future=True)
+    try:
+        with engine.connect() as connection:
+            revisions = connection.execute(
+                text("SELECT version_num FROM alembic_version")
+            )
+            return {revision for revision, in revisions} == heads
+    except Exception:
+        # Most likely the migrations never got as far as creating alembic_version
+        return False
+    finally:
+        engine.dispose()
+
+
+def prepare_template(url: URL, recreate: bool = False) -> None:
+    """
+    Make sure the template database is up to date, migrating it in a process of its own. The template is kept between
+    runs, and only rebuilt when there are new migrations (or --create-db is given, e.g. after editing a migration).
+    """
+    from .config import settings
+
+    migrations = Path(settings.TEST_ALEMBIC_CONFIG).exists()
+    if migrations and not recreate and template_is_current(url):
+        logger.debug("Test template database %s is up to date", url.database)
+        return
+
+    logger.info("Creating the test template database %s", url.database)
+    create_database(url)
+    subprocess.run(
+        [sys.executable, "-m", __name__],
+        env={
+            **os.environ,
+            "FASTAPI_DATABASE_URL": url.render_as_string(hide_password=False),
+        },
+        check=True,
+    )
+
+
+def build_schema() -> None:
+    """Migrate the database at DATABASE_URL to the latest revisions, or create the tables if there are no migrations"""
+    from .config import settings
+
+    if Path(settings.TEST_ALEMBIC_CONFIG).exists():
+        from alembic import command
+        from alembic.config import Config
+
+        command.upgrade(Config(settings.TEST_ALEMBIC_CONFIG), "heads")
+    else:
+        from .bootstrap import setup
+        from .db import Registry, engine
+
+        setup()
+        Registry.metadata.create_all(engine)
+
+
+def pytest_addoption(parser: Any) -> None:
+    parser.addoption(
+        "--create-db",
+        action="store_true",
+        default=False,
+        help="Rebuild the test template database, even if it seems to be up to date.",
+    )
+
+
+def setup_test_database(config: Any, url: URL) -> Optional[URL]:
+    """Prepare the template, and clone this process's own database from it, if it needs one"""
+    if is_memory_database(url):
+        # Nothing to share between processes; the tables are created once setup() has run
+        return None
+
+    worker = os.environ.get("PYTEST_XDIST_WORKER")
+    template = database_url_for(url, "template")
+    if worker is None:
+        prepare_template(template, recreate=config.known_args_namespace.create_db)
+        if getattr(config.known_args_namespace, "numprocesses", None):
+            # This is the xdist controller; the workers clone their own databases
+            return None
+
+    database_url = database_url_for(url, worker or "main")
+    create_database(database_url, template)
+    return database_url
+
+
+def pytest_load_initial_conftests(early_config: Any, parser: Any, args: Any) -> None:
+    # This runs before any conftest.py can import the app, so everything it sets up sees the test database
+    from .config import init_config, reload_settings, settings
+
+    os.environ.setdefault(
+        "FASTAPI_CONFIG_MODULE", "opinionated.fastapi.default_settings"
+    )
+    os.environ.setdefault("FASTAPI_SETTINGS", "DefaultSettings")
+    init_config()
+
+    overrides = {
+        "FASTAPI_WORKER_BROKER_TYPE": "stub",
+        "FASTAPI_WORKER_BROKER_INLINE": str(settings.TEST_INLINE_TASKS).lower(),
+        # Tests run one after another in each process, so there's nothing for the scheduler to do
+        "FASTAPI_WORKER_EMBED_SCHEDULER": "false",
+        # Nor for a pool of processes, each of which would set up the app all over again
+        "FASTAPI_EXECUTOR_PROCESSES": "0",
+    }
+    url = setup_test_database(early_config, make_url(settings.DATABASE_URL))
+    if url is not None:
+        overrides["FASTAPI_DATABASE_URL"] = url.render_as_string(hide_password=False)
+    early_config.test_database_url = url
+
+    # Set them the way they're configured, which also passes them on to any subprocesses the tests start
+    os.environ.update(overrides)
+    reload_settings()
+
+
+def sqlite_savepoints(engine: Engine) -> None:
+    """
+    pysqlite handles transactions itself, and gets SAVEPOINT wrong; this takes over, so the savepoints work.
+    See "Serializable isolation / Savepoints / Transactional DDL" in SQLAlchemy's SQLite documentation.
+    """
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection: Any, connection_record: Any) -> None:
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def begin(connection: Connection) -> None:
+        connection.exec_driver_sql("BEGIN")
+
+
+def pytest_configure(config: Any) -> None:
+    from .bootstrap import setup
+    from .db import Registry, engine
+
+    setup()
+
+    if engine.dialect.name == "sqlite":
+        sqlite_savepoints(engine)
+    if is_memory_database(engine.url):
+        Registry.metadata.create_all(engine)
+
+
+def pytest_unconfigure(config: Any) -> None:
+    url = getattr(config, "test_database_url", None)
+    if url is None:
+        return
+    from .db import engine
+
+    engine.dispose()
+    drop_database(url)
+
+
+@pytest.fixture(autouse=True)
+def db_connection() -> Iterator[Connection]:
+    """
+    The connection everything in the test uses, in a transaction that is rolled back at the end of the test.
+    Sessions run inside a savepoint, which is started again whenever they commit or roll back.
+    """
+    from . import cache
+    from .db import Session, engine
+
+    connection = engine.connect()
+    transaction = connection.begin()
+    savepoint = connection.begin_nested()
+
+    def restart_savepoint(session: Any, session_transaction: Any) -> None:
+        nonlocal savepoint
+        if not savepoint.is_active:
+            savepoint = connection.begin_nested()
+
+    Session.configure(bind=connection)
+    event.listen(Session, "after_transaction_end", restart_savepoint)
+    try:
+        yield connection
+    finally:
+        event.remove(Session, "after_transaction_end", restart_savepoint)
+        Session.configure(bind=engine)
+        transaction.rollback()
+        connection.close()
+        if cache.query_cache is not None:
+            # It may hold the results of queries on data that has just been rolled back
+            cache.query_cache.backend.clear()
+
+
+@pytest.fixture
+def db_session(db_connection: Connection) -> Iterator[Any]:
+    """A Session in the test's transaction"""
+    from .db import Session
+
+    with Session() as session:
+        yield session
+
+
+@pytest.fixture
+def broker() -> Iterator[Any]:
+    """The stub broker, emptied after the test"""
+    from dramatiq import get_broker
+
+    stub = get_broker()
+    yield stub
+    stub.flush_all()
+
+
+if __name__ == "__main__":
+    # Called by prepare_template(), with FASTAPI_DATABASE_URL pointing at the template
+    os.environ.setdefault(
+        "FASTAPI_CONFIG_MODULE", "opinionated.fastapi.default_settings"
+    )
+    os.environ.setdefault("FASTAPI_SETTINGS", "DefaultSettings")
+    from .config import init_config
+
+    init_config()
+    build_schema()
@@ -0,0 +1,94 @@
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from starlette.routing import Router
+from starlette.types import ASGIApp, Message, Scope
+
+
+class RateLimiter:
+    """
+    A thread-safe token bucket, allowing on average rate events per second, in bursts of up to burst events (by
+    default rate, but at least one, so rates below one per second still let anything through)
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = max(1.0, rate) if burst is None else burst
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RouteTemplates:
+    """
+    Finds the path template (e.g. "/items/{item_id}") of the route that handled a request, from the endpoint that
+    routing stored in the ASGI scope. Routes can be added after this is set up, so they're looked up lazily.
+    """
+
+    def __init__(self, router: Router):
+        self.router = router
+        self._templates: Dict[Callable, str] = {}
+
+    def for_scope(self, scope: Scope) -> Optional[str]:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return None
+        template = self._templates.get(endpoint)
+        if template is None:
+            for route in self.router.routes:
+                if getattr(route, "endpoint", None) is endpoint:
+                    template = getattr(route, "path", None)
+                    if template is not None:
+                        self._templates[endpoint] = template
+                    break
+        return template
+
+
+def http_scope(
+    path: str, method: str = "GET", headers: Optional[List[Tuple[bytes, bytes]]] = None
+) -> Scope:
+    """An ASGI scope for a request made directly to the app, without a server"""
+    path, _, query = path.partition("?")
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(b"host", b"localhost"), *(headers or [])],
+        "client": ("127.0.0.1", 0),
+        "server": ("localhost", 80),
+    }
+
+
+async def asgi_request(app: ASGIApp, scope: Scope, body: bytes = b"") -> int:
+    """Send a request directly to the app, discarding the response. Returns the status code."""
+    status = 0
+
+    async def receive() -> Message:
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message: Message) -> None:
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
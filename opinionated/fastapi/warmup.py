@@ -0,0 +1,98 @@
+"""
+warmup
+
+Startup hooks that get the expensive first-time work out of the way before a web worker starts serving requests:
+opening database connections, connecting to the broker, importing modules, and building the OpenAPI schema.
+Failures are logged rather than raised - a cold worker is still better than one that won't start.
+"""
+import importlib
+import logging
+from typing import List
+
+from fastapi import FastAPI
+
+logger = logging.getLogger(__name__)
+
+
+def warm_modules(modules: List[str]) -> None:
+    for mod in modules:
+        try:
+            importlib.import_module(mod)
+        except ImportError:
+            logger.exception("Warmup failed to import %s", mod)
+
+
+def warm_db_pool(count: int) -> None:
+    """Open up to count connections on the engine, then return them all to the pool"""
+    from sqlalchemy import text
+    from sqlalchemy.exc import SQLAlchemyError
+    from sqlalchemy.pool import QueuePool
+
+    from .db import engine
+
+    # Don't open more than the pool will keep; the other pools keep one connection per thread, or none at all
+    if isinstance(engine.pool, QueuePool):
+        count = min(count, engine.pool.size())
+    else:
+        count = min(count, 1)
+
+    connections = []
+    try:
+        for _ in range(count):
+            conn = engine.connect()
+            connections.append(conn)
+            conn.execute(text("SELECT 1"))
+    except SQLAlchemyError:
+        logger.exception("Warmup failed to open database connections")
+    finally:
+        for conn in connections:
+            conn.close()
+    logger.debug("Warmed up %d database connections", len(connections))
+
+
+def warm_broker() -> None:
+    """Make sure the broker connection is open"""
+    from dramatiq import get_broker
+    from dramatiq.brokers.rabbitmq import RabbitmqBroker
+
+    from .tasks import ping_broker
+
+    try:
+        broker = get_broker()
+        if isinstance(broker, RabbitmqBroker):
+            # Opens the connection for this thread (the event loop's), which async endpoints send their tasks through
+            broker.connection.process_data_events(time_limit=0)
+        else:
+            ping_broker()
+    except Exception:
+        logger.exception("Warmup failed to connect to the broker")
+
+
+async def warm_route(app: FastAPI, path: str) -> None:
+    """Make a GET request to path, directly through the ASGI app"""
+    from .utils import asgi_request, http_scope
+
+    scope = http_scope(path, headers=[(b"user-agent", b"opinionated-warmup")])
+    try:
+        status = await asgi_request(app, scope)
+    except Exception:
+        logger.exception("Warmup request to %s failed", path)
+        return
+    logger.debug("Warmup request to %s returned %s", path, status)
+
+
+async def warmup(app: FastAPI) -> None:
+    """Run all the configured warmup steps"""
+    from .config import settings
+
+    logger.info("Warming up")
+    warm_modules(settings.WARMUP_MODULES)
+    if settings.WARMUP_DB_CONNECTIONS > 0:
+        warm_db_pool(settings.WARMUP_DB_CONNECTIONS)
+    if settings.WARMUP_BROKER:
+        warm_broker()
+    if settings.WARMUP_OPENAPI and app.openapi_url is not None:
+        # Builds and caches the schema on the app
+        app.openapi()
+    for path in settings.WARMUP_ROUTES:
+        await warm_route(app, path)
@@ -0,0 +1,16 @@
+import os
+
+# The framework's own tests run against the default settings, with an in-memory database and the stub broker
+os.environ.setdefault("FASTAPI_CONFIG_MODULE", "opinionated.fastapi.default_settings")
+os.environ.setdefault("FASTAPI_SETTINGS", "DefaultSettings")
+os.environ.update(
+    {
+        "FASTAPI_DATABASE_URL": "sqlite://",
+        "FASTAPI_WORKER_BROKER_TYPE": "stub",
+        "FASTAPI_LOG_ASYNC": "false",
+    }
+)
+
+from opinionated.fastapi.bootstrap import setup  # noqa: E402
+
+setup()
@@ -0,0 +1,64 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from opinionated.fastapi import db
+from opinionated.fastapi.backups import (
+    Manifest,
+    create_backup,
+    list_backups,
+    pg_restore,
+    remove_backup,
+    restore_backup,
+)
+from opinionated.fastapi.config import override_settings
+
+
+def names(engine):
+    with engine.connect() as connection:
+        return (
+            connection.execute(text("SELECT name FROM item ORDER BY id"))
+            .scalars()
+            .all()
+        )
+
+
+def test_sqlite_round_trip(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'db.sqlite'}", future=True)
+    monkeypatch.setattr(db, "engine", engine)
+    with engine.begin() as connection:
+        connection.execute(
+            text("CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT)")
+        )
+        connection.execute(text("INSERT INTO item (name) VALUES ('one'), ('two')"))
+
+    with override_settings(BACKUPS_DIR=str(tmp_path / "backups")):
+        manifest = create_backup("first")
+        assert manifest.dialect == "sqlite"
+        assert [found.name for found in list_backups()] == ["first"]
+
+        with engine.begin() as connection:
+            connection.execute(text("DELETE FROM item WHERE name = 'one'"))
+            connection.execute(text("INSERT INTO item (name) VALUES ('three')"))
+        restore_backup("first")
+        assert names(engine) == ["one", "two"]
+
+        remove_backup("first")
+        assert list_backups() == []
+        assert not (tmp_path / "backups" / "first").exists()
+
+
+def test_unfinished_restore_isnt_overwritten(tmp_path):
+    ddl = tmp_path / "restore-ddl.sql"
+    ddl.write_text("CREATE INDEX ix_item_name ON item (name);\n")
+    manifest = Manifest(
+        name="backup",
+        created=datetime.utcnow(),
+        dialect="postgresql",
+        compression="gzip",
+    )
+
+    with pytest.raises(RuntimeError, match="restore-ddl.sql"):
+        pg_restore(manifest, tmp_path)
+    assert ddl.read_text() == "CREATE INDEX ix_item_name ON item (name);\n"
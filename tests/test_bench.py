@@ -0,0 +1,49 @@
+import sentry_sdk
+from dramatiq import get_broker
+
+from opinionated.fastapi.bench import BENCH_QUEUE, Report, compare, run_benchmarks
+from opinionated.fastapi.config import override_settings
+
+
+def test_tasks_use_a_stub_broker():
+    report = run_benchmarks(requests=10, scenarios=["tasks.enqueue"])
+    assert [result.name for result in report.results] == ["tasks.enqueue"]
+    assert BENCH_QUEUE not in get_broker().get_declared_queues()
+
+
+def test_sentry_client_is_restored():
+    hub = sentry_sdk.Hub.current
+    client = sentry_sdk.Client()
+    hub.bind_client(client)
+    try:
+        with override_settings(EXECUTOR_PROCESSES=0):
+            report = run_benchmarks(requests=5, routers=1, routes=1, scenarios=["http"])
+        assert hub.client is client
+    finally:
+        hub.bind_client(None)
+    assert [result.name for result in report.results] == [
+        "http.request",
+        "http.dispatch",
+        "http.sentry",
+    ]
+
+
+def test_report_round_trips_and_compares(tmp_path):
+    report = run_benchmarks(requests=5, scenarios=["settings"])
+    # As written by --output, and read back by --compare
+    path = tmp_path / "bench.json"
+    path.write_text(report.json(indent=2))
+    assert Report.parse_file(path) == report
+
+    baseline = report.copy(deep=True)
+    baseline.results[0].ops_per_second = report.results[0].ops_per_second * 2
+    baseline.results[1].ops_per_second = report.results[1].ops_per_second / 2
+    baseline.results[1].name = "settings.gone"
+    assert compare(report, baseline) == [
+        (
+            "settings.snapshot",
+            report.results[0].ops_per_second * 2,
+            report.results[0].ops_per_second,
+            -50.0,
+        )
+    ]
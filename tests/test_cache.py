@@ -0,0 +1,142 @@
+import time
+from typing import Any
+
+import fakeredis
+import pytest
+import redis
+from sqlalchemy import Column, Integer, String, create_engine, event, select
+from sqlalchemy.orm import registry, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from opinionated.fastapi import cache
+from opinionated.fastapi.config import override_settings
+
+mapper_registry = registry()
+# Typed as Any, so mypy (without the SQLAlchemy plugin) accepts the column keyword arguments
+Base: Any = mapper_registry.generate_base()
+
+
+class Flag(Base):
+    __tablename__ = "test_cache_flag"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+
+
+CACHED = select(Flag).order_by(Flag.id).execution_options(query_cache=True)
+
+
+class Database:
+    def __init__(self):
+        self.engine = create_engine("sqlite://", poolclass=StaticPool, future=True)
+        mapper_registry.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine, future=True)
+        self.queries = 0
+        event.listen(self.engine, "before_cursor_execute", self.count)
+
+    def count(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("SELECT"):
+            self.queries += 1
+
+    def flags(self, session=None):
+        if session is not None:
+            return [flag.name for flag in session.execute(CACHED).scalars()]
+        with self.Session() as session:
+            return self.flags(session)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(cache, "query_cache", None)
+    database = Database()
+    with override_settings(QUERY_CACHE_ENABLED=True):
+        cache.init_query_cache(database.Session)
+    with database.Session.begin() as session:
+        session.add(Flag(name="a"))
+    return database
+
+
+def test_results_are_cached(db):
+    assert db.flags() == ["a"]
+    assert db.flags() == ["a"]
+    assert db.queries == 1
+
+
+def test_commit_invalidates(db):
+    assert db.flags() == ["a"]
+    with db.Session.begin() as session:
+        session.add(Flag(name="b"))
+    assert db.flags() == ["a", "b"]
+    assert db.queries == 2
+
+
+def test_uncommitted_writes_bypass_the_cache(db):
+    assert db.flags() == ["a"]
+    with db.Session() as session:
+        session.add(Flag(name="b"))
+        session.flush()
+        # The session sees its own changes, which mustn't be cached for anyone else
+        assert db.flags(session) == ["a", "b"]
+        session.rollback()
+        assert cache.WRITTEN_TABLES not in session.info
+
+    # Nothing was committed, so the cached result still stands
+    queries = db.queries
+    assert db.flags() == ["a"]
+    assert db.queries == queries
+
+
+def test_explicit_invalidation(db):
+    assert db.flags() == ["a"]
+    cache.invalidate("test_cache_flag")
+    assert db.flags() == ["a"]
+    assert db.queries == 2
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.Redis, "from_url", lambda url: fakeredis.FakeRedis(server=server)
+    )
+    return fakeredis.FakeRedis(server=server)
+
+
+def test_redis_entries_are_signed(fake_redis):
+    # Any picklable value will do in place of a FrozenResult
+    result: Any = ["result"]
+    forged: Any = ["forged"]
+    backend = cache.RedisBackend("redis://", "test:", b"secret")
+    backend.set("key", result, (0,), 60)
+    assert backend.get("key", ("table",)) == (["result"], (0,))
+
+    # Anyone else who can write to redis
+    other = cache.RedisBackend("redis://", "test:", b"guessed")
+    other.set("key", forged, (0,), 60)
+    assert backend.get("key", ("table",)) == (None, (0,))
+
+
+def test_redis_backend_needs_a_secret_key(monkeypatch):
+    monkeypatch.setattr(cache, "query_cache", None)
+    settings = {
+        "QUERY_CACHE_ENABLED": True,
+        "QUERY_CACHE_BACKEND": "redis",
+        "QUERY_CACHE_REDIS_URL": "redis://",
+    }
+    with override_settings(**settings), pytest.raises(RuntimeError):
+        cache.init_query_cache(sessionmaker())
+
+
+def test_broadcast_subscribes_before_the_cache_is_used(fake_redis):
+    sender = cache.InvalidationBroadcast(
+        "redis://", "test:invalidate", cache.MemoryBackend(10)
+    )
+    backend = cache.MemoryBackend(10)
+    receiver = cache.InvalidationBroadcast("redis://", "test:invalidate", backend)
+
+    assert receiver.ready()
+    sender.publish(["test_cache_flag"])
+    deadline = time.monotonic() + 5
+    while backend.versions(("test_cache_flag",)) != (1,):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
@@ -0,0 +1,116 @@
+import gzip
+
+from fastapi import FastAPI
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.testclient import TestClient
+
+from opinionated.fastapi.compression import setup_compression_middleware
+from opinionated.fastapi.config import override_settings
+
+SCRIPT = "console.log('hello');"
+
+
+def get(client: TestClient, path: str, accept_encoding: str):
+    return client.get(path, headers={"Accept-Encoding": accept_encoding}, stream=True)
+
+
+def test_compression_is_opt_in():
+    app = setup_compression_middleware(FastAPI())
+
+    @app.get("/data")
+    def data():
+        return {"data": "x" * 5000}
+
+    response = get(TestClient(app), "/data", "gzip")
+    assert "content-encoding" not in response.headers
+
+
+def compressing_client():
+    app = FastAPI()
+
+    @app.get("/data")
+    def data():
+        return {"data": "x" * 5000}
+
+    @app.get("/small")
+    def small():
+        return {"data": "x"}
+
+    @app.get("/image")
+    def image():
+        return Response(b"x" * 5000, media_type="image/png")
+
+    @app.get("/etag")
+    def etag():
+        return PlainTextResponse("x" * 5000, headers={"ETag": '"abc"'})
+
+    @app.get("/stream")
+    def stream():
+        def chunks():
+            for i in range(3):
+                yield f"chunk {i}\n" * 10
+
+        return StreamingResponse(chunks(), media_type="text/plain")
+
+    with override_settings(COMPRESSION_ENCODINGS=["gzip"]):
+        return TestClient(setup_compression_middleware(app))
+
+
+def test_json_is_compressed():
+    response = get(compressing_client(), "/data", "gzip")
+    assert response.headers["content-encoding"] == "gzip"
+    assert "accept-encoding" in response.headers["vary"].lower()
+    body = response.raw.read(decode_content=False)
+    assert int(response.headers["content-length"]) == len(body)
+    assert gzip.decompress(body) == b'{"data":"' + b"x" * 5000 + b'"}'
+
+
+def test_small_and_unlisted_responses_are_left_alone():
+    client = compressing_client()
+
+    for path in ("/small", "/image"):
+        response = get(client, path, "gzip")
+        assert "content-encoding" not in response.headers
+        assert int(response.headers["content-length"]) == len(
+            response.raw.read(decode_content=False)
+        )
+
+
+def test_streaming_responses_are_compressed():
+    response = get(compressing_client(), "/stream", "gzip")
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    expected = "".join(f"chunk {i}\n" * 10 for i in range(3))
+    assert gzip.decompress(response.raw.read(decode_content=False)).decode() == expected
+
+
+def test_compressed_responses_get_a_weak_etag():
+    client = compressing_client()
+    assert get(client, "/etag", "gzip").headers["etag"] == 'W/"abc"'
+    assert get(client, "/etag", "identity").headers["etag"] == '"abc"'
+
+
+def test_static_files_use_their_own_encodings(tmp_path):
+    (tmp_path / "app.js").write_text(SCRIPT)
+    (tmp_path / "app.js.br").write_bytes(b"not really brotli")
+    (tmp_path / "app.js.gz").write_bytes(gzip.compress(SCRIPT.encode()))
+
+    # Compression is off, and brotli needn't be installed, but the compressed copies are still served
+    with override_settings(
+        STATIC_DIR=str(tmp_path),
+        COMPRESSION_ENCODINGS=[],
+        STATIC_ENCODINGS=["br", "gzip"],
+    ):
+        client = TestClient(setup_compression_middleware(FastAPI()))
+
+        response = get(client, "/static/app.js", "br")
+        assert response.headers["content-encoding"] == "br"
+        assert "javascript" in response.headers["content-type"]
+        # The client's preference wins, as long as we have that copy
+        response = get(client, "/static/app.js", "gzip, br;q=0.5")
+        assert response.headers["content-encoding"] == "gzip"
+        response = get(client, "/static/app.js", "br;q=0, *")
+        assert response.headers["content-encoding"] == "gzip"
+        response = get(client, "/static/app.js", "identity")
+        assert "content-encoding" not in response.headers
+        assert response.text == SCRIPT
@@ -0,0 +1,68 @@
+import copy
+import pickle
+import sys
+import timeit
+from types import ModuleType
+
+import pytest
+
+from opinionated.fastapi import config
+from opinionated.fastapi.config import (
+    current_snapshot,
+    override_settings,
+    register_settings_module,
+    settings_class,
+    settings_proxy,
+)
+from opinionated.fastapi.default_settings import DefaultSettings
+
+
+def test_snapshot_is_the_settings():
+    snapshot = current_snapshot()
+    assert isinstance(snapshot, DefaultSettings)
+    assert settings_class(snapshot) is DefaultSettings
+    assert isinstance(snapshot.APPS, list)
+    assert snapshot.APPS + ["extra"] == [*snapshot.APPS, "extra"]
+    assert copy.deepcopy(snapshot).dict() == snapshot.dict()
+    assert pickle.loads(pickle.dumps(snapshot)).dict() == snapshot.dict()
+    with pytest.raises(RuntimeError):
+        snapshot.DEBUG = True
+
+
+@pytest.mark.timing
+def test_snapshot_is_faster_than_the_proxy():
+    # The benchmark has the actual numbers (the settings.snapshot and settings.proxy scenarios); this only checks the
+    #  snapshot is faster at all, as it's typically several times faster
+    snapshot = current_snapshot()
+    direct = min(timeit.repeat(lambda: snapshot.DATABASE_URL, number=20000, repeat=5))
+    proxied = min(
+        timeit.repeat(lambda: settings_proxy.DATABASE_URL, number=20000, repeat=5)
+    )
+    assert direct < proxied
+
+
+@pytest.fixture
+def modules(monkeypatch):
+    monkeypatch.setattr(config, "_settings_modules", {*config._settings_modules})
+    registered = ModuleType("test_config_registered")
+    unregistered = ModuleType("test_config_unregistered")
+    for module in (registered, unregistered):
+        setattr(module, "settings", config.settings)
+        monkeypatch.setitem(sys.modules, module.__name__, module)
+    register_settings_module(registered.__name__)
+    return registered, unregistered
+
+
+def test_override_settings_rebinds_registered_modules(modules):
+    registered, unregistered = modules
+    previous = current_snapshot()
+    assert registered.settings is previous
+
+    with override_settings(SERVER_TITLE="Overridden"):
+        assert registered.settings is not previous
+        assert registered.settings.SERVER_TITLE == "Overridden"
+        assert unregistered.settings.SERVER_TITLE == "Overridden"
+
+    assert registered.settings is previous
+    assert unregistered.settings is settings_proxy
+    assert unregistered.settings.SERVER_TITLE == previous.SERVER_TITLE
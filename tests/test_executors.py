@@ -0,0 +1,105 @@
+import asyncio
+import os
+import threading
+
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from fastapi import Depends, FastAPI
+from starlette.testclient import TestClient
+
+from opinionated.fastapi import executors
+from opinionated.fastapi.config import override_settings
+from opinionated.fastapi.executors import (
+    Executor,
+    ExecutorFull,
+    ProcessExecutor,
+    ThreadExecutor,
+    noop,
+    setup_executors,
+    thread_pool,
+)
+
+
+def run_in_new_loop(coroutine):
+    # Not asyncio.run(), which leaves no event loop behind for TestClient
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_full_pool():
+    async def run():
+        pool = ThreadExecutor(1, 0)
+        release = threading.Event()
+        running = asyncio.ensure_future(pool.run(release.wait))
+        await asyncio.sleep(0)
+        with pytest.raises(ExecutorFull):
+            await pool.run(noop)
+        release.set()
+        await running
+        # Its slot is free again
+        await pool.run(noop)
+        pool.shutdown()
+
+    run_in_new_loop(run())
+
+
+def test_shutdown_cancels_waiting_work():
+    async def run():
+        pool = ThreadExecutor(1, 1)
+        release = threading.Event()
+        running = asyncio.ensure_future(pool.run(release.wait))
+        waiting = asyncio.ensure_future(pool.run(noop))
+        await asyncio.sleep(0)
+        stopping = asyncio.get_running_loop().run_in_executor(None, pool.shutdown)
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        # The running work still finishes
+        release.set()
+        await stopping
+        assert await running is True
+        assert not pool.futures
+
+    run_in_new_loop(run())
+
+
+def test_full_pool_is_a_503():
+    app = setup_executors(FastAPI())
+
+    @app.get("/work")
+    async def work(threads: Executor = Depends(thread_pool)):
+        return await threads.run(lambda: "done")
+
+    with override_settings(
+        EXECUTOR_THREADS=1, EXECUTOR_THREAD_QUEUE_SIZE=0, EXECUTOR_RETRY_AFTER=5
+    ), TestClient(app) as client:
+        assert client.get("/work").json() == "done"
+
+        # Take the only slot, as running work would
+        pool = executors.threads
+        assert pool is not None
+        assert pool.slots.acquire(blocking=False)
+        response = client.get("/work")
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "5"
+        pool.slots.release()
+
+        assert client.get("/work").json() == "done"
+
+
+def test_broken_process_pool_is_replaced():
+    async def run():
+        pool = ProcessExecutor(1, 0, "forkserver")
+        broken = pool.executor
+        try:
+            with pytest.raises(BrokenProcessPool):
+                await pool.run(os._exit, 1)
+            assert pool.executor is not broken
+            assert await pool.run(os.getpid) != os.getpid()
+        finally:
+            pool.shutdown()
+
+    run_in_new_loop(run())
@@ -0,0 +1,124 @@
+import json
+import logging
+import queue
+import sys
+from typing import Callable, List
+
+from fastapi import FastAPI
+from starlette.testclient import TestClient
+
+from opinionated.fastapi import log
+from opinionated.fastapi.config import override_settings
+from opinionated.fastapi.log import (
+    JSONFormatter,
+    NonBlockingQueueHandler,
+    RequestIDMiddleware,
+    SamplingFilter,
+    init_logging,
+    request_id,
+)
+
+
+def make_record(name="app", level=logging.INFO, msg="hello %s", args=("world",)):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+def test_json_formatter():
+    record = make_record()
+    record.request_id = "abc"
+    record.task_id = None
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record.exc_info = sys.exc_info()
+
+    data = json.loads(JSONFormatter().format(record))
+
+    assert data["message"] == "hello world"
+    assert data["level"] == "INFO"
+    assert data["logger"] == "app"
+    assert data["request_id"] == "abc"
+    assert "task_id" not in data
+    assert "ValueError: boom" in data["exc_info"]
+
+
+def test_sampling_filter(monkeypatch):
+    sampling = SamplingFilter({"sqlalchemy": 0.5}, {"chatty": 1})
+
+    monkeypatch.setattr(log.random, "random", lambda: 0.7)
+    assert not sampling.filter(make_record("sqlalchemy.engine"))
+    assert sampling.filter(make_record("sqlalchemyx"))
+    # Warnings and above always get through
+    assert sampling.filter(make_record("sqlalchemy.engine", logging.WARNING))
+    monkeypatch.setattr(log.random, "random", lambda: 0.2)
+    assert sampling.filter(make_record("sqlalchemy.engine"))
+
+    # One record a second, in bursts of one
+    assert sampling.filter(make_record("chatty"))
+    assert not sampling.filter(make_record("chatty.child"))
+    assert sampling.filter(make_record("chatty", logging.ERROR))
+
+
+def test_queue_handler_drops_records_when_full():
+    log_queue: queue.Queue = queue.Queue(maxsize=1)
+    handler = NonBlockingQueueHandler(log_queue)
+
+    for msg in ("first", "second", "third"):
+        handler.handle(make_record(msg=msg, args=()))
+    assert handler.dropped == 2
+    assert log_queue.get_nowait().msg == "first"
+
+    # Once there is room again, the next thing on the queue says how many were dropped
+    handler.handle(make_record(msg="fourth", args=()))
+    warning = log_queue.get_nowait()
+    assert warning.levelno == logging.WARNING
+    assert warning.msg == "Dropped 2 log records, the log queue was full"
+    # ...and that took the only place, so the record itself was dropped
+    assert handler.dropped == 1
+
+
+def test_request_id_middleware():
+    app = FastAPI()
+    app.add_middleware(RequestIDMiddleware)
+
+    @app.get("/")
+    def index():
+        return {"request_id": request_id.get()}
+
+    client = TestClient(app)
+
+    response = client.get("/", headers={"X-Request-ID": "abc"})
+    assert response.json() == {"request_id": "abc"}
+    assert response.headers["X-Request-ID"] == "abc"
+
+    response = client.get("/")
+    generated = response.headers["X-Request-ID"]
+    assert len(generated) == 32
+    assert response.json() == {"request_id": generated}
+
+
+def test_init_logging_registers_its_hooks_once(monkeypatch):
+    registered: List[Callable[[], None]] = []
+    monkeypatch.setattr(log, "_hooks_registered", False)
+    monkeypatch.setattr(log.atexit, "register", registered.append)
+    monkeypatch.setattr(
+        log.os,
+        "register_at_fork",
+        lambda after_in_child: registered.append(after_in_child),
+        raising=False,
+    )
+
+    try:
+        with override_settings(LOG_ASYNC=True):
+            init_logging()
+            first = log._listener
+            assert first is not None
+            init_logging()
+            assert log._listener is not first
+            # The old listener was stopped, which clears its thread
+            assert getattr(first, "_thread") is None
+    finally:
+        init_logging()
+
+    assert len(registered) == 2
+    assert log._listener is None
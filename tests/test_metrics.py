@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+from typing import Any
+
+from sqlalchemy import create_engine
+
+from opinionated.fastapi.config import override_settings
+from opinionated.fastapi.db import TimedQueuePool
+from opinionated.fastapi.metrics import (
+    instrument_engine,
+    mark_process_dead,
+    metrics_dir,
+)
+
+
+class Metric:
+    def __init__(self):
+        self.value = 0.0
+        self.observations = []
+
+    def inc(self):
+        self.value += 1
+
+    def dec(self):
+        self.value -= 1
+
+    def observe(self, value):
+        self.observations.append(value)
+
+
+class FakeMetrics:
+    def __init__(self):
+        self.db_pool_checkouts = Metric()
+        self.db_pool_in_use = Metric()
+        self.db_pool_wait = Metric()
+        self.db_connect_duration = Metric()
+
+
+def test_instrument_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'db.sqlite'}", future=True)
+    metrics: Any = FakeMetrics()
+    instrument_engine(metrics, engine)
+
+    with engine.connect():
+        assert metrics.db_pool_checkouts.value == 1
+        assert metrics.db_pool_in_use.value == 1
+    assert metrics.db_pool_in_use.value == 0
+    assert len(metrics.db_connect_duration.observations) == 1
+
+    # As after a fork: the new pool is still instrumented
+    engine.dispose(close=False)  # type: ignore[call-arg]
+    with engine.connect():
+        assert metrics.db_pool_checkouts.value == 2
+    assert len(metrics.db_connect_duration.observations) == 2
+
+
+def test_instrument_engine_records_checkout_wait(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'db.sqlite'}",
+        future=True,
+        poolclass=TimedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+    )
+    metrics: Any = FakeMetrics()
+    instrument_engine(metrics, engine)
+
+    with engine.connect():
+        assert len(metrics.db_pool_wait.observations) == 1
+        # Every connection is held, so this checkout has to wait for it to come back
+        waiting = threading.Thread(target=lambda: engine.connect().close())
+        waiting.start()
+        time.sleep(0.2)
+    waiting.join()
+
+    assert len(metrics.db_pool_wait.observations) == 2
+    assert metrics.db_pool_wait.observations[1] >= 0.15
+
+    # As after a fork: the new pool still reports its waits
+    engine.dispose(close=False)  # type: ignore[call-arg]
+    with engine.connect():
+        assert len(metrics.db_pool_wait.observations) == 3
+
+
+def test_mark_process_dead(tmp_path):
+    with override_settings(METRICS_ENABLED=True, METRICS_DIR=str(tmp_path)):
+        directory = metrics_dir("web")
+        os.makedirs(directory)
+        names = [
+            "gauge_livesum_123.db",
+            "gauge_liveall_123.db",
+            "gauge_livesum_456.db",
+            "gauge_all_123.db",
+            "counter_123.db",
+        ]
+        for name in names:
+            open(os.path.join(directory, name), "w").close()
+
+        mark_process_dead(123, "web")
+
+        assert sorted(os.listdir(directory)) == [
+            "counter_123.db",
+            "gauge_all_123.db",
+            "gauge_livesum_456.db",
+        ]
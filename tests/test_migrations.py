@@ -0,0 +1,112 @@
+import pytest
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, inspect, text
+
+from opinionated.fastapi import db, migrations
+
+ENV = """
+from opinionated.fastapi.migrations import run_alembic_migrations
+
+run_alembic_migrations()
+"""
+
+REVISION = """
+import sqlalchemy as sa
+from alembic import op
+
+revision = "a1"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table("test_migration_item", sa.Column("id", sa.Integer, primary_key=True))
+
+
+def downgrade():
+    op.drop_table("test_migration_item")
+"""
+
+BACKFILL_REVISION = """
+import sqlalchemy as sa
+from alembic import op
+
+from opinionated.fastapi.migrations import backfill
+
+revision = "a2"
+down_revision = "a1"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("test_migration_item", sa.Column("flag", sa.Integer))
+    # Gaps in the ids, so some batches are empty and others only partly full
+    op.execute("INSERT INTO test_migration_item (id) VALUES (1), (2), (3), (50), (51), (200)")
+    assert backfill("test_migration_item", {"flag": 1}, batch_size=2, pause=0) == 6
+
+
+def downgrade():
+    pass
+"""
+
+
+@pytest.fixture
+def alembic_config(tmp_path, monkeypatch):
+    script_location = tmp_path / "migrations"
+    (script_location / "versions").mkdir(parents=True)
+    (script_location / "env.py").write_text(ENV)
+    (script_location / "versions" / "a1.py").write_text(REVISION)
+    config = Config()
+    config.set_main_option("script_location", str(script_location))
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'db.sqlite'}", future=True)
+    monkeypatch.setattr(db, "engine", engine)
+    yield config
+    engine.dispose()
+
+
+def current_revision() -> str:
+    with db.engine.connect() as connection:
+        return connection.execute(
+            text("SELECT version_num FROM alembic_version")
+        ).scalar()
+
+
+@pytest.mark.parametrize("transaction_per_migration", [True, False])
+def test_upgrade_commits(alembic_config, monkeypatch, transaction_per_migration):
+    # What the SETs do on PostgreSQL: run a statement, which begins a transaction
+    def set_timeouts(bind, lock_timeout, statement_timeout):
+        bind.exec_driver_sql("SELECT 1")
+
+    monkeypatch.setattr(migrations, "set_timeouts", set_timeouts)
+    from opinionated.fastapi.config import override_settings
+
+    with override_settings(
+        MIGRATIONS_TRANSACTION_PER_MIGRATION=transaction_per_migration
+    ):
+        command.upgrade(alembic_config, "head")
+
+    assert current_revision() == "a1"
+    assert "test_migration_item" in inspect(db.engine).get_table_names()
+
+
+def test_backfill_updates_every_row_in_batches(alembic_config, caplog):
+    versions = alembic_config.get_main_option("script_location") + "/versions"
+    with open(f"{versions}/a2.py", "w") as revision:
+        revision.write(BACKFILL_REVISION)
+
+    with caplog.at_level("INFO", logger=migrations.__name__):
+        command.upgrade(alembic_config, "head")
+
+    assert current_revision() == "a2"
+    with db.engine.connect() as connection:
+        flags = connection.execute(
+            text("SELECT id, flag FROM test_migration_item ORDER BY id")
+        ).all()
+    assert flags == [(1, 1), (2, 1), (3, 1), (50, 1), (51, 1), (200, 1)]
+    batches = [r for r in caplog.records if r.getMessage().startswith("Backfilling")]
+    # Ids 1 to 200, two at a time, with progress logged between the batches
+    assert len(batches) == 99
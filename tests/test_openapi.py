@@ -0,0 +1,79 @@
+import gzip
+
+import pytest
+from starlette.requests import Request
+
+from opinionated.fastapi.compression import parse_accept_encoding, select_encoding
+from opinionated.fastapi.openapi import OpenAPIDocument, etag_matches
+from opinionated.fastapi.utils import http_scope
+
+document = OpenAPIDocument.from_schema({"openapi": "3.0.2", "paths": {}})
+
+
+def get(**headers: str):
+    raw = [(name.replace("_", "-").encode(), v.encode()) for name, v in headers.items()]
+    return document.response(Request(http_scope("/openapi.json", headers=raw)))
+
+
+def test_parse_accept_encoding():
+    header = "gzip;q=0, br; Q=0.5 , *;q=1, zstd;level=3;q=0.2"
+    assert parse_accept_encoding(header) == {
+        "gzip": 0.0,
+        "br": 0.5,
+        "*": 1.0,
+        "zstd": 0.2,
+    }
+
+
+@pytest.mark.parametrize(
+    "header,expected",
+    [
+        ("gzip", "gzip"),
+        ("GZIP, deflate", "gzip"),
+        ("gzip;q=0", None),
+        ("gzip;q=0, *", None),
+        ("*;q=0.1", "gzip"),
+        ("identity", None),
+        ("", None),
+    ],
+)
+def test_select_encoding(header, expected):
+    assert select_encoding(header, ["gzip"]) == expected
+
+
+def test_select_encoding_prefers_higher_quality():
+    assert select_encoding("gzip;q=1, br;q=0.5", ["br", "gzip"]) == "gzip"
+    assert select_encoding("gzip, br", ["br", "gzip"]) == "br"
+
+
+@pytest.mark.parametrize(
+    "header,matches",
+    [
+        (document.etag, True),
+        (f"W/{document.etag}", True),
+        (f'"other", {document.etag}', True),
+        ("*", True),
+        ('"other"', False),
+        ("", False),
+    ],
+)
+def test_etag_matches(header, matches):
+    assert etag_matches(header, document.etag) is matches
+
+
+def test_not_modified():
+    response = get(if_none_match=f'"stale", W/{document.etag}')
+    assert response.status_code == 304
+    assert response.headers["etag"] == document.etag
+
+
+def test_gzip_refused():
+    response = get(accept_encoding="gzip;q=0")
+    assert "content-encoding" not in response.headers
+    assert response.body == document.body
+
+
+def test_gzip():
+    response = get(accept_encoding="br, gzip;q=0.8")
+    assert response.headers["content-encoding"] == "gzip"
+    assert gzip.decompress(response.body) == document.body
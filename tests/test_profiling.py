@@ -0,0 +1,50 @@
+import logging
+
+from fastapi import FastAPI
+from starlette.testclient import TestClient
+
+from opinionated.fastapi.profiling import ProfileWriter, ProfilingMiddleware
+
+
+class BrokenWriter(ProfileWriter):
+    def write(self, profiler, kind, name, duration):
+        raise OSError("disk full")
+
+
+def test_failing_to_save_a_profile_doesnt_fail_the_request(tmp_path, caplog):
+    app = FastAPI()
+
+    @app.get("/slow")
+    def slow():
+        return {"ok": True}
+
+    app.add_middleware(
+        ProfilingMiddleware,
+        writer=BrokenWriter(str(tmp_path), "speedscope", 10),
+        sample_rate=1.0,
+        threshold=0.0,
+        interval=0.001,
+    )
+    with caplog.at_level(logging.ERROR, logger="opinionated.fastapi.profiling"):
+        response = TestClient(app).get("/slow")
+
+    assert response.status_code == 200
+    assert "Failed to save profile of GET /slow" in caplog.text
+
+
+def test_profiles_are_saved(tmp_path):
+    app = FastAPI()
+
+    @app.get("/slow")
+    def slow():
+        return {"ok": True}
+
+    app.add_middleware(
+        ProfilingMiddleware,
+        writer=ProfileWriter(str(tmp_path), "speedscope", 10),
+        sample_rate=1.0,
+        threshold=0.0,
+        interval=0.001,
+    )
+    assert TestClient(app).get("/slow").status_code == 200
+    assert len(list(tmp_path.iterdir())) == 1
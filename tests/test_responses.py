@@ -0,0 +1,111 @@
+import datetime
+import json
+import sys
+from decimal import Decimal
+from enum import Enum
+from typing import Any
+from uuid import UUID
+
+import pytest
+from pydantic import BaseModel
+from sqlalchemy import Column, Integer, String, create_engine, text
+from sqlalchemy.orm import declarative_base
+
+from opinionated.fastapi.config import override_settings
+from opinionated.fastapi.responses import (
+    JSONResponse,
+    ORJSONResponse,
+    UJSONResponse,
+    default_response_class,
+    json_default,
+)
+
+# Typed as Any, so mypy (without the SQLAlchemy plugin) accepts it as a base class
+Base: Any = declarative_base()
+
+
+class Colour(Enum):
+    RED = "red"
+
+
+class Point(BaseModel):
+    x: int
+
+
+class Item(Base):
+    __tablename__ = "item"
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+
+
+UUID_VALUE = UUID("12345678-1234-5678-1234-567812345678")
+CONTENT = {
+    "datetime": datetime.datetime(2021, 1, 2, 3, 4, 5),
+    "date": datetime.date(2021, 1, 2),
+    "decimal": Decimal("1.5"),
+    "uuid": UUID_VALUE,
+    "enum": Colour.RED,
+    "model": Point(x=1),
+    "set": {1},
+    "bytes": b"abc",
+    "orm": Item(id=1, name="one"),
+    "text": "héllo",
+}
+EXPECTED = {
+    "datetime": "2021-01-02T03:04:05",
+    "date": "2021-01-02",
+    "decimal": 1.5,
+    "uuid": str(UUID_VALUE),
+    "enum": "red",
+    "model": {"x": 1},
+    "set": [1],
+    "bytes": "abc",
+    "orm": {"id": 1, "name": "one"},
+    "text": "héllo",
+}
+
+
+def test_json_default_rows():
+    engine = create_engine("sqlite://", future=True)
+    with engine.connect() as connection:
+        row = connection.execute(text("SELECT 1 AS id, 'one' AS name")).one()
+    assert json_default(row) == {"id": 1, "name": "one"}
+
+
+# The package each class needs, which is optional (the stdlib json is always there)
+RESPONSE_CLASSES = [
+    ("json", JSONResponse),
+    ("orjson", ORJSONResponse),
+    ("ujson", UJSONResponse),
+]
+
+
+@pytest.mark.parametrize("name, response_class", RESPONSE_CLASSES)
+def test_response_classes(name, response_class):
+    pytest.importorskip(name)
+    response = response_class(CONTENT)
+    assert json.loads(response.body) == EXPECTED
+    assert response.headers["content-type"] == "application/json"
+
+
+@pytest.mark.parametrize("name, response_class", RESPONSE_CLASSES)
+def test_response_classes_reject_unsupported_types(name, response_class):
+    pytest.importorskip(name)
+    with pytest.raises(TypeError):
+        response_class({"value": object()})
+
+
+@pytest.mark.parametrize("name, response_class", RESPONSE_CLASSES)
+def test_default_response_class(name, response_class):
+    pytest.importorskip(name)
+    with override_settings(JSON_RESPONSE_CLASS=name):
+        assert default_response_class() is response_class
+
+
+@pytest.mark.parametrize("name", ["orjson", "ujson"])
+def test_default_response_class_needs_the_package(name, monkeypatch):
+    # As if it wasn't installed
+    monkeypatch.setitem(sys.modules, name, None)
+    with override_settings(JSON_RESPONSE_CLASS=name):
+        with pytest.raises(RuntimeError, match="not installed"):
+            default_response_class()
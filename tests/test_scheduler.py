@@ -0,0 +1,62 @@
+from datetime import timedelta
+
+from sqlalchemy import update
+
+from opinionated.fastapi.db import engine
+from opinionated.fastapi.scheduler import (
+    SchedulerLeadership,
+    current_leader,
+    database_now,
+    scheduler_leases,
+)
+
+
+def expire(name: str) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            update(scheduler_leases)
+            .where(scheduler_leases.c.name == name)
+            .values(expires_at=database_now(conn) - timedelta(minutes=1))
+        )
+
+
+def test_acquire():
+    first = SchedulerLeadership("test-acquire")
+    second = SchedulerLeadership("test-acquire")
+
+    assert first.acquire()
+    assert not second.acquire()
+    assert current_leader("test-acquire") == first.holder
+
+
+def test_renew():
+    leader = SchedulerLeadership("test-renew")
+    other = SchedulerLeadership("test-renew")
+
+    assert leader.acquire()
+    assert leader.acquire()
+    assert leader.is_leader
+    assert not other.acquire()
+    assert current_leader("test-renew") == leader.holder
+
+
+def test_takeover_after_expiry():
+    old = SchedulerLeadership("test-takeover")
+    new = SchedulerLeadership("test-takeover")
+    assert old.acquire()
+
+    expire("test-takeover")
+    assert current_leader("test-takeover") is None
+    assert new.acquire()
+    assert not old.acquire()
+    assert current_leader("test-takeover") == new.holder
+
+
+def test_release():
+    old = SchedulerLeadership("test-release")
+    new = SchedulerLeadership("test-release")
+    assert old.acquire()
+
+    old.release()
+    assert not old.is_leader
+    assert new.acquire()
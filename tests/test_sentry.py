@@ -0,0 +1,47 @@
+from opinionated.fastapi.config import override_settings
+from opinionated.fastapi.sentry import TracesSampler, tracing_enabled
+from opinionated.fastapi.utils import RateLimiter
+
+DSN = "https://key@sentry.example.com/1"
+
+
+def test_rate_limiter_allows_at_least_one():
+    limiter = RateLimiter(0.5)
+    assert limiter.allow()
+    assert not limiter.allow()
+
+
+def test_rate_limiter_burst():
+    limiter = RateLimiter(1, burst=3)
+    assert [limiter.allow() for _ in range(4)] == [True, True, True, False]
+
+
+def test_tracing_is_opt_in():
+    with override_settings(SENTRY_DSN=DSN):
+        assert not tracing_enabled()
+    with override_settings(SENTRY_DSN=DSN, SENTRY_TRACES_ENABLED=True):
+        assert tracing_enabled()
+    with override_settings(SENTRY_TRACES_ENABLED=True):
+        assert not tracing_enabled()
+
+
+def test_sample_rate_alone_enables_tracing():
+    with override_settings(SENTRY_DSN=DSN, SENTRY_TRACES_SAMPLE_RATE=0.5):
+        assert tracing_enabled()
+    with override_settings(
+        SENTRY_DSN=DSN, SENTRY_TRACES_SAMPLE_RATE=0.5, SENTRY_TRACES_ENABLED=False
+    ):
+        assert not tracing_enabled()
+
+
+def test_budget_applies_to_sampled_parents():
+    sampler = TracesSampler(1.0, {}, {}, max_per_second=1)
+    assert sampler({"parent_sampled": True})
+    assert not sampler({"parent_sampled": True})
+    assert not sampler({"parent_sampled": False})
+
+
+def test_route_rates():
+    sampler = TracesSampler(0.0, {"/items/{item_id}": 1.0}, {})
+    assert sampler({"asgi_scope": {"path": "/items/1"}})
+    assert not sampler({"asgi_scope": {"path": "/other"}})
@@ -0,0 +1,64 @@
+from types import SimpleNamespace
+
+import dramatiq
+import fakeredis
+import pytest
+from dramatiq.brokers.redis import RedisBroker
+from dramatiq.middleware import Shutdown
+
+from opinionated.fastapi import shutdown
+from opinionated.fastapi.shutdown import GracefulRetries
+
+
+@pytest.fixture
+def broker():
+    broker = RedisBroker(client=fakeredis.FakeRedis(), middleware=[GracefulRetries()])
+    yield broker
+    broker.flush_all()
+    broker.close()
+
+
+def test_interrupted_message_survives_the_ack(broker):
+    @dramatiq.actor(queue_name="graceful", broker=broker)
+    def task(value):
+        pass
+
+    sent = task.send(1)
+    consumer = broker.consume("graceful", prefetch=1, timeout=100)
+    message = next(consumer)
+    assert message.message_id == sent.message_id
+
+    # What the worker does with a message whose task was interrupted by the shutdown
+    broker.emit_after("process_message", message, exception=Shutdown())
+    consumer.ack(message)
+    consumer.close()
+
+    consumer = broker.consume("graceful", prefetch=1, timeout=100)
+    requeued = next(consumer)
+    assert requeued is not None
+    assert requeued.message_id != sent.message_id
+    assert requeued.args == (1,)
+    assert requeued.options.get("retries") is None
+    consumer.ack(requeued)
+    consumer.close()
+
+
+def test_running_tasks_get_the_timeout(monkeypatch):
+    closed = []
+    monkeypatch.setattr(shutdown, "close_connections", lambda: closed.append(True))
+    notifications = shutdown.GracefulShutdownNotifications(timeout=60)
+
+    # The scheduler's wakeup worker doesn't start the timer
+    wakeup_worker = SimpleNamespace(runs_actors=False)
+    notifications.before_worker_shutdown(None, wakeup_worker)
+    assert notifications.timer is None
+
+    worker = SimpleNamespace(workers=[])
+    notifications.before_worker_shutdown(None, worker)
+    timer = notifications.timer
+    assert timer is not None
+    assert timer.interval == 60 * shutdown.INTERRUPT_AT
+    notifications.after_worker_shutdown(None, worker)
+    assert timer.finished.is_set()
+    assert notifications.timer is None
+    assert closed == [True]
@@ -0,0 +1,69 @@
+from pathlib import Path
+
+import pytest
+
+pytest_plugins = ["pytester"]
+
+ROOT = Path(__file__).resolve().parents[1]
+
+TESTS = """
+import dramatiq
+from sqlalchemy import inspect, text
+
+from opinionated.fastapi.tasks import InlineBroker
+
+calls = []
+
+
+@dramatiq.actor
+def record(value):
+    calls.append(value)
+
+
+def test_tasks_run_inline(broker):
+    assert isinstance(broker, InlineBroker)
+    record.send(1)
+    assert calls == [1]
+
+
+def test_scheduler_wakeups_are_queued(broker):
+    broker.declare_queue("scheduler")
+    broker.enqueue(
+        dramatiq.Message(
+            queue_name="scheduler",
+            actor_name="wakeup-scheduler",
+            args=(),
+            kwargs={},
+            options={},
+        )
+    )
+    assert broker.queues["scheduler"].qsize() == 1
+
+
+def test_create_table(db_connection):
+    db_connection.execute(text("CREATE TABLE item (id INTEGER)"))
+    db_connection.execute(text("INSERT INTO item VALUES (1)"))
+
+
+def test_rolled_back(db_connection):
+    assert "item" not in inspect(db_connection).get_table_names()
+"""
+
+
+@pytest.fixture
+def plugin_env(tmp_path, monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", str(ROOT))
+    monkeypatch.setenv("FASTAPI_DATABASE_URL", f"sqlite:///{tmp_path / 'app.db'}")
+    monkeypatch.setenv("FASTAPI_TEST_ALEMBIC_CONFIG", str(tmp_path / "alembic.ini"))
+    monkeypatch.delenv("FASTAPI_WORKER_BROKER_INLINE", raising=False)
+
+
+def test_plugin(pytester, plugin_env, tmp_path):
+    pytester.makepyfile(test_app=TESTS)
+    result = pytester.runpytest_subprocess(
+        "-p", "opinionated.fastapi.testing", "-p", "no:cacheprovider"
+    )
+    result.assert_outcomes(passed=4)
+    # The template is kept for the next run, the worker's own database is dropped
+    assert (tmp_path / "app.test-template.db").exists()
+    assert not (tmp_path / "app.test-main.db").exists()
@@ -0,0 +1,35 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool, SingletonThreadPool
+
+from opinionated.fastapi import db
+from opinionated.fastapi.warmup import warm_db_pool
+
+
+def test_warm_db_pool(tmp_path, monkeypatch):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'db.sqlite'}",
+        poolclass=QueuePool,
+        pool_size=2,
+        future=True,
+    )
+    monkeypatch.setattr(db, "engine", engine)
+    warm_db_pool(5)
+    assert isinstance(engine.pool, QueuePool)
+    assert engine.pool.checkedin() == 2
+    engine.dispose()
+
+
+def test_warm_db_pool_singleton(monkeypatch):
+    # An in-memory database, like the one the tests run on, with a pool that has no size()
+    engine = create_engine("sqlite://", future=True)
+    assert isinstance(engine.pool, SingletonThreadPool)
+    connects = []
+    event.listen(engine, "connect", lambda *args: connects.append(args))
+    monkeypatch.setattr(db, "engine", engine)
+
+    warm_db_pool(5)
+    assert len(connects) == 1
+    # The warmed up connection is the one this thread gets
+    with engine.connect():
+        assert len(connects) == 1
+    engine.dispose()